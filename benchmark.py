@@ -0,0 +1,842 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import platform
+import resource
+import tempfile
+import torch as t
+from torch.utils.data import DataLoader
+
+import main
+import models
+from config import opt
+from dataset import MURA_Dataset
+from dataset.synthetic import make_synthetic_mura
+from models.BasicModule import BasicModule
+from utils import TestTimeAugmentation
+from utils.tta import view as tta_view
+
+# models/__init__.py 中导出的所有模型；MultiBranchSpecialists 需要 model_type 或者 checkpoint 才有模型，不作为默认
+MODEL_NAMES = [name for name in dir(models)
+               if isinstance(getattr(models, name), type) and issubclass(getattr(models, name), BasicModule)
+               and name != 'MultiBranchSpecialists']
+
+STAGES = ['dataset', 'dataloader', 'step', 'val', 'test']
+
+
+def _as_list(x):
+    """
+    fire 会把 --model_names=A,B 解析成 str 或 tuple，这里统一成 list
+    """
+    if x is None:
+        return None
+    if isinstance(x, str):
+        return [v for v in x.split(',') if v]
+    if isinstance(x, (list, tuple)):
+        return list(x)
+    return [x]
+
+
+def _sync():
+    if opt.use_gpu:
+        t.cuda.synchronize()
+
+
+def _peak_memory_mb():
+    """
+    GPU 上返回 max_memory_allocated，CPU 上返回进程的峰值 RSS（单调不减，只能反映到目前为止的最大值）
+    """
+    if opt.use_gpu:
+        return t.cuda.max_memory_allocated() / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def _reset_peak_memory():
+    if opt.use_gpu:
+        t.cuda.reset_peak_memory_stats()
+
+
+def _environment():
+    return {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'torch': t.__version__,
+        'cpu_count': os.cpu_count(),
+        'num_threads': t.get_num_threads(),
+        'gpu': t.cuda.get_device_name(0) if opt.use_gpu else None,
+    }
+
+
+def _write(results, output):
+    with open(output, 'w') as F:
+        json.dump(results, F, indent=2, default=float)
+    print('benchmark results written to', output)
+
+
+def prepare(root=None, studies_per_part=4, images_per_study=3, **kwargs):
+    """
+    生成合成的 MURA 数据集，并把 opt 中的数据路径指向它
+    """
+    opt.parse(kwargs)
+    opt.use_visdom = False
+    opt.use_gpu = opt.use_gpu and t.cuda.is_available()
+
+    if root is None:
+        root = tempfile.mkdtemp(prefix='mura_bench_')
+    root = os.path.join(root, '')
+
+    train_csv, valid_csv = make_synthetic_mura(root, studies_per_part=studies_per_part,
+                                               images_per_study=images_per_study)
+    opt.data_root = root
+    opt.train_image_paths = train_csv
+    opt.test_image_paths = valid_csv
+    opt.result_file = os.path.join(root, 'result.csv')
+    opt.output_csv_path = os.path.join(root, 'predictions.csv')
+    return root
+
+
+def bench_dataset(num_images=64):
+    """
+    MURA_Dataset.__getitem__ 的吞吐量（解码 + 数据增强），单进程
+    """
+    results = {}
+    for name, train in [('train', True), ('val', False)]:
+        data = MURA_Dataset(opt.data_root, opt.train_image_paths if train else opt.test_image_paths,
+                            train=train, test=False)
+        n = min(num_images, len(data))
+        start = time.perf_counter()
+        for i in range(n):
+            data[i]
+        elapsed = time.perf_counter() - start
+        results[name] = {'images': n, 'seconds': elapsed, 'images_per_s': n / elapsed}
+    return results
+
+
+def bench_dataloader(workers=(0, 2, 4), num_batches=10):
+    """
+    不同 num_workers 下 DataLoader 的吞吐量，首个 batch 的时间（worker 启动）单独统计
+    """
+    train_data = MURA_Dataset(opt.data_root, opt.train_image_paths, train=True, test=False)
+    results = []
+    for num_workers in workers:
+        dataloader = DataLoader(train_data, opt.batch_size, shuffle=True, num_workers=num_workers)
+        start = time.perf_counter()
+        first_batch, images = None, 0
+        for ii, (data, _, _, _) in enumerate(dataloader):
+            if first_batch is None:
+                first_batch = time.perf_counter() - start
+                start = time.perf_counter()
+            else:
+                images += data.size(0)
+            if ii == num_batches:
+                break
+        elapsed = time.perf_counter() - start
+        results.append({'num_workers': num_workers, 'first_batch_s': first_batch, 'images': images,
+                        'images_per_s': images / elapsed if images else None})
+    return results
+
+
+def bench_step(model_name, steps=5):
+    """
+    一个训练 step（forward + backward + optimizer.step）的时间和峰值内存
+    """
+    opt.model = model_name
+    model = getattr(models, model_name)()
+    if opt.use_gpu:
+        model.cuda()
+    model.train()
+
+    train_data = MURA_Dataset(opt.data_root, opt.train_image_paths, train=True, test=False)
+    data, label, _, body_part = next(iter(DataLoader(train_data, opt.batch_size, shuffle=True)))
+    if opt.use_gpu:
+        data, label = data.cuda(), label.cuda()
+
+    criterion = t.nn.CrossEntropyLoss()
+    optimizer = t.optim.Adam(model.parameters(), lr=opt.lr, weight_decay=opt.weight_decay)
+
+    def step():
+        optimizer.zero_grad()
+        timing = {}
+        start = time.perf_counter()
+        if model_name.startswith('MultiBranch'):
+            score = model(data, body_part)
+        else:
+            score = model(data)
+        loss = criterion(score, label)
+        _sync()
+        timing['forward'] = time.perf_counter() - start
+        start = time.perf_counter()
+        loss.backward()
+        _sync()
+        timing['backward'] = time.perf_counter() - start
+        start = time.perf_counter()
+        optimizer.step()
+        _sync()
+        timing['optimizer'] = time.perf_counter() - start
+        return timing
+
+    # 第一次 step 包含 cudnn autotune 和 Adam 状态的分配，不计入
+    _reset_peak_memory()
+    step()
+    timings = [step() for _ in range(steps)]
+
+    result = {k: sum(x[k] for x in timings) / steps for k in timings[0]}
+    result['step'] = sum(result.values())
+    result['batch_size'] = data.size(0)
+    result['images_per_s'] = data.size(0) / result['step']
+    result['peak_memory_mb'] = _peak_memory_mb()
+    result['parameters'] = sum(p.numel() for p in model.parameters())
+    return result
+
+
+def bench_val(model_name):
+    """
+    main.val 在整个验证集上的时间
+    """
+    opt.model = model_name
+    model = getattr(models, model_name)()
+    if opt.use_gpu:
+        model.cuda()
+
+    val_data = MURA_Dataset(opt.data_root, opt.test_image_paths, train=False, test=False)
+    val_dataloader = DataLoader(val_data, batch_size=opt.batch_size, shuffle=False, num_workers=opt.num_workers)
+
+    start = time.perf_counter()
+    main.val(model, val_dataloader)
+    _sync()
+    elapsed = time.perf_counter() - start
+    return {'images': len(val_data), 'seconds': elapsed, 'images_per_s': len(val_data) / elapsed}
+
+
+def bench_test(model_name):
+    """
+    main.test 端到端的时间：构建模型、推理、写 csv、计算 kappa
+    """
+    start = time.perf_counter()
+    main.test(model=model_name, load_model_path=None)
+    elapsed = time.perf_counter() - start
+    n = len(MURA_Dataset(opt.data_root, opt.test_image_paths, train=False, test=True))
+    return {'images': n, 'seconds': elapsed, 'images_per_s': n / elapsed}
+
+
+def _time(fn, repeat):
+    fn()
+    _sync()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    _sync()
+    return (time.perf_counter() - start) / repeat
+
+
+def spp(batch_size=8, channels=1664, size=10, levels=(1, 2, 3, 4), repeat=50, output='benchmark_spp.json',
+        **kwargs):
+    """
+    CustomDenseNet169 的多尺度 pooling：4 个 AdaptiveAvgPool2d + cat 与 SpatialPyramidPooling 的对比
+
+    python benchmark.py spp --use_gpu=False
+    """
+    opt.parse(kwargs)
+    opt.use_gpu = opt.use_gpu and t.cuda.is_available()
+    device = 'cuda' if opt.use_gpu else 'cpu'
+    levels = _as_list(levels)
+
+    x = t.randn(batch_size, channels, size, size, device=device, requires_grad=True)
+    poolings = [t.nn.AdaptiveAvgPool2d((n, n)) for n in levels]
+    fused = models.SpatialPyramidPooling(levels)
+
+    def separate():
+        return t.cat([p(x).view(x.size(0), -1) for p in poolings], 1)
+
+    def backward(fn):
+        def f():
+            x.grad = None
+            fn().sum().backward()
+        return f
+
+    results = {'environment': _environment(), 'input': [batch_size, channels, size, size], 'levels': levels}
+    with t.no_grad():
+        results['max_abs_diff'] = (separate() - fused(x)).abs().max().item()
+    x.grad = None
+    separate().pow(2).sum().backward()
+    grad_separate = x.grad.clone()
+    x.grad = None
+    fused(x).pow(2).sum().backward()
+    results['max_abs_grad_diff'] = (grad_separate - x.grad).abs().max().item()
+
+    for name, fn in [('adaptive_avg_pool', separate), ('spatial_pyramid_pooling', lambda: fused(x))]:
+        with t.no_grad():
+            forward_s = _time(fn, repeat)
+        results[name] = {'forward_ms': 1000. * forward_s, 'forward_backward_ms': 1000. * _time(backward(fn), repeat)}
+    results['forward_speedup'] = results['adaptive_avg_pool']['forward_ms'] / results['spatial_pyramid_pooling']['forward_ms']
+    results['forward_backward_speedup'] = (results['adaptive_avg_pool']['forward_backward_ms'] /
+                                           results['spatial_pyramid_pooling']['forward_backward_ms'])
+
+    print(json.dumps(results, indent=2))
+    _write(results, output)
+
+
+def focal_loss(batch_size=8, repeat=200, output='benchmark_focal_loss.json', **kwargs):
+    """
+    train() 中使用的带权 CrossEntropyLoss 与 FocalLoss（按类别 / 按部位的 alpha）的对比，
+    以及 fp16/bf16 输入时 loss 是否有限
+
+    python benchmark.py focal_loss --use_gpu=False
+    """
+    from dataset import BODY_PARTS
+    from utils import FocalLoss
+
+    opt.parse(kwargs)
+    opt.use_gpu = opt.use_gpu and t.cuda.is_available()
+    device = 'cuda' if opt.use_gpu else 'cpu'
+
+    weight = t.Tensor([0.6, 0.4]).to(device)
+    criterions = {
+        'cross_entropy': t.nn.CrossEntropyLoss(weight=weight),
+        'focal_loss': FocalLoss(class_num=2, alpha=weight, gamma=2).to(device),
+        'focal_loss_per_part': FocalLoss(class_num=2, alpha=t.rand(len(BODY_PARTS), 2), gamma=2,
+                                         parts=BODY_PARTS).to(device),
+    }
+
+    score = t.randn(batch_size, 2, device=device, requires_grad=True)
+    target = t.randint(0, 2, (batch_size,), device=device)
+    body_part = [BODY_PARTS[i % len(BODY_PARTS)] for i in range(batch_size)]
+
+    def call(criterion, x):
+        if isinstance(criterion, FocalLoss):
+            return criterion(x, target, body_part)
+        return criterion(x, target)
+
+    results = {'environment': _environment(), 'batch_size': batch_size}
+    for name, criterion in criterions.items():
+        def step():
+            score.grad = None
+            call(criterion, score).backward()
+        with t.no_grad():
+            forward_s = _time(lambda: call(criterion, score), repeat)
+        results[name] = {'forward_us': 1e6 * forward_s, 'forward_backward_us': 1e6 * _time(step, repeat)}
+
+        # 很大的 logit 在半精度下 softmax().log() 会得到 inf
+        for dtype in [t.float16, t.bfloat16]:
+            extreme = (score.detach() * 1e4).to(dtype)
+            key = f'finite_{dtype}'.replace('torch.', '')
+            try:
+                results[name][key] = bool(t.isfinite(call(criterion, extreme)).item())
+            except RuntimeError as e:
+                # 例如 CrossEntropyLoss 的 weight 与输入的 dtype 不一致
+                results[name][key] = repr(e)
+
+    print(json.dumps(results, indent=2))
+    _write(results, output)
+
+
+def _saved_activation_bytes(fn):
+    """
+    fn() 的 forward 中为 backward 保存的 tensor 的总大小（同一块存储只算一次），与设备无关。
+    checkpoint 区域内部的中间结果不会被保存，所以不计入
+    """
+    storages = {}
+
+    def pack(x):
+        storage = x.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return x
+
+    with t.autograd.graph.saved_tensors_hooks(pack, lambda x: x):
+        out = fn()
+    return out, sum(storages.values())
+
+
+def checkpointing(model='DenseNet169', stages='none;dense;dense,branch;layer;layer,branch', batch_size=None,
+                  steps=3, memory_budget_mb=None, output='benchmark_checkpointing.json', **kwargs):
+    """
+    不同 checkpoint_stages 下一个训练 step 的时间、保存的 activation 和峰值显存，以及估计的最大 batch size
+
+    stages 用 ';' 分隔不同的配置，每个配置内用 ',' 分隔；memory_budget_mb 默认为 GPU 的显存
+    python benchmark.py checkpointing --model=MultiBranchDenseNet169 --batch_size=4
+    """
+    prepare(**kwargs)
+    batch_size = batch_size or opt.batch_size
+    configs = [[x for x in c.split(',') if x and x != 'none'] for c in stages.split(';')]
+    if memory_budget_mb is None and opt.use_gpu:
+        memory_budget_mb = t.cuda.get_device_properties(0).total_memory / 2 ** 20
+
+    train_data = MURA_Dataset(opt.data_root, opt.train_image_paths, train=True, test=False)
+    data, label, _, body_part = next(iter(DataLoader(train_data, batch_size, shuffle=True)))
+    if opt.use_gpu:
+        data, label = data.cuda(), label.cuda()
+
+    results = {'environment': _environment(), 'model': model, 'batch_size': data.size(0), 'configs': []}
+    for config in configs:
+        net = getattr(models, model)()
+        if opt.use_gpu:
+            net.cuda()
+        net.train()
+        enabled = net.enable_checkpointing(config) if config else []
+        criterion = t.nn.CrossEntropyLoss()
+        optimizer = t.optim.Adam(net.parameters(), lr=opt.lr)
+
+        def forward():
+            if model.startswith('MultiBranch'):
+                return criterion(net(data, body_part), label)
+            return criterion(net(data), label)
+
+        def step():
+            optimizer.zero_grad()
+            loss, saved = _saved_activation_bytes(forward)
+            loss.backward()
+            optimizer.step()
+            return saved
+
+        step()
+        _reset_peak_memory()
+        _sync()
+        start = time.perf_counter()
+        saved = [step() for _ in range(steps)]
+        _sync()
+        step_s = (time.perf_counter() - start) / steps
+
+        result = {'stages': config, 'enabled': enabled, 'step_s': step_s, 'images_per_s': data.size(0) / step_s,
+                  'saved_activation_mb': max(saved) / 2 ** 20, 'peak_memory_mb': _peak_memory_mb()}
+        if memory_budget_mb and opt.use_gpu:
+            # 峰值显存 = 与 batch 无关的部分（参数、梯度、Adam 状态） + 每张图片的 activation
+            per_image = result['saved_activation_mb'] / data.size(0)
+            fixed = result['peak_memory_mb'] - result['saved_activation_mb']
+            result['estimated_max_batch_size'] = int((memory_budget_mb - fixed) / per_image)
+        results['configs'].append(result)
+        print(json.dumps(result))
+
+        del net, optimizer
+        if opt.use_gpu:
+            t.cuda.empty_cache()
+
+    base = results['configs'][0]
+    for result in results['configs']:
+        result['activation_ratio'] = result['saved_activation_mb'] / base['saved_activation_mb']
+        result['time_ratio'] = result['step_s'] / base['step_s']
+    _write(results, output)
+
+
+def compiled(model_names=None, batch_size=None, steps=5, output='benchmark_compile.json', **kwargs):
+    """
+    CPU 上每个模型 eager（NCHW、channels_last）与 torch.compile 的推理吞吐量对比，以及编译产生的 graph break 数
+
+    python benchmark.py compiled --model_names=DenseNet169,MultiBranchResNet50 --batch_size=4
+    """
+    import torch._dynamo
+
+    prepare(use_gpu=False, **kwargs)
+    model_names = _as_list(model_names) or MODEL_NAMES
+    batch_size = batch_size or opt.batch_size
+
+    val_data = MURA_Dataset(opt.data_root, opt.test_image_paths, train=False, test=False)
+    data, _, _, body_part = next(iter(DataLoader(val_data, batch_size, shuffle=True)))
+
+    results = {'environment': _environment(), 'batch_size': data.size(0), 'models': {}}
+    for model_name in model_names:
+        results['models'][model_name] = {}
+        for mode in ['eager', 'eager_channels_last', 'compiled', 'compiled_channels_last']:
+            print(f'benchmark {model_name} {mode}')
+            try:
+                # 每个 mode 创建新的模型，channels_last 和 compile_model 只修改这个模型自己的层
+                model = getattr(models, model_name)().eval()
+                x = data
+                if mode.endswith('channels_last'):
+                    model = model.to(memory_format=t.channels_last)
+                    x = data.contiguous(memory_format=t.channels_last)
+                torch._dynamo.reset()
+                torch._dynamo.utils.counters.clear()
+
+                start = time.perf_counter()
+                if mode.startswith('compiled'):
+                    model.compile_model()
+
+                def forward():
+                    with t.no_grad():
+                        if model_name.startswith('MultiBranch'):
+                            return model(x, body_part)
+                        return model(x)
+
+                # 第一次调用包含编译的时间
+                forward()
+                warmup_s = time.perf_counter() - start
+                seconds = _time(forward, steps)
+                results['models'][model_name][mode] = {
+                    'warmup_s': warmup_s, 'batch_s': seconds, 'images_per_s': data.size(0) / seconds,
+                    'graph_breaks': sum(torch._dynamo.utils.counters['graph_break'].values()),
+                }
+            except Exception as e:
+                results['models'][model_name][mode] = {'error': repr(e)}
+            finally:
+                model = None
+            print(results['models'][model_name][mode])
+
+    _write(results, output)
+
+
+def vgg_heads(model_names='VGG19,VGG16', batch_size=None, steps=3, output='benchmark_vgg_heads.json', **kwargs):
+    """
+    VGG 的 dense head（Linear(51200, 4096)）与 pooled head 的参数量、训练 step 的时间和峰值内存、推理延迟，
+    以及从 dense head 的 checkpoint 转换之后两者预测的一致率
+
+    python benchmark.py vgg_heads --model_names=VGG19,MultiBranchVGG19 --batch_size=4
+    """
+    prepare(**kwargs)
+    batch_size = batch_size or opt.batch_size
+
+    val_data = MURA_Dataset(opt.data_root, opt.test_image_paths, train=False, test=False)
+    data, label, _, body_part = next(iter(DataLoader(val_data, batch_size, shuffle=True)))
+    if opt.use_gpu:
+        data, label = data.cuda(), label.cuda()
+
+    results = {'environment': _environment(), 'batch_size': data.size(0), 'models': {}}
+    checkpoint = os.path.join(tempfile.mkdtemp(), 'dense.pth')
+    for model_name in _as_list(model_names):
+        predictions = {}
+        for name in [model_name, model_name + 'Pooled']:
+            net = getattr(models, name)()
+            if name == model_name:
+                net.save(checkpoint)
+            else:
+                net.load(checkpoint)
+            if opt.use_gpu:
+                net.cuda()
+            criterion = t.nn.CrossEntropyLoss()
+            optimizer = t.optim.SGD(net.parameters(), lr=opt.lr)
+
+            def forward():
+                if name.startswith('MultiBranch'):
+                    return net(data, body_part)
+                return net(data)
+
+            def step():
+                optimizer.zero_grad()
+                criterion(forward(), label).backward()
+                optimizer.step()
+
+            def infer():
+                with t.no_grad():
+                    return forward()
+
+            net.eval()
+            predictions[name] = infer().argmax(1)
+            test_s = _time(infer, steps)
+
+            net.train()
+            _reset_peak_memory()
+            step()
+            step_s = _time(step, steps)
+
+            num_params = sum(p.numel() for p in net.parameters())
+            head_params = sum(p.numel() for n, p in net.named_parameters() if n.startswith('classifier'))
+            result = {'params': num_params, 'head_params': head_params, 'param_mb': num_params * 4 / 2 ** 20,
+                      'train_step_s': step_s, 'test_batch_s': test_s, 'test_images_per_s': data.size(0) / test_s,
+                      'peak_memory_mb': _peak_memory_mb()}
+            results['models'][name] = result
+            print(name, json.dumps(result))
+
+            del net, optimizer
+            if opt.use_gpu:
+                t.cuda.empty_cache()
+
+        pooled = results['models'][model_name + 'Pooled']
+        pooled['agreement_with_dense'] = (predictions[model_name] == predictions[model_name + 'Pooled']).float().mean().item()
+        pooled['param_ratio'] = pooled['params'] / results['models'][model_name]['params']
+    _write(results, output)
+
+
+def shards(workers=(0, 2), shard_size_mb=4, resize=None, num_batches=None, output='benchmark_shards.json', **kwargs):
+    """
+    打乱顺序的一个 epoch：MURA_Dataset（每张图片一次随机读取）与 ShardDataset（顺序读取 shard）的吞吐量
+
+    python benchmark.py shards --studies_per_part=50 --workers=0,4
+    冷 cache 的结果需要在运行前清空 page cache（echo 3 > /proc/sys/vm/drop_caches）
+    """
+    from dataset import ShardDataset, pack_shards
+
+    prepare(**kwargs)
+    train_data = MURA_Dataset(opt.data_root, opt.train_image_paths, train=True, test=False)
+    shard_dir = os.path.join(tempfile.mkdtemp(), 'train')
+    start = time.perf_counter()
+    packed = pack_shards(train_data, shard_dir, shard_size_mb=shard_size_mb, resize=resize)
+    results = {'environment': _environment(), 'images': len(train_data), 'shards': len(packed),
+               'pack_s': time.perf_counter() - start, 'readers': []}
+
+    for num_workers in _as_list(workers):
+        for name, data in [('files', train_data), ('shards', ShardDataset(shard_dir, train_data))]:
+            dataloader = DataLoader(data, opt.batch_size, shuffle=name == 'files', num_workers=num_workers)
+            images = 0
+            start = time.perf_counter()
+            for ii, (x, _, _, _) in enumerate(dataloader):
+                images += x.size(0)
+                if num_batches is not None and ii + 1 == num_batches:
+                    break
+            elapsed = time.perf_counter() - start
+            result = {'reader': name, 'num_workers': num_workers, 'images': images, 'epoch_s': elapsed,
+                      'images_per_s': images / elapsed}
+            results['readers'].append(result)
+            print(json.dumps(result))
+    _write(results, output)
+
+
+def image_cache(epochs=3, num_workers=2, budget_mb=256, output='benchmark_image_cache.json', **kwargs):
+    """
+    验证集重复读取 epochs 遍：不使用 cache 与使用 SharedImageCache 时每个 epoch 的吞吐量和命中率
+
+    python benchmark.py image_cache --num_workers=4 --budget_mb=1024
+    """
+    from dataset import SharedImageCache
+
+    prepare(**kwargs)
+    results = {'environment': _environment(), 'num_workers': num_workers, 'budget_mb': budget_mb, 'epochs': {}}
+    for name in ['no_cache', 'cache']:
+        val_data = MURA_Dataset(opt.data_root, opt.test_image_paths, train=False, test=False)
+        if name == 'cache':
+            val_data.image_cache = SharedImageCache(val_data.imgs, budget_mb)
+        dataloader = DataLoader(val_data, opt.batch_size, shuffle=False, num_workers=num_workers)
+        results['epochs'][name] = []
+        for epoch in range(epochs):
+            start = time.perf_counter()
+            images = sum(data.size(0) for data, _, _, _ in dataloader)
+            elapsed = time.perf_counter() - start
+            result = {'epoch': epoch, 'epoch_s': elapsed, 'images_per_s': images / elapsed}
+            if val_data.image_cache is not None:
+                result.update(val_data.image_cache.stats())
+                val_data.image_cache.reset_stats()
+            results['epochs'][name].append(result)
+            print(name, json.dumps(result))
+    _write(results, output)
+
+
+def prefetch(windows=(0, 8, 32), threads=8, num_workers=2, read_delay_ms=0, output='benchmark_prefetch.json', **kwargs):
+    """
+    测试集读取一遍的吞吐量：window=0 为 MURA_Dataset 同步读取，其余为 PrefetchDataset，同时记录队列深度等统计量
+    read_delay_ms 模拟高延迟的存储（每次读取文件前 sleep）
+
+    python benchmark.py prefetch --windows=0,16,64 --read_delay_ms=20
+    """
+    import builtins
+    from dataset import PrefetchDataset
+
+    prepare(**kwargs)
+    results = {'environment': _environment(), 'num_workers': num_workers, 'threads': threads,
+               'read_delay_ms': read_delay_ms, 'windows': []}
+
+    real_open = builtins.open
+
+    def slow_open(path, mode='r', *args, **kw):
+        if read_delay_ms and 'b' in mode and str(path).endswith('.png'):
+            time.sleep(read_delay_ms / 1000.)
+        return real_open(path, mode, *args, **kw)
+
+    builtins.open = slow_open
+    try:
+        for window in _as_list(windows):
+            test_data = MURA_Dataset(opt.data_root, opt.test_image_paths, train=False, test=True)
+            data = PrefetchDataset(test_data, window, threads) if window else test_data
+            dataloader = DataLoader(data, opt.batch_size, shuffle=False, num_workers=num_workers)
+            start = time.perf_counter()
+            images = sum(x.size(0) for x, _, _, _ in dataloader)
+            elapsed = time.perf_counter() - start
+            result = {'window': window, 'images': images, 'seconds': elapsed, 'images_per_s': images / elapsed}
+            if window:
+                result['metrics'] = data.metrics.summary()
+            results['windows'].append(result)
+            print(json.dumps(result))
+    finally:
+        builtins.open = real_open
+    _write(results, output)
+
+
+def resolution(model='DenseNet169', schedule=((0, 160, 16), (2, 224, 12), (4, 320, 8)), max_epoch=6,
+               target_kappa=0.5, output='benchmark_resolution.json', **kwargs):
+    """
+    固定 320 训练与 resolution_schedule 训练：每个 epoch 的用时和验证集 study kappa，以及达到 target_kappa 的时间
+
+    python benchmark.py resolution --model=ResNet152 --max_epoch=10 --studies_per_part=40
+    checkpoint 保存在临时目录中
+    """
+    prepare(**kwargs)
+    results = {'environment': _environment(), 'model': model, 'target_kappa': target_kappa, 'runs': {}}
+
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    os.mkdir('checkpoints')
+    try:
+        for name, resolution_schedule in [('fixed', None), ('schedule', [list(x) for x in schedule])]:
+            history = main.train(model=model, max_epoch=max_epoch, resolution_schedule=resolution_schedule,
+                                 target_kappa=target_kappa, use_visdom=False)
+            reached = [h['seconds'] for h in history if h['val_kappa'] >= target_kappa]
+            results['runs'][name] = {'resolution_schedule': resolution_schedule, 'history': history,
+                                     'total_s': history[-1]['seconds'],
+                                     'time_to_target_s': reached[0] if reached else None}
+            print(name, json.dumps(results['runs'][name]['time_to_target_s']))
+    finally:
+        os.chdir(cwd)
+    _write(results, output)
+
+
+def importance(model='DenseNet169', max_epoch=6, target_kappa=0.5, output='benchmark_importance.json', **kwargs):
+    """
+    均匀采样与 importance_sampling：每个 epoch 的验证集 study kappa，以及达到 target_kappa 时前向计算过的图片数和时间
+
+    python benchmark.py importance --model=ResNet152 --max_epoch=10 --studies_per_part=40
+    checkpoint 保存在临时目录中
+    """
+    prepare(**kwargs)
+    results = {'environment': _environment(), 'model': model, 'target_kappa': target_kappa, 'runs': {}}
+
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    os.mkdir('checkpoints')
+    try:
+        for name, importance_sampling in [('uniform', False), ('importance', True)]:
+            history = main.train(model=model, max_epoch=max_epoch, importance_sampling=importance_sampling,
+                                 target_kappa=target_kappa, use_visdom=False)
+            reached = [h for h in history if h['val_kappa'] >= target_kappa]
+            results['runs'][name] = {'history': history, 'best_kappa': max(h['val_kappa'] for h in history),
+                                     'image_forwards_to_target': reached[0]['image_forwards'] if reached else None,
+                                     'time_to_target_s': reached[0]['seconds'] if reached else None}
+            print(name, results['runs'][name]['image_forwards_to_target'])
+    finally:
+        os.chdir(cwd)
+    _write(results, output)
+
+
+def branches(model_names='MultiBranchDenseNet169,MultiBranchResNet50', batch_size=None, steps=5, threads=None,
+             output='benchmark_branches.json', **kwargs):
+    """
+    MultiBranch 模型各部位 branch 依次执行与并行执行（CPU 上 threads，GPU 上 streams）的推理和训练 step 时间，
+    以及每个部位 branch 的耗时和负载的不均衡程度
+
+    python benchmark.py branches --model_names=MultiBranchResNet101 --batch_size=16 --threads=4
+    """
+    prepare(**kwargs)
+    batch_size = batch_size or opt.batch_size
+    val_data = MURA_Dataset(opt.data_root, opt.test_image_paths, train=False, test=False)
+    data, label, _, body_part = next(iter(DataLoader(val_data, batch_size, shuffle=True)))
+    if opt.use_gpu:
+        data, label = data.cuda(), label.cuda()
+
+    results = {'environment': _environment(), 'batch_size': data.size(0), 'parts': sorted(set(body_part)), 'models': {}}
+    for model_name in _as_list(model_names):
+        net = getattr(models, model_name)()
+        if opt.use_gpu:
+            net.cuda()
+        criterion = t.nn.CrossEntropyLoss()
+        results['models'][model_name] = {}
+        for mode in [None, 'streams' if opt.use_gpu else 'threads']:
+            net.set_branch_parallel(mode, threads)
+
+            def infer():
+                with t.no_grad():
+                    return net.eval()(data, body_part)
+
+            def step():
+                net.train().zero_grad()
+                criterion(net(data, body_part), label).backward()
+
+            result = {'test_batch_s': _time(infer, steps), 'train_step_s': _time(step, steps)}
+            net.set_branch_parallel(mode, threads, timing=True)
+            infer()
+            result['branch_timing'] = net.branch_stats(reset=True)
+            results['models'][model_name][mode or 'serial'] = result
+            print(model_name, mode or 'serial', json.dumps(result))
+        del net
+    _write(results, output)
+
+
+def tta(model='MultiBranchDenseNet169', views=(1, 2, 4, 8), batch_size=None, steps=5, output='benchmark_tta.json',
+        **kwargs):
+    """
+    test-time augmentation 的推理时间：K 个 view 拼在 batch 维度上做一次 forward（utils.TestTimeAugmentation），
+    与每个 view 单独 forward 一次比较，以及每增加一个 view 增加的时间
+
+    python benchmark.py tta --model=DenseNet169 --views=1,2,4,10 --batch_size=8
+    """
+    prepare(**kwargs)
+    batch_size = batch_size or opt.batch_size
+    val_data = MURA_Dataset(opt.data_root, opt.test_image_paths, train=False, test=False)
+    data, _, _, body_part = next(iter(DataLoader(val_data, batch_size, shuffle=False)))
+    if opt.use_gpu:
+        data = data.cuda()
+
+    net = getattr(models, model)().eval()
+    if opt.use_gpu:
+        net.cuda()
+    multi_branch = model.startswith('MultiBranch')
+
+    def forward(x, parts):
+        return net(x, parts) if multi_branch else net(x)
+
+    results = {'environment': _environment(), 'model': model, 'batch_size': data.size(0), 'views': {}}
+    for k in [int(v) for v in _as_list(views)]:
+        augmentation = TestTimeAugmentation(k)
+
+        def folded():
+            with t.no_grad():
+                return augmentation.reduce(forward(main.prepare_input(augmentation.expand(data)),
+                                                   augmentation.repeat(body_part)))
+
+        def looped():
+            with t.no_grad():
+                return [forward(main.prepare_input(tta_view(data, name)), body_part) for name in augmentation.views]
+
+        result = {'view_names': augmentation.views, 'folded_batch_s': _time(folded, steps),
+                  'looped_batch_s': _time(looped, steps)}
+        result['folded_ms_per_image'] = 1000. * result['folded_batch_s'] / data.size(0)
+        results['views'][k] = result
+        print(k, json.dumps(result))
+
+    # 以 1 个 view 为基准，每增加一个 view 增加的时间
+    base = results['views'].get(1)
+    if base is not None:
+        for k, result in results['views'].items():
+            if k > 1:
+                result['ms_per_added_view'] = 1000. * (result['folded_batch_s'] - base['folded_batch_s']) / (k - 1)
+                result['ms_per_added_view_per_image'] = result['ms_per_added_view'] / data.size(0)
+    _write(results, output)
+
+
+def run(model_names=None, stages=None, output='benchmark.json', root=None, steps=5, workers=(0, 2, 4),
+        num_batches=10, studies_per_part=4, images_per_study=3, **kwargs):
+    """
+    在合成数据上运行 benchmark，结果写入 output（json）
+
+    python benchmark.py run --model_names=DenseNet169,ResNet152 --stages=step,val --use_gpu=False
+    """
+    model_names = _as_list(model_names) or MODEL_NAMES
+    stages = _as_list(stages) or STAGES
+
+    root = prepare(root, studies_per_part=studies_per_part, images_per_study=images_per_study, **kwargs)
+    results = {'environment': _environment(), 'data_root': root, 'batch_size': opt.batch_size,
+               'num_workers': opt.num_workers, 'models': {}}
+
+    if 'dataset' in stages:
+        results['dataset'] = bench_dataset()
+    if 'dataloader' in stages:
+        results['dataloader'] = bench_dataloader(_as_list(workers), num_batches)
+
+    model_stages = [('step', lambda name: bench_step(name, steps)), ('val', bench_val), ('test', bench_test)]
+    for model_name in model_names:
+        results['models'][model_name] = {}
+        for stage, fn in model_stages:
+            if stage not in stages:
+                continue
+            print(f'benchmark {model_name} {stage}')
+            try:
+                results['models'][model_name][stage] = fn(model_name)
+            except Exception as e:
+                # 例如 VGG 显存不够，记录下来继续测下一个
+                results['models'][model_name][stage] = {'error': repr(e)}
+            if opt.use_gpu:
+                t.cuda.empty_cache()
+
+    _write(results, output)
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire()
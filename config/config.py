@@ -7,13 +7,34 @@ import time
 class Config(object):
     use_visdom = True
     env = 'MURA'                                                    # visdom 环境
+    vis_log_file = None                                             # visdom 不可用时写入的本地 jsonl 文件，None 为 tmp/visdom_{env}.jsonl
+    vis_flush_interval = 2                                          # 每隔 N 秒批量发送一次 visdom 数据
     model = 'MultiBranchDenseNet169'  # 使用的模型，名字必须与models/__init__.py中的名字一致
+    part = 'all'                                                    # 只使用一个部位的图片训练，例如 'XR_HAND'
 
     # 组合模型的 模型类型 和 路径
     ensemble_model_types = ['DenseNet169', 'ResNet152']
     ensemble_model_paths = ['checkpoints/best_densenet169_0702.pth',
                             'checkpoints/best_resnet152_0708.pth',
                             ]
+    ensemble_weights = None                                         # 每个模型的权重，None 为直接取平均
+    study_thresholds = None                                         # 每个部位 study 的阈值 {'XR_ELBOW': 0.5, ...}，None 为 0.5
+
+    # distill: 用 ensemble_model_types 的 soft target 训练一个小模型
+    student_model = 'ResNet34'
+    distill_temperature = 4                                         # soft target 的温度
+    distill_alpha = 0.7                                             # loss = alpha * KL(soft target) + (1 - alpha) * CE(label)
+
+    # cascade_test: 先用快的模型，study 概率落在 cascade_band 内的再交给 ensemble_model_types
+    cascade_fast_model = 'ResNet34'
+    cascade_fast_model_path = None
+    cascade_band = (0.3, 0.7)
+
+    # search_ensemble 的候选模型，从中搜索 ensemble 的组合、权重和阈值
+    search_model_types = ['DenseNet169', 'ResNet152']
+    search_model_paths = ['checkpoints/best_densenet169_0702.pth',
+                          'checkpoints/best_resnet152_0708.pth',
+                          ]
 
     data_root = '/DATA4_DB3/data/public/'
 
@@ -23,24 +44,64 @@ class Config(object):
     test_image_paths = data_root + 'MURA-v1.1/valid_image_paths.csv'    # 测试集存放路径
     # test_labeled_studies = '/DATA4_DB3/data/public/MURA-v1.1/valid_labeled_studies.csv'
 
+    shard_dir = None                                                # pack_dataset 的输出，不为 None 时 train 从 shard_dir/train 和 shard_dir/valid 顺序读取
+    image_cache_mb = 0                                              # 所有 DataLoader worker 共用的解码之后的图片 cache 的大小（MB），0 为不使用
+    prefetch_window = 0                                             # test / predict 时用线程池提前读取的文件数，0 为不使用
+    prefetch_threads = 8                                            # 每个 DataLoader worker 中读取文件的线程数
+    aspect_buckets = False                                          # 保持长宽比，按长宽比分成几种 canvas，每个 batch 的 shape 相同，见 dataset/buckets.py
+    canvas_size = 320                                               # canvas 的面积约为 canvas_size * canvas_size
+    stats_file = None                                               # compute_stats 生成的 mean / std，None 为使用 ImageNet 的 mean / std
+
     output_csv_path = 'predictions.csv'
+    prediction_cache_dir = 'cache/predictions'                      # 每张图片 logits 的 cache，None 为不使用
+    tta_views = 1                                                   # test 时每张图片的 view 数（utils/tta.py 的 VIEWS 的前 N 个，或者 view 名字的 list），1 为不使用 TTA
+
+    feature_cache_dir = None                                        # 不为 None 时固定 MultiBranch 模型的 trunk，用 cache 在这里的 trunk 特征训练 branch
 
     # load_model_path = 'checkpoints/CustomDenseNet169_0613_14:42:38.pth'
     load_model_path = None                                        # 加载预训练的模型的路径，为None代表不加载
 
     batch_size = 8                                                  # batch size
+    channels_last = False                                           # 模型和输入使用 channels_last 的内存格式
+    compile = False                                                 # 使用 torch.compile
+    checkpoint_stages = []                                          # activation checkpointing，例如 ['dense', 'layer3', 'branch']，见 BasicModule.enable_checkpointing
+    branch_parallel = None                                          # MultiBranch 模型各部位 branch 的执行方式：None（依次）、'threads'、'streams'，见 BasicModule.set_branch_parallel
+    branch_threads = None                                           # branch_parallel='threads' 的线程数，None 为 7（部位数）
+    branch_timing = False                                           # 记录每个部位 branch 的耗时，用于查看部位之间的负载是否均衡
     use_gpu = True                                                  # user GPU or not
     num_workers = 4                                                 # how many workers for loading data
     print_freq = 20                                                 # print info every N batch
 
     debug_file = 'tmp/debug'                                        # if os.path.exists(debug_file): enter ipdb
+
+    profile = False                                                 # 统计每个阶段（data/forward/backward...）的耗时，每 print_freq 个 batch 打印一次
+    profile_trace_steps = None                                      # (start, end): 在这几个 step 之间用 torch.profiler 记录 trace
+    profile_dir = 'tmp/profile'                                     # torch.profiler trace 的保存路径
     result_file = 'result.csv'
 
     max_epoch = 20
+    resolution_schedule = None                                      # [(开始的 epoch, 图片边长, batch size), ...]，例如 [(0, 224, 16), (6, 288, 12), (12, 320, 8)]，None 为一直使用 320 和 batch_size
+    target_kappa = None                                             # 验证集 study 级别的平均 kappa 第一次达到 target_kappa 时打印用时
     lr = 0.0001                                                      # initial learning rate
     lr_decay = 0.5                                                  # when val_loss increase, lr = lr*lr_decay
+    lr_policy = 'loss'                                              # 'loss'（训练 loss 增大时 lr * lr_decay）、'plateau'、'cosine'、'onecycle'，见 utils/schedule.py
+    warmup_epochs = 0                                               # 前 N 个 epoch 线性 warmup
+    lr_patience = 2                                                 # plateau: 验证集 study kappa 连续 N 个 epoch 没有提高时 lr * lr_decay
+    min_lr = 0                                                      # lr 的下界
+    early_stop_patience = None                                      # 验证集 study kappa 连续 N 个 epoch 没有提高时停止训练，None 为不停止
+    early_stop_min_delta = 0                                        # kappa 提高不超过 min_delta 时视为没有提高
+    keep_checkpoints = None                                         # 只保留最近 N 个 epoch 的 checkpoint（以及最好的一个），None 为全部保留
+    restore_best = True                                             # 训练结束后 model 加载验证集 study kappa 最好的 checkpoint
     weight_decay = 1e-5                                             # 损失函数
 
+    loss = 'CrossEntropyLoss'                                       # 'CrossEntropyLoss' 或 'FocalLoss'
+    focal_gamma = 2                                                 # FocalLoss 的 gamma
+    focal_alpha_per_part = False                                    # FocalLoss 的 alpha 按部位分别统计，用于 MultiBranch 模型
+    part_weights = False                                            # 每张图片的 loss 乘以部位的权重（与该部位的图片数成反比）
+    importance_sampling = False                                     # 按每张图片最近的 loss 采样（dataset.LossAwareSampler），loss 乘以 importance weight
+    importance_smoothing = 0.5                                      # 每张图片 loss 的滑动平均系数
+    importance_uniform = 0.3                                        # 采样概率中均匀分布的比例
+
     def parse(self, kwargs):
         """
         根据字典 kwargs 更新 config 参数。
@@ -1,3 +1,11 @@
 # -*- coding: utf-8 -*-
 
-from .dataset import MURA_Dataset
+from .dataset import MURA_Dataset, BODY_PARTS
+from .feature_store import FeatureStore, FeatureDataset
+from .statistics import compute_statistics, save_statistics, load_statistics
+from .shards import ShardDataset, pack_shards
+from .image_cache import SharedImageCache
+from .prefetch import PrefetchDataset
+from .buckets import BucketedDataset, BucketBatchSampler, pixel_report, bucket_transform_key
+from .resolution import ResolutionSchedule
+from .sampler import LossAwareSampler, class_weights, part_weights
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+import math
+import random
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from torchvision import transforms as T
+
+# canvas 的长宽比 height / width，相邻两个相差约 1.25 倍
+ASPECT_RATIOS = (0.5, 0.625, 0.8, 1., 1.25, 1.6, 2.)
+
+
+def canvas_shapes(size=320, ratios=ASPECT_RATIOS, multiple=32):
+    """
+    面积约为 size * size、长宽比为 ratios 的 canvas (height, width)，长宽为 multiple 的倍数（feature map 的 stride）
+    """
+    shapes = []
+    for r in ratios:
+        h = max(multiple, round(size * math.sqrt(r) / multiple) * multiple)
+        w = max(multiple, round(size / math.sqrt(r) / multiple) * multiple)
+        shapes.append((h, w))
+    return shapes
+
+
+def image_sizes(imgs, threads=16):
+    """
+    每张图片的 (width, height)，Image.open 只读取文件头，不 decode
+    """
+    def size(img_path):
+        with Image.open(img_path) as img:
+            return img.size
+
+    with ThreadPoolExecutor(threads) as pool:
+        return list(pool.map(size, imgs))
+
+
+def assign_buckets(sizes, shapes):
+    """
+    每张图片放入 log(长宽比) 最接近的 canvas，返回 canvas 的序号
+    """
+    log_ratios = [math.log(h / w) for h, w in shapes]
+    return [min(range(len(shapes)), key=lambda i: abs(log_ratios[i] - math.log(h / w))) for w, h in sizes]
+
+
+def bucket_transform_key(transform_key, size=320, ratios=ASPECT_RATIOS):
+    """
+    BucketedDataset 的 transform_key（utils.PredictionCache 使用），与 center crop 的 cache 区分开；transform_key 为 None 时为 None
+    """
+    if transform_key is None:
+        return None
+    return f'aspect{size}x{len(ratios)}_{transform_key}'
+
+
+def to_rgb_tensor(x):
+    # 1 channel 的灰度图复制成 3 channel
+    return x[:1].expand(3, -1, -1).contiguous()
+
+
+class Canvas(object):
+    """
+    保持长宽比缩放到能放入 (height, width) 的最大尺寸，剩余部分用 0（黑色背景）填充
+    不做 crop，整张图片都保留
+    """
+
+    def __init__(self, shape):
+        self.shape = shape
+
+    def __call__(self, img):
+        if img.mode != 'L':
+            img = img.split()[0]
+        h, w = self.shape
+        scale = min(h / img.height, w / img.width)
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        canvas = Image.new('L', (w, h))
+        canvas.paste(img.resize(size, Image.BILINEAR), ((w - size[0]) // 2, (h - size[1]) // 2))
+        return canvas
+
+
+def canvas_transforms(shape, train, mean, std):
+    augment = [T.RandomHorizontalFlip(), T.RandomVerticalFlip(), T.RandomRotation(30)] if train else []
+    return T.Compose([Canvas(shape)] + augment + [T.ToTensor(), T.Lambda(to_rgb_tensor), T.Normalize(mean=mean, std=std)])
+
+
+class BucketedDataset(object):
+    """
+    保持长宽比的 MURA_Dataset：每张图片按长宽比放入 canvas_shapes(size) 中的一个 canvas，
+    与 BucketBatchSampler 一起使用，每个 batch 中的图片来自同一个 canvas，shape 相同
+
+    transforms 与 MURA_Dataset 相同（train 时随机翻转和旋转），只是把 Resize + Crop 换成了 Canvas
+    """
+
+    def __init__(self, dataset, size=320, ratios=ASPECT_RATIOS, sizes=None):
+        self.dataset = dataset
+        self.root = dataset.root
+        self.imgs = dataset.imgs
+        self.profiler = None
+        self.shapes = canvas_shapes(size, ratios)
+        self.sizes = sizes if sizes is not None else image_sizes(self.imgs)
+        self.buckets = assign_buckets(self.sizes, self.shapes)
+
+        train = dataset.train and not dataset.test
+        self.transforms = [canvas_transforms(shape, train, dataset.mean, dataset.std) for shape in self.shapes]
+        self.transform_key = bucket_transform_key(dataset.transform_key, size, ratios)
+
+    def __getitem__(self, index):
+        img_path = self.imgs[index]
+        return self.dataset.get_sample(img_path, lambda: self.dataset.load_image(img_path),
+                                       self.transforms[self.buckets[index]])
+
+    def get_label(self, img_path):
+        return self.dataset.get_label(img_path)
+
+    def get_body_part(self, img_path):
+        return self.dataset.get_body_part(img_path)
+
+    def label_counts(self):
+        return self.dataset.label_counts()
+
+    def __len__(self):
+        return len(self.imgs)
+
+
+class BucketBatchSampler(object):
+    """
+    每个 batch 只包含同一个 bucket 的图片；shuffle 时打乱每个 bucket 内的顺序和 batch 的顺序
+    """
+
+    def __init__(self, buckets, batch_size, shuffle=True, drop_last=False):
+        self.groups = {}
+        for index, bucket in enumerate(buckets):
+            self.groups.setdefault(bucket, []).append(index)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def _batches(self):
+        batches = []
+        for bucket in sorted(self.groups):
+            indices = list(self.groups[bucket])
+            if self.shuffle:
+                random.shuffle(indices)
+            for i in range(0, len(indices), self.batch_size):
+                batch = indices[i:i + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+        if self.shuffle:
+            random.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        return iter(self._batches())
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(g) // self.batch_size for g in self.groups.values())
+        return sum(math.ceil(len(g) / self.batch_size) for g in self.groups.values())
+
+
+def pixel_report(dataset, size=320, ratios=ASPECT_RATIOS, sizes=None):
+    """
+    每个部位平均每个 study 的像素数，以及保留的图片内容的比例：
+        crop:   现在的 Resize(size) + CenterCrop(size)，长边超出 size 的部分被裁掉
+        aspect: BucketedDataset，整张图片缩放到 canvas 中，剩余部分为 padding
+    """
+    shapes = canvas_shapes(size, ratios)
+    sizes = sizes if sizes is not None else image_sizes(dataset.imgs)
+    buckets = assign_buckets(sizes, shapes)
+
+    studies = {}
+    for img_path, (w, h), bucket in zip(dataset.imgs, sizes, buckets):
+        study = img_path[:img_path.rfind('/')]
+        s = studies.setdefault(study, {'part': dataset.get_body_part(img_path), 'images': 0,
+                                       'crop_pixels': 0, 'crop_kept': 0., 'aspect_pixels': 0, 'aspect_content': 0.})
+        s['images'] += 1
+        s['crop_pixels'] += size * size
+        s['crop_kept'] += min(w, h) / max(w, h)
+        ch, cw = shapes[bucket]
+        scale = min(ch / h, cw / w)
+        s['aspect_pixels'] += ch * cw
+        s['aspect_content'] += (w * scale) * (h * scale) / (ch * cw)
+
+    report = {'shapes': shapes, 'bucket_images': {str(shapes[i]): buckets.count(i) for i in range(len(shapes))},
+              'parts': {}}
+    parts = {}
+    for s in studies.values():
+        parts.setdefault(s['part'], []).append(s)
+    for part in sorted(parts):
+        p = parts[part]
+        images = sum(s['images'] for s in p)
+        report['parts'][part] = {
+            'studies': len(p),
+            'crop_pixels_per_study': sum(s['crop_pixels'] for s in p) / len(p),
+            'aspect_pixels_per_study': sum(s['aspect_pixels'] for s in p) / len(p),
+            'crop_image_kept': sum(s['crop_kept'] for s in p) / images,            # crop 之后保留的图片内容比例
+            'aspect_canvas_content': sum(s['aspect_content'] for s in p) / images,  # canvas 中是图片内容（不是 padding）的比例
+        }
+    return report
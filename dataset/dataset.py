@@ -5,18 +5,18 @@ import torch as t
 from PIL import Image
 from torchvision import transforms as T
 
+from .statistics import load_statistics, channel_stats, statistics_key
+from .resolution import SharedSize, SharedResize, SharedCrop
+
 IMAGENET_MEAN = [0.485, 0.456, 0.406]
 IMAGENET_STD = [0.229, 0.224, 0.225]
 
-# training set 的 mean 和 std
-# >>> train_data = MURA_Dataset(opt.data_root, opt.train_image_paths, train=True)
-# >>> l = [x[0] for x in tqdm(train_data)]
-# >>> x = t.cat(l, 0)
-# >>> x.mean()
-# >>> x.std()
+# training set 的 mean 和 std，每个部位的统计量用 python main.py compute_stats 计算，见 dataset/statistics.py
 MURA_MEAN = [0.22588661454502146] * 3
 MURA_STD = [0.17956269377916526] * 3
 
+BODY_PARTS = ['XR_ELBOW', 'XR_FINGER', 'XR_FOREARM', 'XR_HAND', 'XR_HUMERUS', 'XR_SHOULDER', 'XR_WRIST']
+
 
 def logo_filter(data, threshold=200):
 
@@ -33,7 +33,7 @@ def logo_filter(data, threshold=200):
 
 class MURA_Dataset(object):
 
-    def __init__(self, root, csv_path, part='all', transforms=None, train=True, test=False):
+    def __init__(self, root, csv_path, part='all', transforms=None, train=True, test=False, stats_file=None):
         """
         主要目标： 获取所有图片的地址，并根据训练，验证，测试划分数据
 
@@ -43,6 +43,8 @@ class MURA_Dataset(object):
 
         part = 'all', 'XR_HAND', etc.
         用于提取特定部位的数据。
+
+        stats_file: compute_stats 生成的统计量文件，不为 None 时用其中 part 的 mean / std 代替 ImageNet 的 normalize
         """
 
         with open(csv_path, 'rb') as F:
@@ -53,34 +55,59 @@ class MURA_Dataset(object):
                 imgs = [root + str(x, encoding='utf-8').strip() for x in d if
                         str(x, encoding='utf-8').strip().split('/')[2] == part]
 
+        self.root = root
         self.imgs = imgs
         self.train = train
         self.test = test
 
-        if transforms is None:
+        # utils.Profiler，只在 num_workers=0 时由 main.py 设置，用于统计 decode 和 augment 的耗时
+        self.profiler = None
+
+        # dataset.SharedImageCache，由 main.py 设置，所有 worker 共用的解码之后的图片
+        self.image_cache = None
+
+        # 描述 transforms 的字符串，用于 utils.PredictionCache 区分不同的预处理；自定义的 transforms 为 None
+        self.transform_key = None
+
+        # normalize 使用的 mean 和 std，dataset.BucketedDataset 等使用相同的值
+        mean, std = IMAGENET_MEAN, IMAGENET_STD
+        if stats_file is not None:
+            stats = load_statistics(stats_file)
+            mean, std = channel_stats(stats, part if part in stats else 'all')
+        self.mean, self.std = mean, std
+
+        # Resize 和 Crop 的边长，train 时可以按 ResolutionSchedule 在每个 epoch 修改，见 set_size
+        self.size = SharedSize(320)
+
+        if transforms is not None:
+            self.transforms = transforms
+        else:
+            self.transform_key = 'random320' if self.train and not self.test else 'center320'
+            if stats_file is not None:
+                self.transform_key += f'_{statistics_key(stats_file)}'
 
             if self.train and not self.test:
                 # 这里的X光图是1 channel的灰度图
                 self.transforms = T.Compose([
                     # T.Lambda(logo_filter),
-                    T.Resize(320),
-                    T.RandomCrop(320),
+                    SharedResize(self.size),
+                    SharedCrop(self.size, random=True),
                     T.RandomHorizontalFlip(),
                     T.RandomVerticalFlip(),
                     T.RandomRotation(30),
                     T.ToTensor(),
                     T.Lambda(lambda x: t.cat([x[0].unsqueeze(0), x[0].unsqueeze(0), x[0].unsqueeze(0)], 0)),  # 转换成3 channel
-                    T.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD),
+                    T.Normalize(mean=mean, std=std),
                 ])
             if not self.train:
                 # 这里的X光图是1 channel的灰度图
                 self.transforms = T.Compose([
                     # T.Lambda(logo_filter),
-                    T.Resize(320),
-                    T.CenterCrop(320),
+                    SharedResize(self.size),
+                    SharedCrop(self.size, random=False),
                     T.ToTensor(),
                     T.Lambda(lambda x: t.cat([x[0].unsqueeze(0), x[0].unsqueeze(0), x[0].unsqueeze(0)], 0)),  # 转换成3 channel
-                    T.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD),
+                    T.Normalize(mean=mean, std=std),
                 ])
 
     def __getitem__(self, index):
@@ -89,41 +116,79 @@ class MURA_Dataset(object):
         """
 
         img_path = self.imgs[index]
+        return self.get_sample(img_path, lambda: self.load_image(img_path))
 
-        data = Image.open(img_path)
-
-        data = self.transforms(data)
+    def get_sample(self, img_path, open_image, transforms=None):
+        """
+        open_image() 返回 PIL Image，例如 Image.open(img_path) 或者从已经读入内存的文件内容解码（dataset.PrefetchDataset）
+        transforms 为 None 时使用 self.transforms
+        """
+        transforms = transforms or self.transforms
+        if self.profiler is None:
+            data = open_image()
+            data = transforms(data)
+        else:
+            with self.profiler.stage('decode'):
+                data = open_image()
+                data.load()
+            with self.profiler.stage('augment'):
+                data = transforms(data)
 
         # label
-        if not self.test:
-            label_str = img_path.split('_')[-1].split('/')[0]
-            if label_str == 'positive':
-                label = 1
-            elif label_str == 'negative':
-                label = 0
-            else:
-                print(img_path)
-                print(label_str)
-                raise IndexError
-
-        if self.test:
-            label = 0
+        label = 0 if self.test else self.get_label(img_path)
 
-        # body part
-        body_part = img_path.split('/')[6]
+        body_part = self.get_body_part(img_path)
 
         return data, label, img_path, body_part
 
+    def set_size(self, size):
+        """
+        修改默认 transforms 的图片边长，已经启动的 DataLoader worker 也会使用新的值
+        """
+        self.size.value = size
+
+    def load_image(self, img_path):
+        if self.image_cache is not None:
+            return self.image_cache.load(img_path)
+        return Image.open(img_path)
+
+    def get_label(self, img_path):
+        """
+        根据 study 文件夹的名字判断 label：positive 为 1，negative 为 0
+        """
+        label_str = img_path.split('_')[-1].split('/')[0]
+        if label_str == 'positive':
+            return 1
+        elif label_str == 'negative':
+            return 0
+        else:
+            print(img_path)
+            print(label_str)
+            raise IndexError
+
+    def get_body_part(self, img_path):
+        """
+        例如 MURA-v1.1/train/XR_ELBOW/patient00011/study1_negative/image1.png -> XR_ELBOW
+        """
+        return img_path[len(self.root):].split('/')[2]
+
+    def label_counts(self):
+        """
+        只根据路径统计每个部位的 [negative, positive] 图片数，不读取图片
+        """
+        counts = {}
+        for img_path in self.imgs:
+            c = counts.setdefault(self.get_body_part(img_path), [0, 0])
+            c[self.get_label(img_path)] += 1
+        return counts
+
     def __len__(self):
         return len(self.imgs)
 
 
 if __name__ == "__main__":
     from config.config import opt
-    from tqdm import tqdm
-    train_data = MURA_Dataset(opt.data_root, opt.train_image_paths, train=True)
-    l = [x[0] for x in tqdm(train_data)]
-    x = t.cat(l, 0)
-    print(x.mean())
-    print(x.std())
-
+    from .statistics import compute_statistics
+    stats = compute_statistics(opt.data_root, opt.train_image_paths)
+    print(stats['all']['mean'])
+    print(stats['all']['std'])
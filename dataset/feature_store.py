@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import numpy as np
+import torch as t
+from tqdm import tqdm
+
+
+class FeatureStore(object):
+    """
+    保存在硬盘上的 trunk 输出，用于固定 trunk 之后只训练 MultiBranch 的 branch 和 classifier
+
+    path/features.npy   float16，shape 为 (图片数, C, H, W)，用 np.load(mmap_mode='r') 按需读取
+    path/meta.json      图片路径、label、部位，写完 features.npy 之后才写入，存在即表示 cache 完整
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as F:
+            meta = json.load(F)
+        self.path = path
+        self.imgs = meta['imgs']
+        self.labels = meta['labels']
+        self.body_parts = meta['body_parts']
+        self.features = np.load(os.path.join(path, 'features.npy'), mmap_mode='r')
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, 'meta.json'))
+
+    @staticmethod
+    def build(path, trunk, dataloader, use_gpu=False):
+        """
+        用 trunk（例如 model.forward_trunk）计算 dataloader 中所有图片的特征并保存到 path
+        dataloader 不能 shuffle，一般使用 train=False 的 MURA_Dataset，即 center crop
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        features = None
+        imgs, labels, body_parts = [], [], []
+        n = len(dataloader.dataset)
+        tmp_path = os.path.join(path, 'features.tmp.npy')
+
+        with t.no_grad():
+            for data, label, img_path, body_part in tqdm(dataloader):
+                if use_gpu:
+                    data = data.cuda()
+                out = trunk(data).cpu().numpy().astype(np.float16)
+                if features is None:
+                    features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16,
+                                                         shape=(n,) + out.shape[1:])
+                features[len(imgs):len(imgs) + len(out)] = out
+
+                imgs += list(img_path)
+                labels += [int(x) for x in label]
+                body_parts += list(body_part)
+
+        features.flush()
+        del features
+        os.replace(tmp_path, os.path.join(path, 'features.npy'))
+        with open(os.path.join(path, 'meta.json'), 'w') as F:
+            json.dump({'imgs': imgs, 'labels': labels, 'body_parts': body_parts}, F)
+
+        return FeatureStore(path)
+
+    def __len__(self):
+        return len(self.imgs)
+
+
+class FeatureDataset(object):
+    """
+    与 MURA_Dataset 返回相同的 (data, label, img_path, body_part)，data 为 FeatureStore 中的 trunk 特征
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.imgs = store.imgs
+
+    def __getitem__(self, index):
+        data = t.from_numpy(np.asarray(self.store.features[index], dtype=np.float32))
+        return data, self.store.labels[index], self.store.imgs[index], self.store.body_parts[index]
+
+    def label_counts(self):
+        counts = {}
+        for label, body_part in zip(self.store.labels, self.store.body_parts):
+            counts.setdefault(body_part, [0, 0])[label] += 1
+        return counts
+
+    def __len__(self):
+        return len(self.store)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import os
+import multiprocessing as mp
+import numpy as np
+from PIL import Image
+
+# counters 中每一项的位置
+HITS, MISSES, EVICTIONS, TOO_LARGE = range(4)
+
+
+class SharedImageCache(object):
+    """
+    DataLoader 的所有 worker 共用的、解码之后的灰度图 cache，大小不超过 budget_mb，LRU 淘汰
+
+    共享内存在主进程中创建（创建 DataLoader 之前），worker 继承，所以每个 epoch 重新启动的 worker 也能读到之前的结果。
+    内存分成 slot_pixels 字节的 slot，每个 slot 放一张图片，超过 slot_pixels 的图片不 cache。
+    key 为 imgs 中的图片路径；所有 metadata 的修改和 slot 的复制都在 lock 中完成。
+
+    只保存第 0 个 channel：MURA_Dataset 的 transforms 在 ToTensor 之后只使用 x[0]，结果与读取原图相同
+    """
+
+    def __init__(self, imgs, budget_mb=1024, slot_pixels=512 * 512):
+        self.index = {img_path: i for i, img_path in enumerate(imgs)}
+        self.slot_pixels = slot_pixels
+        self.num_slots = max(1, int(budget_mb * 2 ** 20) // slot_pixels)
+
+        self._lock = mp.Lock()
+        self._data = mp.RawArray('B', self.num_slots * slot_pixels)
+        self._slot_key = mp.RawArray('q', [-1] * self.num_slots)       # slot 中图片的序号，-1 为空
+        self._slot_shape = mp.RawArray('i', self.num_slots * 2)       # (height, width)
+        self._slot_used = mp.RawArray('q', self.num_slots)            # 最近一次使用的时间（clock）
+        self._key_slot = mp.RawArray('i', [-1] * len(imgs))           # 图片所在的 slot，-1 为不在 cache 中
+        self._counters = mp.RawArray('q', 4)
+        self._clock = mp.RawValue('q', 0)
+        self._views = None
+
+    def __getstate__(self):
+        # spawn 启动的 worker：只传递共享内存本身，numpy 的 view 在 worker 中重新创建
+        state = self.__dict__.copy()
+        state['_views'] = None
+        return state
+
+    def _arrays(self):
+        if self._views is None or self._views[0] != os.getpid():
+            self._views = (os.getpid(),
+                           np.frombuffer(self._data, dtype=np.uint8).reshape(self.num_slots, self.slot_pixels),
+                           np.frombuffer(self._slot_shape, dtype=np.int32).reshape(self.num_slots, 2),
+                           np.frombuffer(self._slot_used, dtype=np.int64))
+        return self._views[1:]
+
+    def _tick(self, slot):
+        self._clock.value += 1
+        self._slot_used[slot] = self._clock.value
+
+    def get(self, img_path):
+        """
+        返回 cache 中的图片（mode 'L' 的 PIL Image），不在 cache 中时返回 None
+        """
+        key = self.index.get(img_path)
+        if key is None:
+            return None
+        data, shape, _ = self._arrays()
+        with self._lock:
+            slot = self._key_slot[key]
+            if slot < 0:
+                self._counters[MISSES] += 1
+                return None
+            self._counters[HITS] += 1
+            self._tick(slot)
+            h, w = shape[slot]
+            pixels = data[slot, :h * w].reshape(h, w).copy()
+        return Image.fromarray(pixels)
+
+    def put(self, img_path, img):
+        """
+        把解码之后的图片放入 cache，返回 cache 中保存的灰度图（第 0 个 channel）
+        """
+        if img.mode != 'L':
+            img = img.split()[0]
+        key = self.index.get(img_path)
+        if key is None:
+            return img
+        pixels = np.asarray(img, dtype=np.uint8)
+        h, w = pixels.shape
+        if h * w > self.slot_pixels:
+            with self._lock:
+                self._counters[TOO_LARGE] += 1
+            return img
+
+        data, shape, used = self._arrays()
+        with self._lock:
+            if self._key_slot[key] >= 0:
+                return img
+            slot = int(used.argmin())
+            old = self._slot_key[slot]
+            if old >= 0:
+                self._key_slot[old] = -1
+                self._counters[EVICTIONS] += 1
+            data[slot, :h * w] = pixels.ravel()
+            shape[slot] = (h, w)
+            self._slot_key[slot] = key
+            self._key_slot[key] = slot
+            self._tick(slot)
+        return img
+
+    def load(self, img_path):
+        """
+        先查 cache，不在 cache 中时读取图片并放入 cache
+        """
+        img = self.get(img_path)
+        if img is None:
+            img = Image.open(img_path)
+            img.load()
+            img = self.put(img_path, img)
+        return img
+
+    def stats(self):
+        hits, misses, evictions, too_large = self._counters[:]
+        cached = sum(1 for k in self._slot_key[:] if k >= 0)
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / max(1, hits + misses), 'evictions': evictions,
+                'too_large': too_large, 'cached_images': cached, 'slots': self.num_slots,
+                'budget_mb': self.num_slots * self.slot_pixels / 2 ** 20}
+
+    def reset_stats(self):
+        with self._lock:
+            for i in range(len(self._counters)):
+                self._counters[i] = 0
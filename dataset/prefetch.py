@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import io
+import math
+import time
+import collections
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from torch.utils.data import IterableDataset, get_worker_info
+
+# PrefetchMetrics 中每一项的位置
+IMAGES, BYTES, READ_S, WAIT_S, DEPTH_SUM, FIRST_START, LAST_END, MAX_DEPTH = range(8)
+
+
+def _read(img_path):
+    start = time.perf_counter()
+    with open(img_path, 'rb') as F:
+        data = F.read()
+    return data, time.perf_counter() - start
+
+
+class PrefetchMetrics(object):
+    """
+    所有 DataLoader worker 共用的统计量（共享内存），在主进程中创建
+    """
+
+    def __init__(self):
+        self._lock = mp.Lock()
+        self._values = mp.RawArray('d', 8)
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            for i in range(len(self._values)):
+                self._values[i] = 0.
+            self._values[FIRST_START] = float('inf')
+
+    def start(self):
+        with self._lock:
+            self._values[FIRST_START] = min(self._values[FIRST_START], time.time())
+
+    def add(self, num_bytes, read_s, wait_s, depth):
+        with self._lock:
+            v = self._values
+            v[IMAGES] += 1
+            v[BYTES] += num_bytes
+            v[READ_S] += read_s
+            v[WAIT_S] += wait_s
+            v[DEPTH_SUM] += depth
+            v[MAX_DEPTH] = max(v[MAX_DEPTH], depth)
+            v[LAST_END] = time.time()
+
+    def summary(self):
+        v = self._values[:]
+        images = max(1., v[IMAGES])
+        elapsed = max(1e-9, v[LAST_END] - v[FIRST_START]) if v[IMAGES] else 0.
+        return {
+            'images': int(v[IMAGES]),
+            'seconds': elapsed,
+            'images_per_s': v[IMAGES] / elapsed if elapsed else 0.,
+            'mb_per_s': v[BYTES] / 2 ** 20 / elapsed if elapsed else 0.,
+            'mean_read_ms': 1000 * v[READ_S] / images,          # 一次文件读取的平均延迟（在 I/O 线程中）
+            'mean_wait_ms': 1000 * v[WAIT_S] / images,          # decode 等待文件内容的平均时间，接近 0 说明 I/O 不是瓶颈
+            'mean_queue_depth': v[DEPTH_SUM] / images,          # 取出一张图片时仍在读取或已读完未 decode 的文件数
+            'max_queue_depth': int(v[MAX_DEPTH]),
+        }
+
+
+class PrefetchDataset(IterableDataset):
+    """
+    用线程池提前读取 dataset（MURA_Dataset）中图片文件的内容，decode 在 worker 中从内存完成
+
+    每个 DataLoader worker 负责 dataset.imgs 中连续的一段，在自己的线程池中按顺序提交读取，
+    同时进行的读取（包括已读完但未 decode 的）不超过 window 个，内存占用有上界。
+    输出顺序与 dataset.imgs 不同，只用于按图片路径收集结果的 test / predict，不用于训练
+    """
+
+    def __init__(self, dataset, window=32, threads=8):
+        self.dataset = dataset
+        self.window = max(1, window)
+        self.threads = threads
+        self.metrics = PrefetchMetrics()
+
+    @property
+    def imgs(self):
+        return self.dataset.imgs
+
+    @property
+    def transform_key(self):
+        return self.dataset.transform_key
+
+    def __iter__(self):
+        imgs = list(self.dataset.imgs)
+        worker = get_worker_info()
+        if worker is not None:
+            n = math.ceil(len(imgs) / worker.num_workers)
+            imgs = imgs[worker.id * n:(worker.id + 1) * n]
+
+        self.metrics.start()
+        with ThreadPoolExecutor(self.threads) as pool:
+            pending = collections.deque()
+            todo = iter(imgs)
+            for img_path in todo:
+                pending.append((img_path, pool.submit(_read, img_path)))
+                if len(pending) >= self.window:
+                    break
+
+            while pending:
+                img_path, future = pending.popleft()
+                start = time.perf_counter()
+                data, read_s = future.result()
+                wait_s = time.perf_counter() - start
+                for next_path in todo:
+                    pending.append((next_path, pool.submit(_read, next_path)))
+                    break
+                self.metrics.add(len(data), read_s, wait_s, len(pending))
+
+                yield self.dataset.get_sample(img_path, lambda: Image.open(io.BytesIO(data)))
+
+    def __len__(self):
+        return len(self.dataset)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing as mp
+from torchvision import transforms as T
+from torchvision.transforms import functional as TF
+
+
+class SharedSize(object):
+    """
+    transforms 使用的图片边长，保存在共享内存中（在创建 DataLoader 之前创建），
+    主进程修改之后 persistent_workers 的 worker 不需要重新启动就会使用新的值
+    """
+
+    def __init__(self, size=320):
+        self._value = mp.RawValue('i', size)
+
+    @property
+    def value(self):
+        return self._value.value
+
+    @value.setter
+    def value(self, size):
+        self._value.value = size
+
+
+class SharedResize(object):
+    """
+    与 T.Resize(size) 相同，size 在每次调用时从 SharedSize 读取
+    """
+
+    def __init__(self, size):
+        self.size = size
+
+    def __call__(self, img):
+        return TF.resize(img, self.size.value)
+
+
+class SharedCrop(object):
+    """
+    random 为 True 时与 T.RandomCrop(size) 相同，否则与 T.CenterCrop(size) 相同
+    """
+
+    def __init__(self, size, random=False):
+        self.size = size
+        self.random = random
+
+    def __call__(self, img):
+        size = self.size.value
+        if not self.random:
+            return TF.center_crop(img, size)
+        i, j, h, w = T.RandomCrop.get_params(img, (size, size))
+        return TF.crop(img, i, j, h, w)
+
+
+class ResolutionSchedule(object):
+    """
+    训练时每个 epoch 的 (图片边长, batch size)
+
+    schedule: [(开始的 epoch, 边长, batch size), ...]，按 epoch 排列，例如
+        [(0, 224, 16), (6, 288, 12), (12, 320, 8)]
+    前面的 epoch 用小图和大 batch，最后几个 epoch 用完整的 320
+    """
+
+    def __init__(self, schedule):
+        self.schedule = sorted((int(e), int(s), int(b)) for e, s, b in schedule)
+        if not self.schedule or self.schedule[0][0] != 0:
+            raise ValueError(f'resolution schedule must start at epoch 0: {schedule}')
+
+    def at(self, epoch):
+        size, batch_size = None, None
+        for start, s, b in self.schedule:
+            if start <= epoch:
+                size, batch_size = s, b
+        return size, batch_size
+
+    def sizes(self):
+        return sorted(set(s for _, s, _ in self.schedule))
+
+    def __repr__(self):
+        return f'ResolutionSchedule({self.schedule})'
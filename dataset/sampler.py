@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import torch as t
+from torch.utils.data import Sampler
+
+
+def class_weights(counts):
+    """
+    counts: dataset.label_counts() 的结果 {部位: [negative, positive]}
+    返回 CrossEntropyLoss 的 weight [negative / total, positive / total]，与原来写死的 A / (A + N), N / (A + N) 相同
+    """
+    negative = sum(c[0] for c in counts.values())
+    positive = sum(c[1] for c in counts.values())
+    total = max(1, negative + positive)
+    return [negative / total, positive / total]
+
+
+def part_weights(counts):
+    """
+    每个部位的样本权重，与该部位的图片数成反比，按图片数加权平均为 1：每个部位对 loss 的贡献相同
+    """
+    sizes = {part: sum(c) for part, c in counts.items() if sum(c)}
+    total = sum(sizes.values())
+    return {part: total / (len(sizes) * n) for part, n in sizes.items()}
+
+
+class LossAwareSampler(Sampler):
+    """
+    按每张图片最近的 loss 采样：loss 大（难的、最近分错的）的图片被采样得更多
+
+    losses 为每张图片 loss 的指数滑动平均，由训练时每个 batch 的 update 更新；还没有 loss 的图片使用当前最大的 loss。
+    每个 epoch 开始时按
+        p_i = (1 - uniform) * loss_i / sum(loss) + uniform / N
+    有放回地采样 N 次，uniform 保证每张图片都有被采样的机会，同时限制了 importance weight 的上界。
+    importance weight w_i = 1 / (N * p_i)，loss 乘以 w 之后的期望与均匀采样时相同
+    """
+
+    def __init__(self, imgs, smoothing=0.5, uniform=0.3):
+        self.index = {img_path: i for i, img_path in enumerate(imgs)}
+        self.num_samples = len(imgs)
+        self.smoothing = smoothing
+        self.uniform = uniform
+        self.losses = t.full((self.num_samples,), float('nan'))
+        self.weights = t.ones(self.num_samples)
+
+    def probabilities(self):
+        losses = self.losses.clone()
+        seen = ~t.isnan(losses)
+        losses[~seen] = losses[seen].max() if seen.any() else 1.
+        p = losses.clamp(min=1e-6)
+        p = p / p.sum()
+        return (1 - self.uniform) * p + self.uniform / self.num_samples
+
+    def __iter__(self):
+        p = self.probabilities()
+        self.weights = 1. / (self.num_samples * p)
+        return iter(t.multinomial(p, self.num_samples, replacement=True).tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+    def _indices(self, img_paths):
+        return t.tensor([self.index[img_path] for img_path in img_paths], dtype=t.long)
+
+    def importance_weights(self, img_paths):
+        return self.weights[self._indices(img_paths)]
+
+    def update(self, img_paths, losses):
+        """
+        losses: 这个 batch 中每张图片的 loss（没有乘 importance weight）
+        """
+        indices = self._indices(img_paths)
+        losses = losses.detach().float().cpu()
+        old = self.losses[indices]
+        self.losses[indices] = t.where(t.isnan(old), losses, self.smoothing * old + (1 - self.smoothing) * losses)
+
+    def stats(self):
+        """
+        最近一个 epoch 的采样分布：最大的 importance weight，以及 effective sample size 占 N 的比例
+        """
+        p = 1. / (self.num_samples * self.weights)
+        return {'max_weight': self.weights.max().item(), 'ess_fraction': (1. / (p ** 2).sum()).item() / self.num_samples,
+                'seen': int((~t.isnan(self.losses)).sum())}
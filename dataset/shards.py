@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import json
+import queue
+import random
+import tarfile
+import threading
+from PIL import Image
+from tqdm import tqdm
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+def _encode(img_path, resize):
+    """
+    图片文件的内容；resize 不为 None 时先把短边缩放到 resize（与 T.Resize 相同），重新编码成 png
+    """
+    if resize is None:
+        with open(img_path, 'rb') as F:
+            return F.read()
+    img = Image.open(img_path)
+    w, h = img.size
+    scale = resize / min(w, h)
+    if scale < 1:
+        img = img.resize((round(w * scale), round(h * scale)), Image.BILINEAR)
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def pack_shards(dataset, output_dir, shard_size_mb=256, resize=None, seed=0):
+    """
+    把 dataset（MURA_Dataset）中的所有图片打包成若干个 tar 文件，每个约 shard_size_mb：
+
+        output_dir/shard-00000.tar   成员的名字为图片相对 dataset.root 的路径
+        output_dir/index.json        root, resize, 每个 shard 的文件名、图片和大小，最后写入，存在即表示打包完成
+
+    csv 中的图片是按部位排列的，打包前先打乱，每个 shard 中包含各个部位的图片
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    imgs = list(dataset.imgs)
+    random.Random(seed).shuffle(imgs)
+
+    shards, tar = [], None
+    for img_path in tqdm(imgs):
+        if tar is None or shards[-1]['bytes'] >= shard_size_mb * 2 ** 20:
+            if tar is not None:
+                tar.close()
+            name = f'shard-{len(shards):05d}.tar'
+            tar = tarfile.open(os.path.join(output_dir, name), 'w')
+            shards.append({'file': name, 'images': [], 'bytes': 0})
+
+        data = _encode(img_path, resize)
+        info = tarfile.TarInfo(img_path[len(dataset.root):])
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+        shards[-1]['images'].append(info.name)
+        shards[-1]['bytes'] += len(data)
+    if tar is not None:
+        tar.close()
+
+    with open(os.path.join(output_dir, 'index.json'), 'w') as F:
+        json.dump({'root': dataset.root, 'resize': resize, 'shards': shards}, F)
+    return shards
+
+
+def _read_ahead(paths, q):
+    """
+    后台线程：按顺序整个读入每个 shard，最多提前 q.maxsize 个
+    """
+    for path in paths:
+        with open(path, 'rb') as F:
+            q.put(F.read())
+    q.put(None)
+
+
+class ShardDataset(IterableDataset):
+    """
+    读取 pack_shards 的结果，返回与 MURA_Dataset 相同的 (data, label, img_path, body_part)
+
+    dataset 为对应的 MURA_Dataset，提供 transforms、label、部位，以及要读取的图片（不在 dataset.imgs 中的跳过）。
+    每个 shard 用一次顺序读取整个读入（后台线程提前读 read_ahead 个），不再是每张图片一次随机的小文件读取。
+    shuffle 时每个 epoch 打乱 shard 的顺序，再用 buffer_size 张图片的 buffer 随机输出。
+    DataLoader 有多个 worker 时每个 worker 读取不同的 shard，所以 shard 数应不少于 num_workers
+    """
+
+    def __init__(self, shard_dir, dataset, shuffle=True, buffer_size=1000, read_ahead=2):
+        with open(os.path.join(shard_dir, 'index.json')) as F:
+            index = json.load(F)
+
+        self.dataset = dataset
+        self.root = dataset.root
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.read_ahead = read_ahead
+        self.profiler = None
+        self.transform_key = dataset.transform_key
+        if self.transform_key is not None and index['resize'] is not None:
+            self.transform_key += f"_r{index['resize']}"
+
+        wanted = set(img_path[len(self.root):] for img_path in dataset.imgs)
+        self.shards = []
+        for shard in index['shards']:
+            images = [name for name in shard['images'] if name in wanted]
+            if images:
+                self.shards.append((os.path.join(shard_dir, shard['file']), images))
+        self.imgs = [self.root + name for _, images in self.shards for name in images]
+        if len(self.imgs) < len(wanted):
+            print(f'{shard_dir}: {len(wanted) - len(self.imgs)} images are not in the shards')
+
+    def _load(self, name, data):
+        img_path = self.root + name
+        if self.profiler is None:
+            img = self.dataset.transforms(Image.open(io.BytesIO(data)))
+        else:
+            with self.profiler.stage('decode'):
+                img = Image.open(io.BytesIO(data))
+                img.load()
+            with self.profiler.stage('augment'):
+                img = self.dataset.transforms(img)
+        label = 0 if self.dataset.test else self.dataset.get_label(img_path)
+        return img, label, img_path, self.dataset.get_body_part(img_path)
+
+    def _samples(self, shards):
+        wanted = {path: set(images) for path, images in shards}
+        q = queue.Queue(maxsize=max(1, self.read_ahead))
+        reader = threading.Thread(target=_read_ahead, args=([path for path, _ in shards], q), daemon=True)
+        reader.start()
+        for path, _ in shards:
+            data = q.get()
+            with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+                for member in tar:
+                    if member.name in wanted[path]:
+                        yield self._load(member.name, tar.extractfile(member).read())
+        q.get()
+        reader.join()
+
+    def __iter__(self):
+        shards = list(self.shards)
+        worker = get_worker_info()
+        if worker is not None:
+            shards = shards[worker.id::worker.num_workers]
+        if self.shuffle:
+            random.shuffle(shards)
+
+        if not self.shuffle:
+            yield from self._samples(shards)
+            return
+
+        buffer = []
+        for sample in self._samples(shards):
+            buffer.append(sample)
+            if len(buffer) >= self.buffer_size:
+                i = random.randrange(len(buffer))
+                buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                yield buffer.pop()
+        random.shuffle(buffer)
+        yield from buffer
+
+    def get_label(self, img_path):
+        return self.dataset.get_label(img_path)
+
+    def get_body_part(self, img_path):
+        return self.dataset.get_body_part(img_path)
+
+    def label_counts(self):
+        return self.dataset.label_counts()
+
+    def __len__(self):
+        return len(self.imgs)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import json
+import hashlib
+import multiprocessing as mp
+import numpy as np
+from tqdm import tqdm
+from torchvision import transforms as T
+
+
+class RunningStats(object):
+    """
+    Welford 的在线 mean / variance，以及 [0, 1] 上的像素直方图；两个 RunningStats 可以 merge（Chan et al.），
+    所以每个进程各自累加一部分图片，最后合并，结果与把所有像素放在一起计算相同
+    """
+
+    def __init__(self, bins=256):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.images = 0
+        self.histogram = np.zeros(bins, dtype=np.int64)
+
+    def update(self, x):
+        """
+        x: 一张图片的像素，numpy array，取值范围 [0, 1]
+        """
+        x = np.asarray(x, dtype=np.float64).ravel()
+        other = RunningStats(len(self.histogram))
+        other.count = x.size
+        other.mean = x.mean()
+        other.m2 = ((x - other.mean) ** 2).sum()
+        other.images = 1
+        other.histogram = np.histogram(x, bins=len(self.histogram), range=(0., 1.))[0]
+        return self.merge(other)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.images += other.images
+        self.histogram += other.histogram
+        return self
+
+    @property
+    def std(self):
+        # 与 t.Tensor.std() 相同，使用无偏估计
+        return (self.m2 / (self.count - 1)) ** 0.5 if self.count > 1 else 0.
+
+    def to_dict(self):
+        return {'mean': float(self.mean), 'std': float(self.std), 'pixels': int(self.count), 'images': self.images,
+                'histogram': self.histogram.tolist()}
+
+
+# 每个进程中的 MURA_Dataset，由 _init_worker 创建
+_dataset = None
+
+
+def _init_worker(root, csv_path, size):
+    from .dataset import MURA_Dataset
+    global _dataset
+    # 与 val / test 相同的 resize 和 crop，不做随机的 augmentation，也不 normalize
+    transforms = T.Compose([T.Resize(size), T.CenterCrop(size), T.ToTensor()])
+    _dataset = MURA_Dataset(root, csv_path, transforms=transforms, train=False, test=False)
+
+
+def _accumulate(args):
+    """
+    在一个进程中统计 [start, end) 的图片，返回 {部位: RunningStats}
+    """
+    start, end, bins = args
+    stats = {}
+    for index in range(start, end):
+        data, _, _, body_part = _dataset[index]
+        stats.setdefault(body_part, RunningStats(bins)).update(data[0].numpy())
+    return stats
+
+
+def compute_statistics(root, csv_path, processes=4, chunk_size=64, bins=256, size=320):
+    """
+    用 processes 个进程流式地统计 csv_path 中所有图片的 mean / std / 直方图，内存占用与数据集大小无关
+
+    返回 {'all': {...}, 'XR_ELBOW': {...}, ...}，每一项为 RunningStats.to_dict()
+    """
+    from .dataset import MURA_Dataset
+    n = len(MURA_Dataset(root, csv_path, transforms=T.ToTensor()))
+    chunks = [(start, min(start + chunk_size, n), bins) for start in range(0, n, chunk_size)]
+
+    stats = {}
+    with mp.Pool(processes, initializer=_init_worker, initargs=(root, csv_path, size)) as pool:
+        for chunk_stats in tqdm(pool.imap_unordered(_accumulate, chunks), total=len(chunks)):
+            for body_part, s in chunk_stats.items():
+                stats.setdefault(body_part, RunningStats(bins)).merge(s)
+
+    total = RunningStats(bins)
+    for s in stats.values():
+        total.merge(s)
+
+    result = {'all': total.to_dict()}
+    for body_part in sorted(stats):
+        result[body_part] = stats[body_part].to_dict()
+    return result
+
+
+def save_statistics(stats, path):
+    with open(path, 'w') as F:
+        json.dump(stats, F, indent=1)
+
+
+def load_statistics(path):
+    with open(path) as F:
+        return json.load(F)
+
+
+def channel_stats(stats, part='all'):
+    """
+    T.Normalize 使用的 (mean, std)，灰度图复制成了 3 channel，所以三个 channel 相同
+    """
+    s = stats[part]
+    return [s['mean']] * 3, [s['std']] * 3
+
+
+def statistics_key(path):
+    """
+    stats 文件内容的 hash，加入 MURA_Dataset.transform_key，不同的 normalize 不共用 prediction cache
+    """
+    with open(path, 'rb') as F:
+        return hashlib.sha1(F.read()).hexdigest()[:8]
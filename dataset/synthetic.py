@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+from PIL import Image
+
+from .dataset import BODY_PARTS
+
+
+def make_synthetic_mura(root, studies_per_part=4, images_per_study=3, min_size=132, max_size=512, seed=0):
+    """
+    在 root 下生成一个与 MURA-v1.1 结构相同的合成数据集，用于 benchmark，不需要真实数据。
+
+    root/MURA-v1.1/{train,valid}/XR_xxx/patientNNNNN/studyK_{positive,negative}/imageM.png
+    root/MURA-v1.1/{train,valid}_image_paths.csv
+
+    返回 (train_image_paths, valid_image_paths) 两个 csv 的路径，root 以 '/' 结尾时可以直接作为 opt.data_root。
+    """
+    rng = np.random.RandomState(seed)
+    csv_paths = []
+    patient = 0
+
+    for split in ['train', 'valid']:
+        rows = []
+        for part in BODY_PARTS:
+            for s in range(studies_per_part):
+                patient += 1
+                label = 'positive' if s % 2 else 'negative'
+                study_dir = os.path.join('MURA-v1.1', split, part, f'patient{patient:05d}', f'study1_{label}')
+                os.makedirs(os.path.join(root, study_dir), exist_ok=True)
+
+                for i in range(images_per_study):
+                    # 尺寸范围与真实数据一致：宽 89~512，高 132~512，随机的长宽比
+                    h = rng.randint(min_size, max_size + 1)
+                    w = rng.randint(max(89, h // 2), max_size + 1)
+                    # 低频的灰度图 + 噪声，PNG 解码代价与真实 X 光片接近
+                    base = rng.randint(0, 256, size=(h // 16 + 1, w // 16 + 1)).astype(np.uint8)
+                    img = Image.fromarray(base).resize((w, h), Image.BILINEAR)
+                    noise = rng.randint(0, 24, size=(h, w)).astype(np.uint8)
+                    img = Image.fromarray(np.asarray(img, dtype=np.uint8) // 2 + noise)
+
+                    rel_path = os.path.join(study_dir, f'image{i + 1}.png')
+                    img.save(os.path.join(root, rel_path))
+                    rows.append(rel_path)
+
+        csv_path = os.path.join(root, 'MURA-v1.1', f'{split}_image_paths.csv')
+        with open(csv_path, 'w') as F:
+            F.write('\n'.join(rows) + '\n')
+        csv_paths.append(csv_path)
+
+    return tuple(csv_paths)
@@ -3,10 +3,14 @@
 import os
 import sys
 import csv
+import copy
+import json
+import queue
+import multiprocessing as mp
 import torch as t
 import numpy as np
 from torch.autograd import Variable
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler
 from torchnet import meter
 from tqdm import tqdm
 from sklearn.metrics import cohen_kappa_score#, confusion_matrix
@@ -14,14 +18,31 @@ import time
 
 import models
 from config import opt
-from utils import Visualizer, FocalLoss
-from dataset import MURA_Dataset
+from utils import Visualizer, FocalLoss, Profiler, PredictionCache, file_hash, softmax, ensemble_search, pruning, \
+    LRSchedule, EarlyStopping, CheckpointKeeper, TestTimeAugmentation
+from dataset import MURA_Dataset, BODY_PARTS, FeatureStore, FeatureDataset, compute_statistics, save_statistics, \
+    ShardDataset, pack_shards, SharedImageCache, PrefetchDataset, BucketedDataset, BucketBatchSampler, pixel_report, \
+    ResolutionSchedule, LossAwareSampler, class_weights, part_weights, bucket_transform_key
 
 
 def train(**kwargs):
     opt.parse(kwargs)
+
+    # opt.part 不为 'all' 时只使用一个部位的图片
+    train_data = MURA_Dataset(opt.data_root, opt.train_image_paths, part=opt.part, train=True, test=False,
+                              stats_file=opt.stats_file)
+    val_data = MURA_Dataset(opt.data_root, opt.test_image_paths, part=opt.part, train=False, test=False,
+                            stats_file=opt.stats_file)
+    return fit(train_data, val_data)
+
+
+def fit(train_data, val_data, image_cache=None):
+    """
+    用 opt 的设置在 train_data 上训练 opt.model，每个 epoch 在 val_data 上验证，返回每个 epoch 的记录
+    image_cache: 已经创建好的 SharedImageCache（例如 train_specialists 中所有进程共用的），None 时按 opt.image_cache_mb 创建
+    """
     if opt.use_visdom:
-        vis = Visualizer(opt.env)
+        vis = Visualizer(opt.env, log_file=opt.vis_log_file, flush_interval=opt.vis_flush_interval)
 
     # step 1: configure model
     # model = densenet169(pretrained=True)
@@ -33,89 +54,220 @@ def train(**kwargs):
     if opt.use_gpu:
         print('CUDA MODEL!')
         model.cuda()
+    if opt.checkpoint_stages:
+        model.enable_checkpointing(opt.checkpoint_stages)
+    model = prepare_model(model)
+    check_aspect_buckets(model)
 
     model.train()
 
     # step 2: data
-    train_data = MURA_Dataset(opt.data_root, opt.train_image_paths, train=True, test=False)
-    val_data = MURA_Dataset(opt.data_root, opt.test_image_paths, train=False, test=False)
+    if image_cache is None and opt.image_cache_mb:
+        # 在创建 DataLoader 之前创建，每个 epoch 重新启动的 worker 继承同一块共享内存
+        image_cache = SharedImageCache(train_data.imgs + val_data.imgs, opt.image_cache_mb)
+    if image_cache is not None:
+        train_data.image_cache = val_data.image_cache = image_cache
+
+    if opt.shard_dir:
+        # 从 pack_dataset 打包的 shard 顺序读取
+        train_data = ShardDataset(os.path.join(opt.shard_dir, 'train'), train_data, shuffle=True)
+        val_data = ShardDataset(os.path.join(opt.shard_dir, 'valid'), val_data, shuffle=False)
+
+    if opt.feature_cache_dir:
+        # trunk 不再训练，每个 epoch 直接读取 cache 的 trunk 特征
+        train_store, val_store = feature_stores(model)
+        model.train()
+        model.freeze_trunk()
+        model.use_cached_trunk = True
+        train_data, val_data = FeatureDataset(train_store), FeatureDataset(val_store)
 
     print('Training images:', len(train_data), 'Validation images:', len(val_data))
 
-    train_dataloader = DataLoader(train_data, opt.batch_size, shuffle=True, num_workers=opt.num_workers)
-    val_dataloader = DataLoader(val_data, batch_size=opt.batch_size, shuffle=False, num_workers=opt.num_workers)
+    sampler = None
+    if opt.importance_sampling:
+        if opt.aspect_buckets or isinstance(train_data, ShardDataset):
+            raise ValueError('importance_sampling cannot be combined with aspect_buckets or shard_dir')
+        sampler = LossAwareSampler(train_data.imgs, opt.importance_smoothing, opt.importance_uniform)
+
+    schedule = ResolutionSchedule(opt.resolution_schedule) if opt.resolution_schedule else None
+    if schedule is not None:
+        if opt.aspect_buckets or not isinstance(train_data, MURA_Dataset):
+            raise ValueError('resolution_schedule cannot be combined with aspect_buckets, shard_dir or feature_cache_dir')
+        if model.fixed_input_size and schedule.sizes() != [320]:
+            raise ValueError(f'{model.model_name} only takes 320 x 320 inputs and cannot use resolution_schedule')
+        # 每个 epoch 修改 train_sampler.batch_size 和 train_data 的边长，worker 不重新启动
+        train_sampler = BatchSampler(sampler or RandomSampler(train_data), opt.batch_size, drop_last=False)
+        train_dataloader = DataLoader(train_data, batch_sampler=train_sampler, num_workers=opt.num_workers,
+                                      persistent_workers=opt.num_workers > 0)
+        val_dataloader = DataLoader(val_data, batch_size=opt.batch_size, shuffle=False, num_workers=opt.num_workers)
+    elif opt.aspect_buckets:
+        train_dataloader = bucket_dataloader(train_data, shuffle=True)
+        val_dataloader = bucket_dataloader(val_data, shuffle=False)
+    else:
+        # ShardDataset 自己打乱顺序，LossAwareSampler 自己采样，DataLoader 不能 shuffle
+        shuffle = sampler is None and not isinstance(train_data, ShardDataset)
+        train_dataloader = DataLoader(train_data, opt.batch_size, shuffle=shuffle, sampler=sampler,
+                                      num_workers=opt.num_workers)
+        val_dataloader = DataLoader(val_data, batch_size=opt.batch_size, shuffle=False, num_workers=opt.num_workers)
 
     # step 3: criterion and optimizer
-    A = 21935
-    N = 14873
-    weight = t.Tensor([A / (A + N), N / (A + N)])
+    # 根据训练集的图片统计 class 和部位的权重
+    counts = train_data.label_counts()
+    weight = t.Tensor(class_weights(counts))
     if opt.use_gpu:
         weight = weight.cuda()
-
-    criterion = t.nn.CrossEntropyLoss(weight=weight)
-    # criterion = FocalLoss(alpha=weight, class_num=2)
+    part_weight = part_weights(counts) if opt.part_weights else None
+    # importance sampling 和部位权重需要每张图片的 loss
+    per_sample = sampler is not None or part_weight is not None
+
+    if opt.loss == 'FocalLoss':
+        if opt.focal_alpha_per_part:
+            # 每个部位按自己的正负样本比例计算 alpha，形式与上面的 weight 相同
+            counts = train_data.label_counts()
+            alpha = t.Tensor([[c[0] / sum(c), c[1] / sum(c)] for c in [counts.get(bp, [1, 1]) for bp in BODY_PARTS]])
+            criterion = FocalLoss(class_num=2, alpha=alpha, gamma=opt.focal_gamma, parts=BODY_PARTS, reduce=not per_sample)
+        else:
+            criterion = FocalLoss(class_num=2, alpha=weight, gamma=opt.focal_gamma, reduce=not per_sample)
+        if opt.use_gpu:
+            criterion.cuda()
+    else:
+        criterion = t.nn.CrossEntropyLoss(weight=weight, reduction='none' if per_sample else 'mean')
     lr = opt.lr
-    optimizer = t.optim.Adam(model.parameters(), lr=lr, weight_decay=opt.weight_decay)
+    optimizer = t.optim.Adam([p for p in model.parameters() if p.requires_grad], lr=lr, weight_decay=opt.weight_decay)
+    lr_schedule = LRSchedule(optimizer, opt.lr_policy, opt.lr, opt.max_epoch, opt.warmup_epochs, opt.lr_decay,
+                             opt.lr_patience, opt.min_lr)
+    stopper = EarlyStopping(opt.early_stop_patience, opt.early_stop_min_delta)
 
     # step 4: meters
     loss_meter = meter.AverageValueMeter()
     confusion_matrix = meter.ConfusionMeter(2)
-    previous_loss = 1e10
 
     # step 5: train
 
-    if not os.path.exists(os.path.join('checkpoints', model.model_name)):
-        os.mkdir(os.path.join('checkpoints', model.model_name))
     prefix = time.strftime('%m%d')
-    if not os.path.exists(os.path.join('checkpoints', model.model_name, prefix)):
-        os.mkdir(os.path.join('checkpoints', model.model_name, prefix))
-
-    s = t.nn.Softmax()
+    checkpoint_dir = os.path.join('checkpoints', model.model_name, prefix)
+    if opt.part != 'all':
+        checkpoint_dir = os.path.join(checkpoint_dir, opt.part)
+    if not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    keeper = CheckpointKeeper(checkpoint_dir, opt.keep_checkpoints)
+
+    prof = Profiler(opt.profile, opt.profile_trace_steps, opt.profile_dir, opt.use_gpu, name='train')
+    if opt.num_workers == 0:
+        # 只有在主进程中加载数据时才能把 data 拆分成 decode 和 augment
+        train_data.profiler = prof
+
+    s = t.nn.Softmax(dim=1)
+    history, target_reached, image_forwards = [], None, 0
+    start_time = time.perf_counter()
     for epoch in range(opt.max_epoch):
 
         loss_meter.reset()
         confusion_matrix.reset()
 
-        for ii, (data, label, _, body_part) in tqdm(enumerate(train_dataloader)):
+        if schedule is not None:
+            size, train_sampler.batch_size = schedule.at(epoch)
+            train_data.set_size(size)
+            print(f'epoch {epoch}: image size {size}, batch size {train_sampler.batch_size}')
 
-            # train model
-            input = Variable(data)
-            target = Variable(label)
-            # body_part = Variable(body_part)
-            if opt.use_gpu:
-                input = input.cuda()
-                target = target.cuda()
-                # body_part = body_part.cuda()
+        prof.start('data')
+        for ii, (data, label, path, body_part) in tqdm(enumerate(train_dataloader)):
+            prof.stop('data')
 
+            # train model
+            with prof.stage('transfer'):
+                input = Variable(data)
+                target = Variable(label)
+                # body_part = Variable(body_part)
+                if opt.use_gpu:
+                    input = input.cuda()
+                    target = target.cuda()
+                    # body_part = body_part.cuda()
+                input = prepare_input(input)
+
+            lr_schedule.step_batch(epoch, ii, len(train_dataloader))
             optimizer.zero_grad()
-            if opt.model.startswith('MultiBranch'):
-                score = model(input, body_part)
-            else:
-                score = model(input)
-            loss = criterion(score, target)
-            loss.backward()
-            optimizer.step()
+            with prof.stage('forward'):
+                if opt.model.startswith('MultiBranch'):
+                    score = model(input, body_part)
+                else:
+                    score = model(input)
+                if isinstance(criterion, FocalLoss):
+                    loss = criterion(score, target, body_part)
+                else:
+                    loss = criterion(score, target)
+                if per_sample:
+                    sample_loss = loss
+                    w = t.ones(len(path))
+                    if sampler is not None:
+                        w = w * sampler.importance_weights(path)
+                    if part_weight is not None:
+                        w = w * t.Tensor([part_weight.get(bp, 1.) for bp in body_part])
+                    if isinstance(criterion, FocalLoss):
+                        # 与 FocalLoss 的 reduce 相同，按图片数平均
+                        normalizer = float(len(path))
+                    else:
+                        # 与 CrossEntropyLoss(weight, reduction='mean') 相同，除以 batch 中 class weight 的和，
+                        # w 全为 1 时 loss 与不使用 importance sampling / part_weights 时相同
+                        normalizer = weight[target].sum()
+                    loss = (sample_loss * w.to(sample_loss.device)).sum() / normalizer
+            with prof.stage('backward'):
+                loss.backward()
+            with prof.stage('optimizer'):
+                optimizer.step()
 
             # meters update and visualize
-            loss_meter.add(loss.data[0])
-            confusion_matrix.add(s(Variable(score.data)).data, target.data)
+            with prof.stage('metrics'):
+                if sampler is not None:
+                    sampler.update(path, sample_loss)
+                loss_meter.add(loss.item())
+                confusion_matrix.add(s(Variable(score.data)).data, target.data)
+            prof.count('images', input.size(0))
+            prof.step()
+            image_forwards += input.size(0)
 
             if ii % opt.print_freq == opt.print_freq - 1:
                 if opt.use_visdom:
                     vis.plot('loss', loss_meter.value()[0])
                 # print('loss', loss_meter.value()[0])
+                if prof.enabled:
+                    print(prof.summary())
 
                 # debug
                 if os.path.exists(opt.debug_file):
                     import ipdb
                     ipdb.set_trace()
 
-        ck_name = f'epoch_{epoch}_{str(opt)}.pth'
-        model.save(os.path.join('checkpoints', model.model_name, prefix, ck_name))
-        # model.save()
+            prof.start('data')
+        prof.stop('data')
 
         # validate and visualize
-        val_cm, val_accuracy, val_loss = val(model, val_dataloader)
+        with prof.stage('val'):
+            val_results = []
+            val_cm, val_accuracy, val_loss = val(model, val_dataloader, val_results)
+            val_kappa = mean_study_kappa(val_results)
+
+        with prof.stage('checkpoint'):
+            ck_name = f'epoch_{epoch}_{str(opt)}.pth'
+            # 只保留最近 opt.keep_checkpoints 个和 val_kappa 最好的 checkpoint
+            checkpoint = keeper.save(model, ck_name, epoch, val_kappa)
+            # model.save()
+
+        # 从开始训练到这个 epoch 验证结束的时间
+        elapsed = time.perf_counter() - start_time
+        lr = lr_schedule.lr
+        history.append({'epoch': epoch, 'seconds': elapsed, 'image_forwards': image_forwards, 'lr': lr,
+                        'checkpoint': checkpoint, 'val_kappa': val_kappa, 'val_accuracy': float(val_accuracy),
+                        'size': train_data.size.value if schedule is not None else 320,
+                        'batch_size': train_sampler.batch_size if schedule is not None else opt.batch_size})
+        print(f'val study kappa: {val_kappa:.4f}, {elapsed:.1f}s')
+        if sampler is not None:
+            print('importance sampling:', sampler.stats())
+        if opt.branch_timing:
+            print('branch timing:', json.dumps(model.branch_stats(reset=True)))
+        if opt.target_kappa is not None and target_reached is None and val_kappa >= opt.target_kappa:
+            target_reached = elapsed
+            print(f'target kappa {opt.target_kappa} reached at epoch {epoch}, {elapsed:.1f}s, {image_forwards} image forwards')
 
         cm = confusion_matrix.value()
 
@@ -127,6 +279,8 @@ def train(**kwargs):
                                          train_acc=str(100. * (cm[0][0] + cm[1][1]) / (cm.sum())),
                                          val_acc=str(100. * (val_cm.value()[0][0] + val_cm.value()[1][1]) / (val_cm.value().sum()))))
         print('val_accuracy: ', val_accuracy)
+        if image_cache is not None:
+            print('image cache:', image_cache.stats())
         print("epoch:{epoch},lr:{lr},loss:{loss},train_cm:{train_cm},val_cm:{val_cm},train_acc:{train_acc}, "
               "val_acc:{val_acc}".format(epoch=epoch, loss=loss_meter.value()[0], val_cm=str(val_cm.value()),
                                          train_cm=str(confusion_matrix.value()), lr=lr,
@@ -134,45 +288,220 @@ def train(**kwargs):
                                          val_acc=100. * (val_cm.value()[0][0] + val_cm.value()[1][1]) / (val_cm.value().sum())))
 
         # update learning rate
-        if loss_meter.value()[0] > previous_loss:
-        # if val_loss > previous_loss:
-            lr = lr * opt.lr_decay
-            # 第二种降低学习率的方法:不会有moment等信息的丢失
-            for param_group in optimizer.param_groups:
-                param_group['lr'] = lr
+        lr_schedule.step_epoch(loss_meter.value()[0], val_kappa)
+
+        if stopper.step(epoch, val_kappa):
+            print(f'early stopping at epoch {epoch}: val study kappa has not improved since epoch {stopper.best_epoch}')
+            break
+
+    print('best checkpoint:', keeper.best)
+    if opt.restore_best and keeper.best is not None:
+        model.load(keeper.best['path'])
+
+    prof.close()
+    if opt.use_visdom:
+        vis.close()
+    if opt.target_kappa is not None:
+        print('time to target kappa:', target_reached)
+    return history
+
 
-        # previous_loss = val_loss
-        previous_loss = loss_meter.value()[0]
+# train_specialists 在创建子进程之前设置，子进程 fork 之后继承：完整的训练集 / 验证集（manifest）和共用的图片 cache
+_specialist_state = {}
 
 
-def val(model, dataloader):
+def _part_subset(data, part):
+    """
+    data 中一个部位的图片，不重新读取 csv
+    """
+    subset = copy.copy(data)
+    subset.imgs = [img_path for img_path in data.imgs if data.get_body_part(img_path) == part]
+    return subset
+
+
+def _specialist_worker(parts, threads, results):
+    """
+    子进程：依次训练 parts 中每个部位的模型，结果放入 results
+    """
+    t.set_num_threads(threads)
+    env = opt.env
+    for part in parts:
+        opt.part = part
+        opt.env = f'{env}_{part}'
+        try:
+            train_data = _part_subset(_specialist_state['train'], part)
+            val_data = _part_subset(_specialist_state['val'], part)
+            history = fit(train_data, val_data, image_cache=_specialist_state['image_cache'])
+            best = max(history, key=lambda h: h['val_kappa'])
+            results.put((part, {'images': len(train_data), 'epochs': len(history),
+                                'seconds': history[-1]['seconds'], 'best_epoch': best['epoch'],
+                                'best_kappa': best['val_kappa'], 'checkpoint': best['checkpoint'], 'history': history}))
+        except Exception as e:
+            results.put((part, {'error': repr(e)}))
+
+
+def train_specialists(parts=None, processes=None, threads=None, output='specialists.json', **kwargs):
+    """
+    每个部位单独训练一个 opt.model，多个部位在 processes 个进程中并行（进程数少于部位数时一个进程依次训练几个部位）：
+        python main.py train_specialists --model=DenseNet169 --processes=4 --threads=4 --image_cache_mb=8192
+
+    csv 只在主进程中读取一次，所有进程共用一个 SharedImageCache（opt.image_cache_mb 为 0 时不使用）；
+    threads 为每个进程的 torch 线程数，默认平分 CPU。
+    结束后把每个部位最好的 checkpoint 合并成一个 MultiBranchSpecialists 的 checkpoint，
+    可以用 --model=MultiBranchSpecialists --load_model_path=... 进行 test
+    """
+    opt.parse(kwargs)
+    if opt.model.startswith('MultiBranch'):
+        raise ValueError('specialists are single body part models, use e.g. --model=DenseNet169')
+    parts = [p for p in BODY_PARTS if p in (parts or BODY_PARTS)]
+    processes = min(len(parts), processes or len(parts))
+    threads = threads or max(1, (os.cpu_count() or 1) // processes)
+
+    train_data = MURA_Dataset(opt.data_root, opt.train_image_paths, train=True, test=False, stats_file=opt.stats_file)
+    val_data = MURA_Dataset(opt.data_root, opt.test_image_paths, train=False, test=False, stats_file=opt.stats_file)
+    image_cache = SharedImageCache(train_data.imgs + val_data.imgs, opt.image_cache_mb) if opt.image_cache_mb else None
+    _specialist_state.update(train=train_data, val=val_data, image_cache=image_cache)
+
+    # 不能使用 mp.Pool：Pool 的进程是 daemon，不能再启动 DataLoader 的 worker
+    ctx = mp.get_context('fork')
+    results = ctx.Queue()
+    workers = [ctx.Process(target=_specialist_worker, args=(parts[i::processes], threads, results))
+               for i in range(processes)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    assignment = {part: w for i, w in enumerate(workers) for part in parts[i::processes]}
+    report = {}
+    while len(report) < len(parts):
+        try:
+            part, r = results.get(timeout=10)
+            report[part] = r
+        except queue.Empty:
+            # 被 OOM killer 结束或者 segfault 的进程不会放入结果，所有进程都已经退出时不再等待
+            if all(w.exitcode is not None for w in workers):
+                break
+    for part in parts:
+        if part not in report:
+            report[part] = {'error': f'worker exited with code {assignment[part].exitcode} before reporting'}
+    for w in workers:
+        w.join()
+
+    trained = {part: r['checkpoint'] for part, r in report.items() if 'checkpoint' in r}
+    # 只有所有部位都训练成功时才合并，缺少部位的 router 不能用于完整的验证集和测试集
+    missing = [part for part in parts if part not in trained]
+    summary = {
+        'model': opt.model, 'processes': processes, 'threads': threads, 'seconds': time.perf_counter() - start,
+        'mean_kappa': float(np.mean([report[p]['best_kappa'] for p in trained])) if trained else None,
+        'image_cache': image_cache.stats() if image_cache is not None else None,
+        'parts': {part: report[part] for part in parts},
+        'missing_parts': missing,
+        'router_checkpoint': models.MultiBranchSpecialists.combine(opt.model, trained) if not missing else None,
+    }
+    with open(output, 'w') as F:
+        json.dump(summary, F, indent=2)
+    for part in parts:
+        r = report[part]
+        print(part, r.get('error') or f"best kappa {r['best_kappa']:.4f} at epoch {r['best_epoch']}, {r['seconds']:.0f}s")
+    if missing:
+        print('router checkpoint not written, parts without a trained model:', ', '.join(missing))
+    else:
+        print('router checkpoint:', summary['router_checkpoint'])
+    print('written to', output)
+
+
+def feature_stores(model):
+    """
+    返回 train 和 valid 的 trunk 特征（FeatureStore），不存在时用 model.forward_trunk 计算一次
+    训练集使用 center crop，不做数据增强
+    """
+    if not model.trunk_names:
+        raise ValueError(f'{model.model_name} has no shared trunk, feature_cache_dir needs a MultiBranch model')
+
+    # 与 PredictionCache 一样按 checkpoint 内容的 hash 和 transform_key（包括 stats_file 的 normalize）区分，
+    # opt.part 不为 'all' 时只包含该部位的图片
+    if not os.path.exists(opt.feature_cache_dir):
+        os.makedirs(opt.feature_cache_dir)
+    tag = file_hash(opt.load_model_path, opt.feature_cache_dir)[:16] if opt.load_model_path else 'imagenet'
+    stores = []
+    for split, csv_path in [('train', opt.train_image_paths), ('valid', opt.test_image_paths)]:
+        data = MURA_Dataset(opt.data_root, csv_path, part=opt.part, train=False, test=False, stats_file=opt.stats_file)
+        path = os.path.join(opt.feature_cache_dir, f'{model.model_name}_{tag}_{data.transform_key}', opt.part, split)
+        if not FeatureStore.exists(path):
+            print('caching trunk features to', path)
+            dataloader = DataLoader(data, opt.batch_size, shuffle=False, num_workers=opt.num_workers)
+            model.eval()
+            FeatureStore.build(path, model.forward_trunk, dataloader, opt.use_gpu)
+        stores.append(FeatureStore(path))
+    return stores
+
+
+def cache_features(**kwargs):
+    """
+    预先计算 MultiBranch 模型 trunk 的特征： python main.py cache_features --feature_cache_dir=cache/features
+    """
+    opt.parse(kwargs)
+
+    model = getattr(models, opt.model)()
+    if opt.load_model_path:
+        model.load(opt.load_model_path)
+    if opt.use_gpu:
+        model.cuda()
+
+    for store in feature_stores(model):
+        print(store.path, store.features.shape)
+
+
+def val(model, dataloader, results=None):
     """
     计算模型在验证集上的准确率等信息
+    results 不为 None 时把每张图片的 (路径, 第 0 类的概率) 加入 results，用于计算 study 级别的 kappa
     """
     model.eval()
     confusion_matrix = meter.ConfusionMeter(2)
-    s = t.nn.Softmax()
+    s = t.nn.Softmax(dim=1)
 
     criterion = t.nn.CrossEntropyLoss()
     loss_meter = meter.AverageValueMeter()
 
+    prof = Profiler(opt.profile, use_gpu=opt.use_gpu, name='val')
+
+    prof.start('data')
     for ii, data in tqdm(enumerate(dataloader)):
-        input, label, _, body_part = data
-        val_input = Variable(input, volatile=True)
-        target = Variable(label)
-        # body_part = Variable(body_part)
-        if opt.use_gpu:
-            val_input = val_input.cuda()
-            target = target.cuda()
-            # body_part = body_part.cuda()
-        if opt.model.startswith('MultiBranch'):
-            score = model(val_input, body_part)
-        else:
-            score = model(val_input)
-        # confusion_matrix.add(softmax(score.data.squeeze()), label.type(t.LongTensor))
-        confusion_matrix.add(s(Variable(score.data.squeeze())).data, label.type(t.LongTensor))
-        loss = criterion(score, target)
-        loss_meter.add(loss.data[0])
+        prof.stop('data')
+        input, label, path, body_part = data
+        with prof.stage('transfer'):
+            val_input = Variable(input)
+            target = Variable(label)
+            # body_part = Variable(body_part)
+            if opt.use_gpu:
+                val_input = val_input.cuda()
+                target = target.cuda()
+                # body_part = body_part.cuda()
+            val_input = prepare_input(val_input)
+        with prof.stage('forward'), t.no_grad():
+            if opt.model.startswith('MultiBranch'):
+                score = model(val_input, body_part)
+            else:
+                score = model(val_input)
+        with prof.stage('metrics'):
+            # confusion_matrix.add(softmax(score.data.squeeze()), label.type(t.LongTensor))
+            probability = s(score.data.view(score.size(0), -1)).cpu()
+            confusion_matrix.add(probability, label.type(t.LongTensor))
+            if results is not None:
+                results.extend(zip(path, probability[:, 0].tolist()))
+            loss = criterion(score, target)
+            loss_meter.add(loss.item())
+        prof.count('images', val_input.size(0))
+        prof.step()
+        if prof.enabled and ii % opt.print_freq == opt.print_freq - 1:
+            # 与 train 相同，每 print_freq 个 batch 打印一次这个窗口内各阶段的耗时并开始新的窗口
+            print(prof.summary())
+        prof.start('data')
+    prof.stop('data')
+
+    # 最后一个不满 print_freq 个 batch 的窗口
+    if prof.enabled and prof.window_steps:
+        print(prof.summary())
 
     model.train()
     cm_value = confusion_matrix.value()
@@ -182,111 +511,185 @@ def val(model, dataloader):
     return confusion_matrix, accuracy, loss
 
 
-def test(**kwargs):
-    opt.parse(kwargs)
-
-    # configure model
-    # model = DenseNet169(num_classes=2)
-    # model = CustomDenseNet169(num_classes=2)
-    # model = ResNet152(num_classes=2)
-    model = getattr(models, opt.model)()
-    if opt.load_model_path:
-        model.load(opt.load_model_path)
+def build_model(model_type, model_path=None):
+    """
+    创建模型并加载 checkpoint
+    """
+    model = getattr(models, model_type)()
+    if model_path:
+        model.load(model_path)
     if opt.use_gpu:
         model.cuda()
+    check_aspect_buckets(model)
+    return prepare_model(model)
 
-    model.eval()
 
-    # data
-    test_data = MURA_Dataset(opt.data_root, opt.test_image_paths, train=False, test=True)
-    test_dataloader = DataLoader(test_data, batch_size=opt.batch_size, shuffle=False, num_workers=opt.num_workers)
+def check_aspect_buckets(model):
+    if opt.aspect_buckets and model.fixed_input_size:
+        raise ValueError(f'{model.model_name} only takes 320 x 320 inputs and cannot be used with aspect_buckets')
 
-    results = []
-    # confusion_matrix = meter.ConfusionMeter(2)
-    # s = t.nn.Softmax()
 
-    for ii, (data, label, body_part, path) in tqdm(enumerate(test_dataloader)):
-        input = Variable(data, volatile=True)
-        # body_part = Variable(body_part, volatile=True)
-        if opt.use_gpu:
-            input = input.cuda()
-            # body_part = body_part.cuda()
-        if opt.model.startswith('MultiBranch'):
-            score = model(input, body_part)
-        else:
-            score = model(input)
+def bucket_dataloader(data, shuffle):
+    """
+    opt.aspect_buckets: 保持长宽比的 BucketedDataset，每个 batch 中的图片 shape 相同
+    """
+    if not isinstance(data, MURA_Dataset):
+        raise ValueError('aspect_buckets cannot be combined with shard_dir or feature_cache_dir')
+    data = BucketedDataset(data, opt.canvas_size)
+    sampler = BucketBatchSampler(data.buckets, opt.batch_size, shuffle=shuffle)
+    return DataLoader(data, batch_sampler=sampler, num_workers=opt.num_workers)
+
 
-        # confusion_matrix.add(s(Variable(score.data.squeeze())).data, label.type(t.LongTensor))
+def prepare_model(model):
+    """
+    opt.channels_last: 参数使用 channels_last 内存格式；opt.compile: torch.compile
+    """
+    if opt.channels_last:
+        model = model.to(memory_format=t.channels_last)
+    if opt.compile:
+        model.compile_model()
+    if opt.branch_parallel or opt.branch_timing:
+        model.set_branch_parallel(opt.branch_parallel, opt.branch_threads, opt.branch_timing)
+    return model
 
-        probability = t.nn.functional.softmax(score)[:, 0].data.tolist()
 
-        # 每一行为 图片路径 和 positive的概率
-        batch_results = [(path_, probability_) for path_, probability_ in zip(path, probability)]
+def prepare_input(input):
+    if opt.channels_last:
+        input = input.contiguous(memory_format=t.channels_last)
+    return input
 
-        results += batch_results
 
-    # cm_value = confusion_matrix.value()
-    # accuracy = 100. * (cm_value[0][0] + cm_value[1][1]) / (cm_value.sum())
+def prediction_key(data, tta=None):
+    """
+    PredictionCache 使用的 transform key：实际读取的 dataset（opt.aspect_buckets 时为 BucketedDataset）的 transform_key
+    加上 TTA（opt.tta_views）的设置，不能 cache 时为 None。predict 和 evaluate_cache 都用这里的 key，保证读写的是同一个 cache
+    """
+    tta = tta or TestTimeAugmentation(opt.tta_views)
+    key = bucket_transform_key(data.transform_key, opt.canvas_size) if opt.aspect_buckets else data.transform_key
+    if key is not None and tta.key:
+        key = f'{key}_{tta.key}'
+    return key
 
-    # print('confusion matrix: ')
-    # print(cm_value)
-    # print(f'accuracy: {accuracy}')
 
-    write_csv(results, opt.result_file)
+def predict(model_types, model_paths, data, name='test'):
+    """
+    计算 data 中每张图片在每个模型下的 logits，返回 list，每个元素为 numpy array (len(data), 2)
 
-    calculate_cohen_kappa()
-    # return results
+    opt.prediction_cache_dir 不为 None 时使用 utils.PredictionCache，只计算 cache 中没有的图片；
+    所有模型共用同一次数据读取。
+    """
+    imgs = list(data.imgs)
+    # opt.tta_views: 每个 batch 在 device 上展开成 K 个 view 做一次 forward，再在 device 上平均
+    tta = TestTimeAugmentation(opt.tta_views)
+    caches = [PredictionCache.open(opt.prediction_cache_dir, model_type, model_path, prediction_key(data, tta))
+              for model_type, model_path in zip(model_types, model_paths)]
+    missing = [set(cache.missing(imgs)) if cache is not None else set(imgs) for cache in caches]
+    computed = [{} for _ in model_types]
+
+    todo = [img for img in imgs if any(img in m for m in missing)]
+    print(f'{name}: {len(imgs) - len(todo)} of {len(imgs)} images found in prediction cache')
+    if todo:
+        if len(tta) > 1:
+            print(f'{name}: test-time augmentation with {len(tta)} views:', ', '.join(tta.views))
+        # configure model
+        model_hub = [build_model(model_type, model_path).eval() if m else None
+                     for model_type, model_path, m in zip(model_types, model_paths, missing)]
+
+        data.imgs = todo
+        # 结果按图片路径收集，所以可以使用输出顺序不同的 PrefetchDataset 和 BucketBatchSampler
+        if opt.aspect_buckets:
+            dataloader = bucket_dataloader(data, shuffle=False)
+        else:
+            loader_data = PrefetchDataset(data, opt.prefetch_window, opt.prefetch_threads) if opt.prefetch_window else data
+            dataloader = DataLoader(loader_data, batch_size=opt.batch_size, shuffle=False, num_workers=opt.num_workers)
+
+        prof = Profiler(opt.profile, opt.profile_trace_steps, opt.profile_dir, opt.use_gpu, name=name)
+        if opt.num_workers == 0:
+            data.profiler = prof
+
+        prof.start('data')
+        for ii, (input, label, path, body_part) in tqdm(enumerate(dataloader)):
+            prof.stop('data')
+            with prof.stage('transfer'):
+                if opt.use_gpu:
+                    input = input.cuda()
+                input = prepare_input(input)
+
+            for j, model in enumerate(model_hub):
+                # 只计算这个模型的 cache 中没有的图片
+                rows = [k for k, path_ in enumerate(path) if model is not None and path_ in missing[j]]
+                if not rows:
+                    continue
+                x = input if len(rows) == len(path) else input[rows]
+                with prof.stage('tta'):
+                    x = prepare_input(tta.expand(x))
+                with prof.stage(f'forward_{model_types[j]}'), t.no_grad():
+                    if model_types[j].startswith('MultiBranch'):
+                        score = model(x, tta.repeat([body_part[k] for k in rows]))
+                    else:
+                        score = model(x)
+                    score = tta.reduce(score)
+                with prof.stage('metrics'):
+                    computed[j].update(zip([path[k] for k in rows], score.float().cpu().numpy()))
+
+            prof.count('images', input.size(0))
+            prof.step()
+            if prof.enabled and ii % opt.print_freq == opt.print_freq - 1:
+                print(prof.summary())
+            prof.start('data')
+        prof.stop('data')
+        prof.close()
+        if opt.prefetch_window and not opt.aspect_buckets:
+            print('prefetch:', loader_data.metrics.summary())
+        if opt.branch_timing:
+            for model_type, model in zip(model_types, model_hub):
+                if model is not None:
+                    print(model_type, 'branch timing:', json.dumps(model.branch_stats(reset=True)))
+
+        data.imgs = imgs
+        data.profiler = None
+
+    logits = []
+    for cache, c in zip(caches, computed):
+        if cache is None:
+            logits.append(np.stack([c[img] for img in imgs], 0))
+        else:
+            cache.update(c)
+            cache.save()
+            logits.append(cache.get(imgs))
+    return logits
 
 
-def ensemble_test(**kwargs):
+def test(**kwargs):
     opt.parse(kwargs)
 
-    # configure model
-    model_hub = []
-    for i in range(len(opt.ensemble_model_types)):
-        model = getattr(models, opt.ensemble_model_types[i])()
-        if opt.ensemble_model_paths[i]:
-            model.load(opt.ensemble_model_paths[i])
-        if opt.use_gpu:
-            model.cuda()
-        model.eval()
-        model_hub.append(model)
-
     # data
-    test_data = MURA_Dataset(opt.data_root, opt.test_image_paths, train=False, test=True)
-    test_dataloader = DataLoader(test_data, batch_size=opt.batch_size, shuffle=False, num_workers=opt.num_workers)
+    test_data = MURA_Dataset(opt.data_root, opt.test_image_paths, train=False, test=True, stats_file=opt.stats_file)
 
-    results = []
-    # confusion_matrix = meter.ConfusionMeter(2)
-    # s = t.nn.Softmax()
+    logits, = predict([opt.model], [opt.load_model_path], test_data, name='test')
 
-    for ii, (data, label, path) in tqdm(enumerate(test_dataloader)):
-        input = Variable(data, volatile=True)
-        if opt.use_gpu:
-            input = input.cuda()
+    # 每一行为 图片路径 和 positive的概率
+    probability = softmax(logits)[:, 0]
+    results = list(zip(test_data.imgs, probability.tolist()))
 
-        probability_hub = []
-        for model in model_hub:
-            score = model(input)
-            # confusion_matrix.add(s(Variable(score.data.squeeze())).data, label.type(t.LongTensor))
-            probability = t.nn.functional.softmax(score)[:, 0].data.tolist()
-            probability_hub.append(probability)
+    write_csv(results, opt.result_file)
 
-        # print(probability_hub)
+    calculate_cohen_kappa()
+    # return results
 
-        prob = [np.mean([x[i] for x in probability_hub]) for i in range(len(probability_hub[0]))]
 
-        # 每一行为 图片路径 和 positive的概率
-        batch_results = [(path_, probability_) for path_, probability_ in zip(path, prob)]
+def ensemble_test(**kwargs):
+    opt.parse(kwargs)
 
-        results += batch_results
+    # data
+    test_data = MURA_Dataset(opt.data_root, opt.test_image_paths, train=False, test=True, stats_file=opt.stats_file)
+
+    logits = predict(opt.ensemble_model_types, opt.ensemble_model_paths, test_data, name='ensemble_test')
 
-    # cm_value = confusion_matrix.value()
-    # accuracy = 100. * (cm_value[0][0] + cm_value[1][1]) / (cm_value.sum())
+    prob = np.average([softmax(x)[:, 0] for x in logits], axis=0, weights=opt.ensemble_weights)
 
-    # print('confusion matrix: ')
-    # print(cm_value)
-    # print(f'accuracy: {accuracy}')
+    # 每一行为 图片路径 和 positive的概率
+    results = list(zip(test_data.imgs, prob.tolist()))
 
     write_csv(results, opt.result_file)
 
@@ -301,55 +704,448 @@ def write_csv(results, file_name):
         writer.writerows(results)
 
 
-def calculate_cohen_kappa(threshold=0.5):
-    input_csv_file_path = 'result.csv'
-
+def study_probabilities(results):
+    """
+    results: [(图片路径, 概率)]，返回 {study 文件夹路径: 该 study 所有图片概率的平均}
+    """
     result_dict = {}
-    with open(input_csv_file_path, 'r') as F:
-        d = F.readlines()[1:]
-        for data in d:
-            (path, prob) = data.split(',')
-
-            folder_path = path[:path.rfind('/')]
-            prob = float(prob)
-
-            if folder_path in result_dict.keys():
-                result_dict[folder_path].append(prob)
-            else:
-                result_dict[folder_path] = [prob]
+    for path, prob in results:
+        folder_path = path[:path.rfind('/')]
+        result_dict.setdefault(folder_path, []).append(float(prob))
 
     for k, v in result_dict.items():
         result_dict[k] = np.mean(v)
         # visualize
         # print(k, result_dict[k])
+    return result_dict
+
+
+def part_threshold(threshold, XR_type):
+    """
+    threshold 可以是一个数，也可以是 {部位: 阈值}（例如 search_ensemble 得到的 opt.study_thresholds）
+    """
+    if isinstance(threshold, dict):
+        return threshold.get(XR_type, 0.5)
+    return threshold
+
+
+def study_kappa(result_dict, threshold=0.5, verbose=True):
+    """
+    每个部位 study 级别的 cohen kappa 和准确率，返回 {部位: (kappa, accuracy)}
+    """
+    scores = {}
+    for XR_type in BODY_PARTS:
+
+        # 提取出 XR_type 下的所有folder路径，即 result_dict 中的key
+        keys = [k for k, v in result_dict.items() if k[len(opt.data_root):].split('/')[2] == XR_type]
+        if not keys:
+            continue
+
+        y_true = [1 if key.split('_')[-1] == 'positive' else 0 for key in keys]
+        y_pred = [0 if result_dict[key] >= part_threshold(threshold, XR_type) else 1 for key in keys]
+
+        kappa_score = cohen_kappa_score(y_true, y_pred)
+
+        # 预测准确的个数
+        count = sum([1 if y_pred[i] == y_true[i] else 0 for i in range(len(y_true))])
+        scores[XR_type] = (kappa_score, 100.0 * count / len(y_true))
+
+        if verbose:
+            print('--------------------------------------------')
+            print(XR_type, kappa_score)
+            print(XR_type, 'Accuracy', 100.0 * count / len(y_true))
+    return scores
+
+
+def mean_study_kappa(results, threshold=None):
+    """
+    results: [(图片路径, 概率)]，各部位 study 级别 kappa 的平均
+    """
+    if threshold is None:
+        threshold = opt.study_thresholds or 0.5
+    scores = study_kappa(study_probabilities(results), threshold, verbose=False)
+    # 只有一种 label 的部位 kappa 为 nan
+    kappas = [kappa for kappa, _ in scores.values() if not np.isnan(kappa)]
+    return float(np.mean(kappas)) if kappas else 0.
+
+
+def calculate_cohen_kappa(threshold=None):
+    if threshold is None:
+        threshold = opt.study_thresholds or 0.5
+    input_csv_file_path = opt.result_file
+
+    with open(input_csv_file_path, 'r') as F:
+        d = F.readlines()[1:]
+        results = [data.strip().split(',') for data in d]
+
+    result_dict = study_probabilities(results)
 
     # 写入每个study的诊断csv
     with open(opt.output_csv_path, 'w') as F:
         writer = csv.writer(F)
         for k, v in result_dict.items():
             path = k[len(opt.data_root):] + '/'
-            value = 0 if v >= threshold else 1
+            value = 0 if v >= part_threshold(threshold, path.split('/')[2]) else 1
             writer.writerow([path, value])
 
-    XR_type_list = ['XR_ELBOW', 'XR_FINGER', 'XR_FOREARM', 'XR_HAND', 'XR_HUMERUS', 'XR_SHOULDER', 'XR_WRIST']
+    return study_kappa(result_dict, threshold)
 
-    for XR_type in XR_type_list:
 
-        # 提取出 XR_type 下的所有folder路径，即 result_dict 中的key
-        keys = [k for k, v in result_dict.items() if k.split('/')[6] == XR_type]
+def evaluate_cache(thresholds=0.5, ensemble=False, **kwargs):
+    """
+    只用 prediction cache 计算 study 级别的 kappa，不运行模型，需要先运行过 test 或 ensemble_test
 
-        y_true = [1 if key.split('_')[-1] == 'positive' else 0 for key in keys]
-        y_pred = [0 if result_dict[key] >= threshold else 1 for key in keys]
+    python main.py evaluate_cache --thresholds=0.3,0.4,0.5,0.6 --ensemble=True
+    """
+    opt.parse(kwargs)
+    if not isinstance(thresholds, (list, tuple)):
+        thresholds = [float(x) for x in str(thresholds).split(',')]
 
-        print('--------------------------------------------')
+    test_data = MURA_Dataset(opt.data_root, opt.test_image_paths, train=False, test=True, stats_file=opt.stats_file)
+    if ensemble:
+        model_types, model_paths = opt.ensemble_model_types, opt.ensemble_model_paths
+    else:
+        model_types, model_paths = [opt.model], [opt.load_model_path]
 
-        kappa_score = cohen_kappa_score(y_true, y_pred)
+    prob = np.average([PredictionCache(opt.prediction_cache_dir, model_type, model_path,
+                                       prediction_key(test_data)).probabilities(test_data.imgs)
+                       for model_type, model_path in zip(model_types, model_paths)],
+                      axis=0, weights=opt.ensemble_weights if ensemble else None)
+    result_dict = study_probabilities(zip(test_data.imgs, prob))
 
-        print(XR_type, kappa_score)
+    for threshold in thresholds:
+        scores = study_kappa(result_dict, threshold, verbose=False)
+        print(f'threshold {threshold}: mean kappa {np.mean([v[0] for v in scores.values()]):.4f}, ' +
+              ', '.join(f'{k} {v[0]:.3f}' for k, v in scores.items()))
 
-        # 预测准确的个数
-        count = sum([1 if y_pred[i] == y_true[i] else 0 for i in range(len(y_true))])
-        print(XR_type, 'Accuracy', 100.0 * count / len(y_true))
+
+def distill(**kwargs):
+    """
+    知识蒸馏：ensemble_model_types 的 soft target（在 center crop 的训练集上计算一次，保存在 prediction cache 中）
+    监督一个更小的 student_model（在同样的 center crop 上训练），每个 epoch 报告 student 的推理速度和与 teacher ensemble 对比的 study kappa
+
+    python main.py distill --student_model=ResNet34 --distill_temperature=4
+    """
+    opt.parse(kwargs)
+    T = opt.distill_temperature
+
+    # step 1: teacher 的 logits，训练集和验证集都使用 center crop
+    teacher_train = MURA_Dataset(opt.data_root, opt.train_image_paths, train=False, test=False, stats_file=opt.stats_file)
+    val_data = MURA_Dataset(opt.data_root, opt.test_image_paths, train=False, test=True, stats_file=opt.stats_file)
+    teacher_logits = predict(opt.ensemble_model_types, opt.ensemble_model_paths, teacher_train, name='teacher_train')
+    soft_target = np.average([softmax(x / T) for x in teacher_logits], axis=0, weights=opt.ensemble_weights)
+    soft_target = t.from_numpy(soft_target).float()
+    target_index = {path: i for i, path in enumerate(teacher_train.imgs)}
+
+    teacher_val = predict(opt.ensemble_model_types, opt.ensemble_model_paths, val_data, name='teacher_val')
+    teacher_prob = np.average([softmax(x)[:, 0] for x in teacher_val], axis=0, weights=opt.ensemble_weights)
+    teacher_scores = study_kappa(study_probabilities(zip(val_data.imgs, teacher_prob)), verbose=False)
+
+    # step 2: student
+    model = build_model(opt.student_model, opt.load_model_path)
+    model.train()
+
+    # student 在与 teacher 相同的 center crop 上训练，soft target 描述的就是 student 的输入
+    train_data = teacher_train
+    train_dataloader = DataLoader(train_data, opt.batch_size, shuffle=True, num_workers=opt.num_workers)
+
+    weight = t.Tensor(class_weights(train_data.label_counts()))
+    if opt.use_gpu:
+        weight = weight.cuda()
+        soft_target = soft_target.cuda()
+    criterion = t.nn.CrossEntropyLoss(weight=weight)
+    optimizer = t.optim.Adam(model.parameters(), lr=opt.lr, weight_decay=opt.weight_decay)
+    loss_meter = meter.AverageValueMeter()
+
+    ck_dir = os.path.join('checkpoints', model.model_name, 'distill_' + time.strftime('%m%d'))
+    if not os.path.exists(ck_dir):
+        os.makedirs(ck_dir)
+
+    for epoch in range(opt.max_epoch):
+        loss_meter.reset()
+        for ii, (data, label, path, body_part) in tqdm(enumerate(train_dataloader)):
+            target = soft_target[[target_index[p] for p in path]]
+            if opt.use_gpu:
+                data = data.cuda()
+                label = label.cuda()
+            data = prepare_input(data)
+
+            optimizer.zero_grad()
+            if opt.student_model.startswith('MultiBranch'):
+                score = model(data, body_part)
+            else:
+                score = model(data)
+            # T^2 使 soft target 部分的梯度大小与温度无关
+            kd_loss = t.nn.functional.kl_div(t.nn.functional.log_softmax(score / T, dim=1), target,
+                                             reduction='batchmean') * T * T
+            loss = opt.distill_alpha * kd_loss + (1 - opt.distill_alpha) * criterion(score, label)
+            loss.backward()
+            optimizer.step()
+            loss_meter.add(loss.item())
+
+        ck_path = model.save(os.path.join(ck_dir, f'epoch_{epoch}_{str(opt)}.pth'))
+
+        # step 3: student 的速度和 study kappa
+        start = time.perf_counter()
+        student_logits, = predict([opt.student_model], [ck_path], val_data, name='student')
+        elapsed = time.perf_counter() - start
+        student_prob = softmax(student_logits)[:, 0]
+        student_scores = study_kappa(study_probabilities(zip(val_data.imgs, student_prob)), verbose=False)
+        model.train()
+
+        print(f'epoch {epoch}: loss {loss_meter.value()[0]:.4f}, '
+              f'student {len(val_data) / elapsed:.1f} images/s, '
+              f'kappa student {np.mean([v[0] for v in student_scores.values()]):.4f} / '
+              f'teacher {np.mean([v[0] for v in teacher_scores.values()]):.4f}')
+        for XR_type in student_scores:
+            print(f'    {XR_type}: student {student_scores[XR_type][0]:.3f}, teacher {teacher_scores[XR_type][0]:.3f}')
+
+
+def cascade_test(sweep=False, **kwargs):
+    """
+    级联推理：cascade_fast_model 先对所有 study 打分，聚合后的 study 概率落在 cascade_band 内（不确定）的 study
+    再交给 ensemble_model_types 计算，结果合并后与 test() 写出相同格式的 predictions.csv
+
+    sweep=True 时 ensemble 对所有图片都计算一次（结果在 prediction cache 中），
+    然后报告不同 band 下升级的比例、kappa 和估计的吞吐量。
+    计时包含 prediction cache 的命中，要测真实的速度请使用 --prediction_cache_dir=None。
+    """
+    opt.parse(kwargs)
+    lo, hi = opt.cascade_band
+
+    test_data = MURA_Dataset(opt.data_root, opt.test_image_paths, train=False, test=True, stats_file=opt.stats_file)
+    imgs = list(test_data.imgs)
+
+    # step 1: fast model
+    start = time.perf_counter()
+    fast_logits, = predict([opt.cascade_fast_model], [opt.cascade_fast_model_path], test_data, name='cascade_fast')
+    fast_time = time.perf_counter() - start
+    fast_prob = softmax(fast_logits)[:, 0]
+    fast_study = study_probabilities(zip(imgs, fast_prob))
+
+    # step 2: 不确定的 study 交给 heavy 模型
+    uncertain = {k for k, v in fast_study.items() if lo <= v <= hi}
+    escalated = [i for i, img in enumerate(imgs) if img[:img.rfind('/')] in uncertain]
+
+    prob = fast_prob.copy()
+    heavy_time = 0.
+    if escalated:
+        test_data.imgs = [imgs[i] for i in escalated]
+        start = time.perf_counter()
+        heavy_logits = predict(opt.ensemble_model_types, opt.ensemble_model_paths, test_data, name='cascade_heavy')
+        heavy_time = time.perf_counter() - start
+        test_data.imgs = imgs
+        prob[escalated] = np.average([softmax(x)[:, 0] for x in heavy_logits], axis=0, weights=opt.ensemble_weights)
+
+    results = list(zip(imgs, prob.tolist()))
+    write_csv(results, opt.result_file)
+    scores = calculate_cohen_kappa()
+    fast_scores = study_kappa(fast_study, opt.study_thresholds or 0.5, verbose=False)
+
+    print('--------------------------------------------')
+    print(f'escalated {len(uncertain)} of {len(fast_study)} studies ({100. * len(uncertain) / len(fast_study):.1f}%), '
+          f'{len(escalated)} of {len(imgs)} images')
+    print(f'fast {fast_time:.1f}s, heavy {heavy_time:.1f}s, total {len(imgs) / (fast_time + heavy_time):.1f} images/s')
+    print(f'mean kappa: fast only {np.mean([v[0] for v in fast_scores.values()]):.4f}, '
+          f'cascade {np.mean([v[0] for v in scores.values()]):.4f}')
+
+    if not sweep:
+        return
+
+    heavy_logits = predict(opt.ensemble_model_types, opt.ensemble_model_paths, test_data, name='cascade_sweep')
+    heavy_prob = np.average([softmax(x)[:, 0] for x in heavy_logits], axis=0, weights=opt.ensemble_weights)
+    fast_cost = fast_time / len(imgs)
+    heavy_cost = heavy_time / len(escalated) if escalated else 0.
+    study_of = np.array([fast_study[img[:img.rfind('/')]] for img in imgs])
+
+    print('band, escalated studies %, mean kappa, estimated images/s')
+    for width in [0., 0.1, 0.2, 0.3, 0.4, 0.5]:
+        band = (0.5 - width / 2, 0.5 + width / 2) if width < 0.5 else (0., 1.)
+        mask = (study_of >= band[0]) & (study_of <= band[1])
+        merged = np.where(mask, heavy_prob, fast_prob)
+        band_study = study_probabilities(zip(imgs, merged))
+        band_scores = study_kappa(band_study, opt.study_thresholds or 0.5, verbose=False)
+        n_studies = sum(1 for v in fast_study.values() if band[0] <= v <= band[1])
+        cost = fast_cost + heavy_cost * mask.mean() if heavy_cost else None
+        print(f'({band[0]:.2f}, {band[1]:.2f}), {100. * n_studies / len(fast_study):.1f}, '
+              f'{np.mean([v[0] for v in band_scores.values()]):.4f}, '
+              f'{1. / cost if cost else float("nan"):.1f}')
+
+
+def search_ensemble(step=0.1, thresholds=None, output='ensemble_search.json', **kwargs):
+    """
+    在 opt.search_model_types 中搜索 ensemble 的模型子集、权重和每个部位的阈值，使验证集上 study 级别的平均 kappa 最大
+    概率来自 prediction cache（缺少的会先计算一次），结果可以直接作为 ensemble_test 的参数
+
+    python main.py search_ensemble --step=0.05
+    """
+    opt.parse(kwargs)
+    if thresholds is None:
+        thresholds = np.arange(0.05, 0.96, 0.025)
+
+    test_data = MURA_Dataset(opt.data_root, opt.test_image_paths, train=False, test=True, stats_file=opt.stats_file)
+    logits = predict(opt.search_model_types, opt.search_model_paths, test_data, name='search_ensemble')
+    probs = np.stack([softmax(x)[:, 0] for x in logits], 0)
+
+    weights = ensemble_search.weight_grid(len(probs), step)
+    best = ensemble_search.search(probs, test_data.imgs, opt.data_root, BODY_PARTS, weights, thresholds)
+
+    used = [i for i, w in enumerate(best['weights']) if w > 0]
+    settings = {
+        'ensemble_model_types': [opt.search_model_types[i] for i in used],
+        'ensemble_model_paths': [opt.search_model_paths[i] for i in used],
+        'ensemble_weights': [best['weights'][i] for i in used],
+        'study_thresholds': best['thresholds'],
+    }
+    best['config'] = settings
+
+    print(f"searched {best['weight_vectors']} weight vectors x {len(thresholds)} thresholds per part "
+          f"in {best['seconds']:.3f}s ({best['weight_vectors_per_s']:.0f} weight vectors/s)")
+    print('mean kappa:', best['mean_kappa'])
+    print('kappa:', best['kappa'])
+    print('Config:')
+    for k, v in settings.items():
+        print(f'    {k} = {v!r}')
+
+    with open(output, 'w') as F:
+        json.dump(best, F, indent=2)
+    print('written to', output)
+
+
+def aspect_report(output='aspect_report.json', **kwargs):
+    """
+    比较现在的 Resize + CenterCrop 与 aspect_buckets 每个部位平均每个 study 的像素数和保留的图片内容：
+        python main.py aspect_report --canvas_size=320
+    """
+    opt.parse(kwargs)
+    report = {}
+    for name, csv_path in [('train', opt.train_image_paths), ('valid', opt.test_image_paths)]:
+        report[name] = pixel_report(MURA_Dataset(opt.data_root, csv_path, train=False, test=False), opt.canvas_size)
+    print(json.dumps(report, indent=2))
+    with open(output, 'w') as F:
+        json.dump(report, F, indent=2)
+    print('written to', output)
+
+
+def pack_dataset(output=None, resize=None, shard_size_mb=256, **kwargs):
+    """
+    把训练集和验证集打包成 tar shard，用于网络存储等随机读取慢的情况：
+        python main.py pack_dataset --output=/local/mura_shards --resize=320
+    之后用 --shard_dir=/local/mura_shards 训练。resize 为短边的长度，None 为保存原图
+    """
+    opt.parse(kwargs)
+    output = output or opt.shard_dir
+    for name, csv_path in [('train', opt.train_image_paths), ('valid', opt.test_image_paths)]:
+        data = MURA_Dataset(opt.data_root, csv_path, train=False, test=False)
+        shards = pack_shards(data, os.path.join(output, name), shard_size_mb=shard_size_mb, resize=resize)
+        print(name, len(data), 'images,', len(shards), 'shards,', sum(s['bytes'] for s in shards) / 2 ** 20, 'MB')
+
+
+def compute_stats(output='dataset_stats.json', processes=4, **kwargs):
+    """
+    用多个进程流式统计训练集每个部位的 mean / std / 像素直方图，写入 output：
+        python main.py compute_stats --output=dataset_stats.json --processes=8
+    之后用 --stats_file=dataset_stats.json 代替 ImageNet 的 mean / std
+    """
+    opt.parse(kwargs)
+    stats = compute_statistics(opt.data_root, opt.train_image_paths, processes=processes)
+    save_statistics(stats, output)
+    for part, s in stats.items():
+        print(f"{part:12s} images {s['images']:6d} mean {s['mean']:.4f} std {s['std']:.4f}")
+    print('written to', output)
+
+
+def convert_pooled_head(**kwargs):
+    """
+    把 dense head 的 VGG checkpoint 转换成 pooled head 并保存：
+        python main.py convert_pooled_head --model=MultiBranchVGG19Pooled --load_model_path=checkpoints/MultiBranchVGG19_xxx.pth
+    之后可以用转换后的 checkpoint 继续 train 或者 test（pooled head 的模型也可以直接加载 dense head 的 checkpoint）
+    """
+    opt.parse(kwargs)
+    model = getattr(models, opt.model)()
+    if not getattr(model, 'pooled_head', False):
+        raise ValueError(f'{opt.model} does not have a pooled head')
+    model.load(opt.load_model_path)
+    print('converted checkpoint saved to', model.save())
+
+
+def _pruning_level(model, data, ratio, checkpoint=None):
+    """
+    一个剪枝比例下模型的乘加次数（MACs）、batch 的推理时间和验证集 study kappa
+    """
+    size = data.size.value
+    multi_branch = opt.model.startswith('MultiBranch')
+    device = 'cuda' if opt.use_gpu else 'cpu'
+    x = prepare_input(t.randn(1, 3, size, size, device=device))
+    batch = prepare_input(t.randn(opt.batch_size, 3, size, size, device=device))
+    results = []
+    val(model, DataLoader(data, opt.batch_size, shuffle=False, num_workers=opt.num_workers), results)
+    return {
+        'ratio': ratio, 'checkpoint': checkpoint,
+        'parameters': sum(p.numel() for p in model.parameters()),
+        'gmacs': pruning.count_macs(model, x, ['XR_WRIST'] if multi_branch else None) / 1e9,
+        'batch_latency': pruning.latency(model, batch, ['XR_WRIST'] * opt.batch_size if multi_branch else None),
+        'kappa': mean_study_kappa(results),
+    }
+
+
+def prune(ratios='0.25,0.5', finetune_epochs=3, output='pruning.json', **kwargs):
+    """
+    按 BatchNorm 的 |gamma| 对 DenseNet / ResNet 的 block 内部 channel 做结构化剪枝，每个比例剪枝之后用 train 微调：
+        python main.py prune --model=DenseNet169 --load_model_path=checkpoints/xxx.pth --ratios=0.25,0.5 --finetune_epochs=3
+
+    剪枝之后的 checkpoint 保存在 checkpoints/pruned/ 中，可以直接用 --load_model_path 加载（BasicModule.load 会按
+    checkpoint 修改层的大小）。每个比例的 MACs、推理时间以及微调前后的 kappa 写入 output
+    """
+    opt.parse(kwargs)
+    if not opt.load_model_path:
+        raise ValueError('prune needs a trained model, set --load_model_path')
+    ratios = [float(r) for r in (ratios if isinstance(ratios, (list, tuple)) else str(ratios).split(','))]
+    baseline_path = opt.load_model_path
+    val_data = MURA_Dataset(opt.data_root, opt.test_image_paths, part=opt.part, train=False, test=False,
+                            stats_file=opt.stats_file)
+
+    baseline = build_model(opt.model, baseline_path)
+    report = {'model': opt.model, 'baseline': _pruning_level(baseline, val_data, 0., baseline_path), 'levels': []}
+    print(f"baseline: {report['baseline']['gmacs']:.2f} GMACs, kappa {report['baseline']['kappa']:.4f}")
+
+    if not os.path.exists('checkpoints/pruned'):
+        os.makedirs('checkpoints/pruned')
+    tag = os.path.splitext(os.path.basename(baseline_path))[0]
+    for ratio in ratios:
+        # 每个比例从 baseline 的 checkpoint 重新创建模型再剪枝，剪枝之后再 prepare_model（channels_last、compile）
+        pruned = getattr(models, opt.model)()
+        pruned.load(baseline_path)
+        if opt.use_gpu:
+            pruned.cuda()
+        channels = pruning.prune_model(pruned, ratio)
+        pruned = prepare_model(pruned)
+        path = pruned.save(os.path.join('checkpoints/pruned', f'{tag}_prune{int(ratio * 100)}.pth'))
+        level = {'channels': channels, 'pruned': _pruning_level(pruned, val_data, ratio, path)}
+        del pruned
+
+        if finetune_epochs:
+            # train 会把参数写入 opt，结束后恢复，下一个比例和之后的 build_model 使用原来的设置
+            finetune = {'load_model_path': path, 'max_epoch': finetune_epochs}
+            saved = {k: getattr(opt, k) for k in finetune}
+            try:
+                history = train(**finetune)
+            finally:
+                for k, v in saved.items():
+                    setattr(opt, k, v)
+            best = max(history, key=lambda h: h['val_kappa'])
+            level['finetuned'] = _pruning_level(build_model(opt.model, best['checkpoint']), val_data, ratio,
+                                                best['checkpoint'])
+            level['finetune_epochs'] = len(history)
+        report['levels'].append(level)
+        final = level.get('finetuned', level['pruned'])
+        print(f"ratio {ratio}: channels {channels['after']}/{channels['before']}, {final['gmacs']:.2f} GMACs, "
+              f"latency {final['batch_latency'] * 1000:.1f}ms, kappa {level['pruned']['kappa']:.4f} -> "
+              f"{final['kappa']:.4f}")
+
+    with open(output, 'w') as F:
+        json.dump(report, F, indent=2)
+    print('written to', output)
 
 
 def help(**kwargs):
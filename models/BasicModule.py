@@ -3,6 +3,12 @@
 import torch as t
 import time
 import re
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.checkpoint import checkpoint
+
+# route 使用的线程池和 CUDA stream，按 (线程数) / (device, 序号) 共用，不放在 module 中（module 需要能 deepcopy）
+_EXECUTORS = {}
+_STREAMS = {}
 
 
 class BasicModule(t.nn.Module):
@@ -10,17 +16,236 @@ class BasicModule(t.nn.Module):
     封装了nn.Module,主要是提供了save和load两个方法
     """
 
+    # MultiBranch 模型中所有部位共用的层（trunk），由 forward_trunk 计算
+    trunk_names = ()
+
+    # 为 True 时只能输入 320 x 320 的图片（classifier 之前没有 adaptive pooling），不能用于 opt.aspect_buckets
+    fixed_input_size = False
+
     def __init__(self):
         super(BasicModule, self).__init__()
         # self.model_name = str(type(self))  # 默认名字
         self.model_name = self.__class__.__name__
+        # 为 True 时 forward 的输入已经是 forward_trunk 的输出（来自 dataset.FeatureStore）
+        self.use_cached_trunk = False
+        # route 中各部位 branch 的执行方式，见 set_branch_parallel
+        self.branch_parallel = None
+        self.branch_threads = None
+        self.branch_timing = False
+        self.branch_times = {}
+
+    def freeze_trunk(self):
+        """
+        固定 trunk 的参数和 BatchNorm 统计量，只训练各个部位的 branch 和 classifier
+        """
+        for name in self.trunk_names:
+            module = getattr(self, name)
+            module.eval()
+            for param in module.parameters():
+                param.requires_grad = False
+        return self
+
+    def set_branch_parallel(self, mode=None, threads=None, timing=False):
+        """
+        route 中各部位 branch 的执行方式：
+            None        依次执行
+            'threads'   在线程池中同时执行（CPU 上的 inter-op 并行，torch 的算子会释放 GIL），threads 默认为部位数
+            'streams'   GPU 上每个部位使用单独的 CUDA stream，CPU 上与 None 相同
+        timing 为 True 时记录每个部位 branch 的调用次数、图片数和耗时，见 branch_stats
+        """
+        if mode not in (None, 'threads', 'streams'):
+            raise ValueError(f'unknown branch_parallel mode {mode}')
+        for module in self.modules():
+            if isinstance(module, BasicModule):
+                module.branch_parallel, module.branch_threads, module.branch_timing = mode, threads, timing
+        return self
+
+    def route(self, x, body_part, branch):
+        """
+        MultiBranch 模型按部位分组：同一个部位的样本组成一个子 batch，调用一次 branch(bp, 子 batch)，
+        输出再按原来的顺序拼回去。每个部位只有一次 branch 调用，而不是每个样本一次
+        """
+        groups = {}
+        for i, bp in enumerate(body_part):
+            groups.setdefault(bp, []).append(i)
+
+        order, inputs = [], []
+        for bp, idx in groups.items():
+            index = t.tensor(idx, dtype=t.long, device=x.device)
+            inputs.append((bp, x.index_select(0, index)))
+            order.append(index)
+
+        if self.branch_parallel == 'streams' and x.is_cuda and len(inputs) > 1:
+            outs = self._route_streams(inputs, branch)
+        elif self.branch_parallel == 'threads' and len(inputs) > 1:
+            # 默认每个部位（共 7 个）一个线程
+            threads = self.branch_threads or 7
+            if threads not in _EXECUTORS:
+                _EXECUTORS[threads] = ThreadPoolExecutor(threads)
+            grad = t.is_grad_enabled()
+            outs = list(_EXECUTORS[threads].map(lambda a: self._run_branch(branch, a[0], a[1], grad), inputs))
+        else:
+            outs = [self._run_branch(branch, bp, sub) for bp, sub in inputs]
+
+        out = t.cat(outs, 0)
+        return t.zeros_like(out).index_copy(0, t.cat(order, 0), out)
+
+    def _run_branch(self, branch, bp, x, grad=None):
+        # 线程池中的线程不继承 grad mode，需要设置成与调用 route 的线程相同
+        with t.set_grad_enabled(t.is_grad_enabled() if grad is None else grad):
+            if not self.branch_timing:
+                return branch(bp, x)
+            if x.is_cuda:
+                t.cuda.current_stream(x.device).synchronize()
+            start = time.perf_counter()
+            out = branch(bp, x)
+            if x.is_cuda:
+                t.cuda.current_stream(x.device).synchronize()
+            self._record_branch(bp, x.size(0), time.perf_counter() - start)
+            return out
+
+    def _route_streams(self, inputs, branch):
+        current = t.cuda.current_stream(inputs[0][1].device)
+        outs, events = [], []
+        for i, (bp, sub) in enumerate(inputs):
+            key = (sub.device, i)
+            if key not in _STREAMS:
+                _STREAMS[key] = t.cuda.Stream(device=sub.device)
+            stream = _STREAMS[key]
+            stream.wait_stream(current)
+            # sub 由 current stream 分配，在 stream 上使用结束之前不能被回收
+            sub.record_stream(stream)
+            with t.cuda.stream(stream):
+                if self.branch_timing:
+                    start, end = t.cuda.Event(enable_timing=True), t.cuda.Event(enable_timing=True)
+                    start.record(stream)
+                    outs.append(branch(bp, sub))
+                    end.record(stream)
+                    events.append((bp, sub.size(0), start, end))
+                else:
+                    outs.append(branch(bp, sub))
+        for i in range(len(inputs)):
+            current.wait_stream(_STREAMS[(inputs[i][1].device, i)])
+        for bp, n, start, end in events:
+            end.synchronize()
+            self._record_branch(bp, n, start.elapsed_time(end) / 1000.)
+        return outs
+
+    def _record_branch(self, bp, images, seconds):
+        stats = self.branch_times.setdefault(bp, [0, 0, 0.])
+        stats[0] += 1
+        stats[1] += images
+        stats[2] += seconds
+
+    def branch_stats(self, reset=False):
+        """
+        每个部位 branch 的调用次数、图片数、总耗时和每张图片的耗时；imbalance 为最慢的部位总耗时与平均的比值
+        """
+        stats = {}
+        for module in self.modules():
+            if isinstance(module, BasicModule):
+                for bp, (calls, images, seconds) in module.branch_times.items():
+                    s = stats.setdefault(bp, {'calls': 0, 'images': 0, 'seconds': 0.})
+                    s['calls'] += calls
+                    s['images'] += images
+                    s['seconds'] += seconds
+                if reset:
+                    module.branch_times = {}
+        for s in stats.values():
+            s['ms_per_image'] = 1000. * s['seconds'] / max(1, s['images'])
+        result = {'parts': stats}
+        if stats:
+            seconds = [s['seconds'] for s in stats.values()]
+            result['imbalance'] = max(seconds) / max(1e-12, sum(seconds) / len(seconds))
+        return result
+
+    def compile_model(self, **kwargs):
+        """
+        使用 torch.compile（in-place，不改变 state_dict 的 key）
+        MultiBranch 模型按部位分组是数据相关的控制流，整个 forward 编译会产生 graph break，
+        所以分别编译 trunk 和每个部位的 branch（子 batch 的大小会变化，branch 使用 dynamic shape），分组在 eager 中完成
+        """
+        if not self.trunk_names:
+            self.compile(**kwargs)
+            return self
+        for name, module in self.named_children():
+            if not any(True for _ in module.parameters()):
+                continue
+            module.compile(dynamic=name not in self.trunk_names, **kwargs)
+        return self
+
+    def enable_checkpointing(self, stages):
+        """
+        对选中的 stage 使用 activation checkpointing：forward 时不保存 stage 内部的中间结果，backward 时重新计算，
+        用计算时间换显存。stages 可以包含：
+            'dense', 'denseblock1' ~ 'denseblock4'   DenseNet 的 dense block，使用 torchvision 的 memory_efficient，
+                                                     不保存每一层 concat 之后的 feature map
+            'layer', 'layer1' ~ 'layer4'             ResNet 的 layer
+            'branch'                                 MultiBranch 模型中每个部位单独的 branch
+        返回使用了 checkpointing 的 module 的名字
+        """
+        from torchvision.models.densenet import _DenseBlock
+
+        if isinstance(stages, str):
+            stages = stages.split(',')
+        enabled = []
+        branch = re.compile(r'^(features_specific|layer4)_XR_')
+        for name, module in self.named_children():
+            if branch.match(name):
+                if 'branch' in stages:
+                    _checkpoint_forward(module)
+                    enabled.append(name)
+            elif re.match(r'^layer\d$', name) and ('layer' in stages or name in stages):
+                _checkpoint_forward(module)
+                enabled.append(name)
+
+        for name, module in self.named_modules():
+            if not isinstance(module, _DenseBlock) or branch.match(name):
+                continue
+            block = f'denseblock{_dense_block_index(module)}'
+            if 'dense' in stages or block in stages:
+                for layer in module.children():
+                    layer.memory_efficient = True
+                enabled.append(f'{name} ({block})')
+
+        print('activation checkpointing:', ', '.join(enabled) or 'none')
+        return enabled
+
+    def conform_to(self, state_dict):
+        """
+        把 shape 与 state_dict 不同的 Conv2d / BatchNorm2d / Linear 换成与 state_dict 相同大小的新层
+        （参数之后由 load_state_dict 加载），用于加载 utils.pruning 剪枝之后的模型。返回被替换的层的名字
+        """
+        replaced = []
+        for name, module in list(self.named_modules()):
+            if not isinstance(module, (t.nn.Conv2d, t.nn.BatchNorm2d, t.nn.Linear)):
+                continue
+            weight = state_dict.get(name + '.weight')
+            if weight is None or weight.shape == module.weight.shape:
+                continue
+            if isinstance(module, t.nn.Conv2d):
+                new = t.nn.Conv2d(weight.size(1) * module.groups, weight.size(0), module.kernel_size, module.stride,
+                                  module.padding, module.dilation, module.groups, bias=module.bias is not None)
+            elif isinstance(module, t.nn.BatchNorm2d):
+                new = t.nn.BatchNorm2d(weight.size(0), module.eps, module.momentum, module.affine,
+                                       module.track_running_stats)
+            else:
+                new = t.nn.Linear(weight.size(1), weight.size(0), bias=module.bias is not None)
+            parent_name, _, child = name.rpartition('.')
+            parent = self.get_submodule(parent_name)
+            setattr(parent, child, new.to(module.weight.device))
+            replaced.append(name)
+        return replaced
 
     def load(self, path):
         """
         可加载指定路径的模型
         """
         # GPU 加载模型
-        self.load_state_dict(t.load(path))
+        state_dict = t.load(path)
+        # 剪枝之后保存的模型（python main.py prune）层的大小不同，先按 checkpoint 修改结构
+        self.conform_to(state_dict)
+        self.load_state_dict(state_dict)
 
         # 使用CPU加载GPU模型
         # state_dict = t.load(path, map_location=lambda storage, loc: storage)
@@ -45,6 +270,31 @@ class BasicModule(t.nn.Module):
         return name
 
 
+def _checkpoint_forward(module):
+    """
+    把 module 的 forward 换成 checkpoint 版本，不改变 state_dict；只在需要计算梯度时生效
+    """
+    if getattr(module, '_checkpointed', False):
+        return
+    forward = module.forward
+
+    def checkpointed_forward(*args):
+        if t.is_grad_enabled():
+            return checkpoint(forward, *args, use_reentrant=False)
+        return forward(*args)
+
+    module.forward = checkpointed_forward
+    module._checkpointed = True
+
+
+def _dense_block_index(block):
+    """
+    DenseNet169 中 dense block 的序号。Sequential(*children()) 之后名字丢失了，用第一层的输入 channel 数判断
+    """
+    num_features = next(block.children()).norm1.num_features
+    return {64: 1, 128: 2, 256: 3, 640: 4}.get(num_features, 0)
+
+
 class Flat(t.nn.Module):
     """
     把输入reshape成（batch_size,dim_length）
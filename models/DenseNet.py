@@ -10,10 +10,11 @@ from torchvision import models
 from torch.autograd import Variable
 
 from .BasicModule import BasicModule
+from .SpatialPyramidPooling import SpatialPyramidPooling
 
 # load the original DenseNet model
+# 只加载一次，每个模型在 __init__ 中 deepcopy 自己的一份，不同实例之间不共用参数
 model = models.densenet169(pretrained=True)
-model.cuda()
 # model.load_state_dict(t.load('./models/pretrained_models/densenet169-b2777c0a.pth'))
 
 
@@ -25,7 +26,7 @@ class DenseNet169(BasicModule):
 
         # model = models.densenet169(pretrained=False)
 
-        self.features = nn.Sequential(*list(model.features.children()))
+        self.features = nn.Sequential(*list(copy.deepcopy(model.features).children()))
 
         self.classifier = nn.Linear(1664, num_classes)
 
@@ -58,6 +59,8 @@ class DenseNet169(BasicModule):
                 new_key = res.group(1) + res.group(2)
                 state_dict[new_key] = state_dict[key]
                 del state_dict[key]
+        # 剪枝之后保存的模型（python main.py prune）层的大小不同，先按 checkpoint 修改结构
+        self.conform_to(state_dict)
         self.load_state_dict(state_dict)
 
 
@@ -69,25 +72,19 @@ class CustomDenseNet169(BasicModule):
 
         # model = models.densenet169(pretrained=False)
 
-        self.features = nn.Sequential(*list(model.features.children()))
+        self.features = nn.Sequential(*list(copy.deepcopy(model.features).children()))
 
         # self.classifier = nn.Linear(26624, num_classes)
         self.classifier = nn.Linear(30 * 1664, num_classes)
 
-        self.ada_pooling1 = nn.AdaptiveAvgPool2d((1, 1))
-        self.ada_pooling2 = nn.AdaptiveAvgPool2d((2, 2))
-        self.ada_pooling3 = nn.AdaptiveAvgPool2d((3, 3))
-        self.ada_pooling4 = nn.AdaptiveAvgPool2d((4, 4))
+        # 1x1, 2x2, 3x3, 4x4 四个 level 一次计算完成
+        self.spp = SpatialPyramidPooling((1, 2, 3, 4))
 
     def forward(self, x):
         features = self.features(x)
         out = F.relu(features, inplace=True)
         # out = F.avg_pool2d(out, kernel_size=7, stride=1).view(features.size(0), -1)
-        out1 = self.ada_pooling1(out).view(features.size(0), -1)
-        out2 = self.ada_pooling2(out).view(features.size(0), -1)
-        out3 = self.ada_pooling3(out).view(features.size(0), -1)
-        out4 = self.ada_pooling4(out).view(features.size(0), -1)
-        out = t.cat([out1, out2, out3, out4], 1)
+        out = self.spp(out)
 
         # print(out.size())
         out = self.classifier(out)
@@ -96,29 +93,32 @@ class CustomDenseNet169(BasicModule):
 
 class MultiBranchDenseNet169(BasicModule):
 
+    trunk_names = ('features_common',)
+
     def __init__(self, num_classes=2):
         super(MultiBranchDenseNet169, self).__init__()
 
         # model = models.densenet169(pretrained=False)
 
+        features = copy.deepcopy(model.features)
         self.features_common = nn.Sequential(
-            model.features.conv0,
-            model.features.norm0,
-            model.features.relu0,
-            model.features.pool0,
-            model.features.denseblock1,
-            model.features.transition1,
-            model.features.denseblock2,
-            model.features.transition2,
-            model.features.denseblock3,
-            model.features.transition3
+            features.conv0,
+            features.norm0,
+            features.relu0,
+            features.pool0,
+            features.denseblock1,
+            features.transition1,
+            features.denseblock2,
+            features.transition2,
+            features.denseblock3,
+            features.transition3
         )
 
         self.dropout = nn.Dropout(0.5)
 
         for x in ['XR_ELBOW', 'XR_FINGER', 'XR_FOREARM', 'XR_HAND', 'XR_HUMERUS', 'XR_SHOULDER', 'XR_WRIST']:
-            setattr(self, f'features_specific_{x}', copy.deepcopy(nn.Sequential(model.features.denseblock4,
-                                                                                model.features.norm5)))
+            setattr(self, f'features_specific_{x}', copy.deepcopy(nn.Sequential(features.denseblock4,
+                                                                                features.norm5)))
             setattr(self, f'ada_pooling_{x}', nn.AdaptiveAvgPool2d((1, 1)))
             setattr(self, f'classifier_{x}', nn.Linear(1664, num_classes))
 
@@ -126,47 +126,33 @@ class MultiBranchDenseNet169(BasicModule):
         # print(dir(self))
 
     def forward(self, x, body_part):
-        x = self.features_common(x)
+        if not self.use_cached_trunk:
+            x = self.forward_trunk(x)
+        return self.forward_branches(x, body_part)
+
+    def forward_trunk(self, x):
+        return self.features_common(x)
+
+    def forward_branches(self, x, body_part):
         # print('x.size(): ', x.size()) -> torch.Size([8, 640, 10, 10])
+        return self.route(x, body_part, self.forward_branch)
 
-        out1 = Variable(t.FloatTensor())
-        for (xx, bp) in zip(x, body_part):
-            d = xx.unsqueeze(0).cuda()
-            d = getattr(self, f'features_specific_{bp}')(d)
-            if out1.size():
-                out1 = t.cat([out1, d], dim=0)
-            else:
-                out1 = d
+    def forward_branch(self, bp, x):
+        """
+        一个部位的子 batch 经过该部位的 branch 和 classifier
+        """
+        out1 = getattr(self, f'features_specific_{bp}')(x)
 
-        # print('out1.size(): ', out1.size()) -> torch.Size([8, 1664, 10, 10])
+        # print('out1.size(): ', out1.size()) -> torch.Size([n, 1664, 10, 10])
         out2 = F.relu(out1, inplace=True)
         out2 = self.dropout(out2)
 
-        # print('out2.size(): ', out2.size()) -> torch.Size([8, 1664, 10, 10])
-
-        out3 = Variable(t.FloatTensor(), requires_grad=True)
-        for (xx, bp) in zip(out2, body_part):
-            d = xx.unsqueeze(0).cuda()
-            d = getattr(self, f'ada_pooling_{bp}')(d).view(d.size(0), -1)
-            if out3.size():
-                out3 = t.cat([out3, d], dim=0)
-            else:
-                out3 = d
-
-        # print('out3.size(): ', out3.size()) -> torch.Size([8, 1664])
-
-        out4 = Variable(t.FloatTensor(), requires_grad=True)
-        for (xx, bp) in zip(out3, body_part):
-            xx = xx.cuda()
-            xx = getattr(self, f'classifier_{bp}')(xx)
-            d = xx.unsqueeze(0)
-            if out4.size():
-                out4 = t.cat([out4, d], dim=0)
-            else:
-                out4 = d
+        out3 = getattr(self, f'ada_pooling_{bp}')(out2).view(out2.size(0), -1)
 
-        # print('out4.size(): ', out4.size()) -> torch.Size([8, 2])
+        # print('out3.size(): ', out3.size()) -> torch.Size([n, 1664])
+        out4 = getattr(self, f'classifier_{bp}')(out3)
 
+        # print('out4.size(): ', out4.size()) -> torch.Size([n, 2])
         return out4
 
     def load(self, path):
@@ -186,5 +172,7 @@ class MultiBranchDenseNet169(BasicModule):
                 new_key = res.group(1) + res.group(2)
                 state_dict[new_key] = state_dict[key]
                 del state_dict[key]
+        # 剪枝之后保存的模型（python main.py prune）层的大小不同，先按 checkpoint 修改结构
+        self.conform_to(state_dict)
         self.load_state_dict(state_dict)
 
@@ -39,6 +39,9 @@ class ResNet34(BasicModule):
     用子module来实现Residual block，用_make_layer函数来实现layer
     """
 
+    # forward 中 avg_pool2d 的 kernel 固定为 7，对应 320 x 320 的输入
+    fixed_input_size = True
+
     def __init__(self, num_classes=2):
         super(ResNet34, self).__init__()
         self.model_name = 'resnet34'
@@ -131,6 +134,8 @@ class ResNet152(BasicModule):
 
 class MultiBranchResNet101(BasicModule):
 
+    trunk_names = ('conv1', 'bn1', 'relu', 'maxpool', 'layer1', 'layer2', 'layer3')
+
     def __init__(self, num_classes=2):
         model = models.resnet101(pretrained=True)
 
@@ -153,6 +158,11 @@ class MultiBranchResNet101(BasicModule):
             setattr(self, f'fc_{x}', nn.Linear(2048, num_classes))
 
     def forward(self, x, body_part):
+        if not self.use_cached_trunk:
+            x = self.forward_trunk(x)
+        return self.forward_branches(x, body_part)
+
+    def forward_trunk(self, x):
         # shared layers
         x = self.conv1(x)
         x = self.bn1(x)
@@ -162,51 +172,26 @@ class MultiBranchResNet101(BasicModule):
         x = self.layer1(x)
         x = self.layer2(x)
         x = self.layer3(x)
+        return x
 
-        # specific layers
-        out1 = Variable(t.FloatTensor())
-        for (xx, bp) in zip(x, body_part):
-            d = xx.unsqueeze(0).cuda()
-            d = getattr(self, f'layer4_{bp}')(d)
-            if out1.size():
-                out1 = t.cat([out1, d], dim=0)
-            else:
-                out1 = d
-
-        out2 = Variable(t.FloatTensor())
-        for (xx, bp) in zip(out1, body_part):
-            d = xx.unsqueeze(0).cuda()
-            d = getattr(self, f'avgpool_{bp}')(d)
-            if out2.size():
-                out2 = t.cat([out2, d], dim=0)
-            else:
-                out2 = d
-
-        out3 = Variable(t.FloatTensor())
-        for (xx, bp) in zip(out2, body_part):
-            d = xx.unsqueeze(0).cuda()
-            d = getattr(self, f'ada_pooling_{bp}')(d)
-            if out3.size():
-                out3 = t.cat([out3, d], dim=0)
-            else:
-                out3 = d
-
-        out4 = out3.view(out3.size(0), -1)
-        
-        out5 = Variable(t.FloatTensor())
-        for (xx, bp) in zip(out4, body_part):
-            d = xx.unsqueeze(0).cuda()
-            d = getattr(self, f'fc_{bp}')(d)
-            if out5.size():
-                out5 = t.cat([out5, d], dim=0)
-            else:
-                out5 = d
-
-        return out5
+    def forward_branches(self, x, body_part):
+        return self.route(x, body_part, self.forward_branch)
 
+    def forward_branch(self, bp, x):
+        """
+        一个部位的子 batch 经过该部位的 layer4 和 fc
+        """
+        # specific layers
+        x = getattr(self, f'layer4_{bp}')(x)
+        x = getattr(self, f'avgpool_{bp}')(x)
+        x = getattr(self, f'ada_pooling_{bp}')(x)
+        x = x.view(x.size(0), -1)
+        return getattr(self, f'fc_{bp}')(x)
 
 class MultiBranchResNet50(BasicModule):
 
+    trunk_names = ('conv1', 'bn1', 'relu', 'maxpool', 'layer1', 'layer2', 'layer3')
+
     def __init__(self, num_classes=2):
         model = models.resnet50(pretrained=True)
 
@@ -229,6 +214,11 @@ class MultiBranchResNet50(BasicModule):
             setattr(self, f'fc_{x}', nn.Linear(2048, num_classes))
 
     def forward(self, x, body_part):
+        if not self.use_cached_trunk:
+            x = self.forward_trunk(x)
+        return self.forward_branches(x, body_part)
+
+    def forward_trunk(self, x):
         # shared layers
         x = self.conv1(x)
         x = self.bn1(x)
@@ -238,44 +228,18 @@ class MultiBranchResNet50(BasicModule):
         x = self.layer1(x)
         x = self.layer2(x)
         x = self.layer3(x)
+        return x
 
+    def forward_branches(self, x, body_part):
+        return self.route(x, body_part, self.forward_branch)
+
+    def forward_branch(self, bp, x):
+        """
+        一个部位的子 batch 经过该部位的 layer4 和 fc
+        """
         # specific layers
-        out1 = Variable(t.FloatTensor())
-        for (xx, bp) in zip(x, body_part):
-            d = xx.unsqueeze(0).cuda()
-            d = getattr(self, f'layer4_{bp}')(d)
-            if out1.size():
-                out1 = t.cat([out1, d], dim=0)
-            else:
-                out1 = d
-
-        out2 = Variable(t.FloatTensor())
-        for (xx, bp) in zip(out1, body_part):
-            d = xx.unsqueeze(0).cuda()
-            d = getattr(self, f'avgpool_{bp}')(d)
-            if out2.size():
-                out2 = t.cat([out2, d], dim=0)
-            else:
-                out2 = d
-
-        out3 = Variable(t.FloatTensor())
-        for (xx, bp) in zip(out2, body_part):
-            d = xx.unsqueeze(0).cuda()
-            d = getattr(self, f'ada_pooling_{bp}')(d)
-            if out3.size():
-                out3 = t.cat([out3, d], dim=0)
-            else:
-                out3 = d
-
-        out4 = out3.view(out3.size(0), -1)
-        
-        out5 = Variable(t.FloatTensor())
-        for (xx, bp) in zip(out4, body_part):
-            d = xx.unsqueeze(0).cuda()
-            d = getattr(self, f'fc_{bp}')(d)
-            if out5.size():
-                out5 = t.cat([out5, d], dim=0)
-            else:
-                out5 = d
-
-        return out5
+        x = getattr(self, f'layer4_{bp}')(x)
+        x = getattr(self, f'avgpool_{bp}')(x)
+        x = getattr(self, f'ada_pooling_{bp}')(x)
+        x = x.view(x.size(0), -1)
+        return getattr(self, f'fc_{bp}')(x)
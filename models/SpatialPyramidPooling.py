@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import torch as t
+from torch import nn
+
+
+def pyramid_pooling_kernel(height, width, levels):
+    """
+    所有 level 的 bin 组成的平均池化矩阵，shape 为 (sum(n * n), height * width)
+
+    bin 的划分与 nn.AdaptiveAvgPool2d 相同：start = floor(i * size / n), end = ceil((i + 1) * size / n)，
+    size 不能被 n 整除时相邻的 bin 会重叠。
+    """
+    rows = []
+    for n in levels:
+        for i in range(n):
+            h0, h1 = (i * height) // n, -(-(i + 1) * height // n)
+            for j in range(n):
+                w0, w1 = (j * width) // n, -(-(j + 1) * width // n)
+                k = t.zeros(height, width)
+                k[h0:h1, w0:w1] = 1. / ((h1 - h0) * (w1 - w0))
+                rows.append(k.view(-1))
+    return t.stack(rows, 0)
+
+
+class _PyramidPoolingFunction(t.autograd.Function):
+    """
+    forward:  (N * C, H * W) x (H * W, bins)，一次 GEMM 读一遍 feature map 得到所有 level
+    backward: (N * C, bins) x (bins, H * W)，不需要保存输入
+    """
+
+    @staticmethod
+    def forward(ctx, x, kernel):
+        n, c, h, w = x.size()
+        ctx.save_for_backward(kernel)
+        ctx.input_size = x.size()
+        return x.reshape(n * c, h * w).mm(kernel.t()).view(n, c, -1)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        kernel, = ctx.saved_tensors
+        n, c, h, w = ctx.input_size
+        grad_input = grad_output.reshape(n * c, -1).mm(kernel).view(n, c, h, w)
+        return grad_input, None
+
+
+class SpatialPyramidPooling(nn.Module):
+    """
+    多尺度的 adaptive average pooling，结果与
+
+        t.cat([nn.AdaptiveAvgPool2d((n, n))(x).view(x.size(0), -1) for n in levels], 1)
+
+    相同，但只遍历一次 feature map，输出 shape 为 (batch_size, channels * sum(n * n))
+    """
+
+    def __init__(self, levels=(1, 2, 3, 4)):
+        super(SpatialPyramidPooling, self).__init__()
+        self.levels = tuple(levels)
+        # 不注册成 buffer，保证 state_dict 与使用 AdaptiveAvgPool2d 时一致
+        self._kernels = {}
+
+    def output_size(self, channels):
+        return channels * sum(n * n for n in self.levels)
+
+    def _kernel(self, height, width, device, dtype):
+        key = (height, width, device, dtype)
+        if key not in self._kernels:
+            self._kernels[key] = pyramid_pooling_kernel(height, width, self.levels).to(device=device, dtype=dtype)
+        return self._kernels[key]
+
+    def forward(self, x):
+        n, c, h, w = x.size()
+        out = _PyramidPoolingFunction.apply(x, self._kernel(h, w, x.device, x.dtype))
+
+        # (N, C, bins) -> 每个 level 按 (C, n, n) 展开后拼接，与原来的顺序一致
+        outs, offset = [], 0
+        for level in self.levels:
+            outs.append(out[:, :, offset:offset + level * level].reshape(n, -1))
+            offset += level * level
+        return t.cat(outs, 1)
+
+    def extra_repr(self):
+        return f'levels={self.levels}'
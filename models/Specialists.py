@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import time
+import importlib
+import torch as t
+
+from .BasicModule import BasicModule
+
+BODY_PARTS = ['XR_ELBOW', 'XR_FINGER', 'XR_FOREARM', 'XR_HAND', 'XR_HUMERUS', 'XR_SHOULDER', 'XR_WRIST']
+
+
+def _build(model_type):
+    return getattr(importlib.import_module(__package__), model_type)()
+
+
+class MultiBranchSpecialists(BasicModule):
+    """
+    每个部位一个单独训练的模型（python main.py train_specialists），与 MultiBranch 模型一样按部位路由：
+        forward(x, body_part)
+
+    checkpoint 中除了 state_dict 还保存了 model_type 和 parts，所以 MultiBranchSpecialists() 可以直接 load，
+    load 时才创建每个部位的模型
+    """
+
+    def __init__(self, model_type=None, parts=BODY_PARTS):
+        super(MultiBranchSpecialists, self).__init__()
+        self.model_type = model_type
+        self.parts = []
+        if model_type is not None:
+            for bp in parts:
+                self.add_specialist(bp, _build(model_type))
+
+    def add_specialist(self, bp, model):
+        setattr(self, f'specialist_{bp}', model)
+        if bp not in self.parts:
+            self.parts.append(bp)
+
+    @property
+    def fixed_input_size(self):
+        return any(getattr(self, f'specialist_{bp}').fixed_input_size for bp in self.parts)
+
+    def forward(self, x, body_part):
+        return self.route(x, body_part, self.forward_branch)
+
+    def forward_branch(self, bp, x):
+        if bp not in self.parts:
+            raise ValueError(f'no specialist for {bp}, this router only has {self.parts}')
+        return getattr(self, f'specialist_{bp}')(x)
+
+    def compile_model(self, **kwargs):
+        # 分别编译每个部位的模型，按部位分组在 eager 中完成
+        for bp in self.parts:
+            getattr(self, f'specialist_{bp}').compile_model(dynamic=True, **kwargs)
+        return self
+
+    def load(self, path):
+        checkpoint = t.load(path, map_location='cpu')
+        if not self.parts:
+            self.model_type = checkpoint['model_type']
+            for bp in checkpoint['parts']:
+                self.add_specialist(bp, _build(self.model_type))
+        self.conform_to(checkpoint['state_dict'])
+        self.load_state_dict(checkpoint['state_dict'])
+
+    def save(self, name=None):
+        if name is None:
+            name = time.strftime('checkpoints/' + self.model_name + '_%m%d_%H:%M:%S.pth')
+        t.save({'model_type': self.model_type, 'parts': self.parts, 'state_dict': self.state_dict()}, name)
+        return name
+
+    @staticmethod
+    def combine(model_type, paths, name=None):
+        """
+        paths: {部位: 该部位的模型的 checkpoint}，合并成一个 MultiBranchSpecialists 的 checkpoint，返回保存的路径
+        """
+        router = MultiBranchSpecialists()
+        router.model_type = model_type
+        for bp, path in sorted(paths.items()):
+            model = _build(model_type)
+            model.load(path)
+            router.add_specialist(bp, model)
+        return router.save(name)
+
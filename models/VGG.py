@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import re
 import math
 import copy
 import torch as t
@@ -10,7 +11,52 @@ from torchvision import models
 from torch.autograd import Variable
 
 
-class VGG19(BasicModule):
+class VGGHead(BasicModule):
+    """
+    VGG 的 classifier 的输入：
+        pooled_head = False   把 512 x 10 x 10 的 feature map 展开，第一层为 Linear(51200, 4096)，约 2 亿参数
+        pooled_head = True    global average pooling 之后为 512 维，第一层为 Linear(512, 4096)
+    两者 classifier 的结构和 state_dict 的 key 相同，只有 classifier 第一层 weight 的 shape 不同
+    """
+
+    pooled_head = False
+
+    @property
+    def fixed_input_size(self):
+        return not self.pooled_head
+
+    @property
+    def head_features(self):
+        return 512 if self.pooled_head else 512 * 10 * 10
+
+    def flatten(self, x):
+        if self.pooled_head:
+            x = F.adaptive_avg_pool2d(x, 1)
+        return x.reshape(x.size(0), -1)
+
+    def load(self, path):
+        """
+        pooled head 的模型可以直接加载原来 dense head 的 checkpoint，见 pooled_state_dict
+        """
+        state_dict = t.load(path, map_location='cpu')
+        if self.pooled_head:
+            state_dict = pooled_state_dict(state_dict)
+        self.load_state_dict(state_dict)
+
+
+def pooled_state_dict(state_dict, channels=512):
+    """
+    把 dense head 的 checkpoint 转换成 pooled head：classifier 第一层 W (4096, C * H * W) 在空间位置上求和，
+    得到 (4096, C)。feature map 在空间上为常数时两者输出相同，其余层原样保留
+    """
+    state_dict = dict(state_dict)
+    for key, weight in state_dict.items():
+        if re.match(r'^classifier\w*\.0\.weight$', key) and weight.size(1) > channels:
+            state_dict[key] = weight.view(weight.size(0), channels, -1).sum(2)
+    return state_dict
+
+
+class VGG19(VGGHead):
 
     def __init__(self, num_classes=2):
         model = models.vgg19(pretrained=True)
@@ -20,7 +66,7 @@ class VGG19(BasicModule):
         self.features = nn.Sequential(*list(model.features.children()))
 
         self.classifier = nn.Sequential(
-            nn.Linear(512 * 10 * 10, 4096),
+            nn.Linear(self.head_features, 4096),
             nn.ReLU(True),
             nn.Dropout(),
             nn.Linear(4096, 4096),
@@ -31,12 +77,12 @@ class VGG19(BasicModule):
 
     def forward(self, x):
         x = self.features(x)
-        x = x.view(x.size(0), -1)
+        x = self.flatten(x)
         x = self.classifier(x)
         return x
 
 
-class VGG16(BasicModule):
+class VGG16(VGGHead):
 
     def __init__(self, num_classes=2):
         model = models.vgg16(pretrained=True)
@@ -46,7 +92,7 @@ class VGG16(BasicModule):
         self.features = nn.Sequential(*list(model.features.children()))
 
         self.classifier = nn.Sequential(
-            nn.Linear(512 * 10 * 10, 4096),
+            nn.Linear(self.head_features, 4096),
             nn.ReLU(True),
             nn.Dropout(),
             nn.Linear(4096, 4096),
@@ -57,16 +103,17 @@ class VGG16(BasicModule):
 
     def forward(self, x):
         x = self.features(x)
-        x = x.view(x.size(0), -1)
+        x = self.flatten(x)
         x = self.classifier(x)
         return x
 
 
-class MultiBranchVGG19(BasicModule):
+class MultiBranchVGG19(VGGHead):
+
+    trunk_names = ('features_shared',)
 
     def __init__(self, num_classes=2):
         model = models.vgg19(pretrained=True)
-        model.cuda()
 
         super(MultiBranchVGG19, self).__init__()
 
@@ -77,7 +124,7 @@ class MultiBranchVGG19(BasicModule):
         for x in ['XR_ELBOW', 'XR_FINGER', 'XR_FOREARM', 'XR_HAND', 'XR_HUMERUS', 'XR_SHOULDER', 'XR_WRIST']:
             setattr(self, f'features_specific_{x}', copy.deepcopy(nn.Sequential(*list(model.features.children())[28:])))
             setattr(self, f'classifier_{x}', nn.Sequential(
-                                                nn.Linear(512 * 10 * 10, 4096),
+                                                nn.Linear(self.head_features, 4096),
                                                 nn.ReLU(True),
                                                 nn.Dropout(),
                                                 nn.Linear(4096, 4096),
@@ -88,37 +135,30 @@ class MultiBranchVGG19(BasicModule):
                                             ))
 
     def forward(self, x, body_part):
-        x = self.features_shared(x)
-
-        out1 = Variable(t.FloatTensor())
-        for (xx, bp) in zip(x, body_part):
-            d = xx.unsqueeze(0).cuda()
-            d = getattr(self, f'features_specific_{bp}')(d)
-            if out1.size():
-                out1 = t.cat([out1, d], dim=0)
-            else:
-                out1 = d
+        if not self.use_cached_trunk:
+            x = self.forward_trunk(x)
+        return self.forward_branches(x, body_part)
 
-        out1 = out1.view(out1.size(0), -1)
+    def forward_trunk(self, x):
+        return self.features_shared(x)
 
-        out2 = Variable(t.FloatTensor(), requires_grad=True)
-        for (xx, bp) in zip(out1, body_part):
-            xx = xx.cuda()
-            xx = getattr(self, f'classifier_{bp}')(xx)
-            d = xx.unsqueeze(0)
-            if out2.size():
-                out2 = t.cat([out2, d], dim=0)
-            else:
-                out2 = d
+    def forward_branches(self, x, body_part):
+        return self.route(x, body_part, self.forward_branch)
 
-        return out2
+    def forward_branch(self, bp, x):
+        """
+        一个部位的子 batch 经过该部位的 features 和 classifier
+        """
+        x = getattr(self, f'features_specific_{bp}')(x)
+        x = self.flatten(x)
+        return getattr(self, f'classifier_{bp}')(x)
 
+class MultiBranchVGG16(VGGHead):
 
-class MultiBranchVGG16(BasicModule):
+    trunk_names = ('features_shared',)
 
     def __init__(self, num_classes=2):
         model = models.vgg16(pretrained=True)
-        model.cuda()
 
         super(MultiBranchVGG16, self).__init__()
 
@@ -129,7 +169,7 @@ class MultiBranchVGG16(BasicModule):
         for x in ['XR_ELBOW', 'XR_FINGER', 'XR_FOREARM', 'XR_HAND', 'XR_HUMERUS', 'XR_SHOULDER', 'XR_WRIST']:
             # setattr(self, f'features_specific_{x}', copy.deepcopy(nn.Sequential(*list(model.features.children())[28:])))
             setattr(self, f'classifier_{x}', nn.Sequential(
-                                                nn.Linear(512 * 10 * 10, 4096),
+                                                nn.Linear(self.head_features, 4096),
                                                 nn.ReLU(True),
                                                 nn.Dropout(),
                                                 # nn.Linear(4096, 4096),
@@ -140,29 +180,35 @@ class MultiBranchVGG16(BasicModule):
                                             ))
 
     def forward(self, x, body_part):
-        x = self.features_shared(x)
-
-        # out1 = Variable(t.FloatTensor())
-        # for (xx, bp) in zip(x, body_part):
-        #     d = xx.unsqueeze(0).cuda()
-        #     d = getattr(self, f'features_specific_{bp}')(d)
-        #     if out1.size():
-        #         out1 = t.cat([out1, d], dim=0)
-        #     else:
-        #         out1 = d
-
-        # out1 = out1.view(out1.size(0), -1)
-
-        out1 = x.view(x.size(0), -1)
-
-        out2 = Variable(t.FloatTensor(), requires_grad=True)
-        for (xx, bp) in zip(out1, body_part):
-            xx = xx.cuda()
-            xx = getattr(self, f'classifier_{bp}')(xx)
-            d = xx.unsqueeze(0)
-            if out2.size():
-                out2 = t.cat([out2, d], dim=0)
-            else:
-                out2 = d
-
-        return out2
\ No newline at end of file
+        if not self.use_cached_trunk:
+            x = self.forward_trunk(x)
+        return self.forward_branches(x, body_part)
+
+    def forward_trunk(self, x):
+        return self.features_shared(x)
+
+    def forward_branches(self, x, body_part):
+        return self.route(x, body_part, self.forward_branch)
+
+    def forward_branch(self, bp, x):
+        """
+        一个部位的子 batch 经过该部位的 classifier
+        """
+        x = self.flatten(x)
+        return getattr(self, f'classifier_{bp}')(x)
+
+
+class VGG19Pooled(VGG19):
+    pooled_head = True
+
+
+class VGG16Pooled(VGG16):
+    pooled_head = True
+
+
+class MultiBranchVGG19Pooled(MultiBranchVGG19):
+    pooled_head = True
+
+
+class MultiBranchVGG16Pooled(MultiBranchVGG16):
+    pooled_head = True
@@ -2,5 +2,7 @@
 
 from .DenseNet import DenseNet169, CustomDenseNet169, MultiBranchDenseNet169
 from .ResNet import ResNet34, ResNet152, MultiBranchResNet101, MultiBranchResNet50
-from .VGG import VGG19, VGG16, MultiBranchVGG19, MultiBranchVGG16
-
+from .VGG import VGG19, VGG16, MultiBranchVGG19, MultiBranchVGG16, \
+    VGG19Pooled, VGG16Pooled, MultiBranchVGG19Pooled, MultiBranchVGG16Pooled
+from .SpatialPyramidPooling import SpatialPyramidPooling
+from .Specialists import MultiBranchSpecialists
@@ -7,7 +7,6 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
 
 
 class FocalLoss(nn.Module):
@@ -19,84 +18,96 @@ class FocalLoss(nn.Module):
 
         The losses are averaged across observations for each minibatch.
         Args:
-            alpha(1D Tensor, Variable) : the scalar factor for this criterion
+            alpha(1D or 2D Tensor) : the scalar factor for this criterion. A tensor of shape (class_num,)
+                                     (or (class_num, 1)) weights each class; a tensor of shape
+                                     (len(parts), class_num) weights each class separately per body part,
+                                     and forward then needs body_part.
             gamma(float, double) : gamma > 0; reduces the relative loss for well-classiﬁed examples (p > .5),
                                    putting more focus on hard, misclassiﬁed examples
             size_average(bool): size_average(bool): By default, the losses are averaged over observations for each minibatch.
                                 However, if the field size_average is set to False, the losses are
                                 instead summed for each minibatch.
+            reduce(bool): if False, returns the loss of every observation and ignores size_average.
+            parts(list of str): body part names indexing the first dimension of a 2D alpha.
+
+        log p is taken with log_softmax in float32 and gathered at the target class, so the loss is
+        finite for fp16/bf16 logits. alpha is a buffer and follows .to(device) / .cuda().
     """
 
-    def __init__(self, class_num, alpha=None, gamma=2, size_average=True):
+    def __init__(self, class_num, alpha=None, gamma=2, size_average=True, reduce=True, parts=None):
         super(FocalLoss, self).__init__()
         if alpha is None:
-            self.alpha = Variable(torch.ones(class_num, 1))
-        else:
-            if isinstance(alpha, Variable):
-                self.alpha = alpha
-            else:
-                self.alpha = Variable(alpha)
+            alpha = torch.ones(class_num)
+        alpha = torch.as_tensor(alpha, dtype=torch.float32)
+        if alpha.dim() == 2 and alpha.size(1) == 1:
+            # the original interface took a (class_num, 1) column
+            alpha = alpha.view(-1)
+        if alpha.dim() == 2 and parts is None:
+            raise ValueError('a per body part alpha of shape {} needs parts'.format(tuple(alpha.size())))
+
+        self.register_buffer('alpha', alpha)
         self.gamma = gamma
         self.class_num = class_num
         self.size_average = size_average
+        self.reduce = reduce
+        self.parts = list(parts) if parts is not None else None
+
+    def _part_index(self, body_part, device):
+        if torch.is_tensor(body_part):
+            return body_part.to(device=device, dtype=torch.long)
+        return torch.tensor([self.parts.index(bp) for bp in body_part], dtype=torch.long, device=device)
+
+    def forward(self, inputs, targets, body_part=None):
+        targets = targets.view(-1, 1)
+
+        log_p = F.log_softmax(inputs.float(), dim=1).gather(1, targets).view(-1)
+        # 1 - exp(log_p) loses all precision as p -> 1, expm1 does not
+        one_minus_p = (-torch.expm1(log_p)).clamp(min=0)
+
+        targets = targets.view(-1)
+        if self.alpha.dim() == 2:
+            if body_part is None:
+                raise ValueError('FocalLoss with a per body part alpha needs body_part')
+            alpha = self.alpha[self._part_index(body_part, targets.device), targets]
+        else:
+            alpha = self.alpha[targets]
 
-    def forward(self, inputs, targets):
-        N = inputs.size(0)
-        # print(N)
-        C = inputs.size(1)
-        P = F.softmax(inputs)
-
-        class_mask = inputs.data.new(N, C).fill_(0)
-        class_mask = Variable(class_mask)
-        ids = targets.view(-1, 1)
-        class_mask.scatter_(1, ids.data, 1.)
-        # print(class_mask)
-
-        if inputs.is_cuda and not self.alpha.is_cuda:
-            self.alpha = self.alpha.cuda()
-        alpha = self.alpha[ids.data.view(-1)]
-
-        probs = (P * class_mask).sum(1).view(-1, 1)
-
-        log_p = probs.log()
-        # print('probs size= {}'.format(probs.size()))
-        # print(probs)
-
-        batch_loss = -alpha * (torch.pow((1 - probs), self.gamma)) * log_p
-        # print('-----bacth_loss------')
-        # print(batch_loss)
+        if self.gamma == 0:
+            batch_loss = -alpha * log_p
+        else:
+            batch_loss = -alpha * one_minus_p.pow(self.gamma) * log_p
 
+        if not self.reduce:
+            return batch_loss
         if self.size_average:
-            loss = batch_loss.mean()
-        else:
-            loss = batch_loss.sum()
-        return loss
+            return batch_loss.mean()
+        return batch_loss.sum()
 
 
 if __name__ == "__main__":
-    alpha = torch.rand(21, 1)
-    print(alpha)
     FL = FocalLoss(class_num=5, gamma=0)
     CE = nn.CrossEntropyLoss()
     N = 4
     C = 5
     inputs = torch.rand(N, C)
     targets = torch.LongTensor(N).random_(C)
-    inputs_fl = Variable(inputs.clone(), requires_grad=True)
-    targets_fl = Variable(targets.clone())
-
-    inputs_ce = Variable(inputs.clone(), requires_grad=True)
-    targets_ce = Variable(targets.clone())
+    inputs_fl = inputs.clone().requires_grad_()
+    inputs_ce = inputs.clone().requires_grad_()
     print('----inputs----')
     print(inputs)
     print('---target-----')
     print(targets)
 
-    fl_loss = FL(inputs_fl, targets_fl)
-    ce_loss = CE(inputs_ce, targets_ce)
-    print('ce = {}, fl ={}'.format(ce_loss.data[0], fl_loss.data[0]))
+    # with gamma=0 and alpha=1 focal loss equals cross entropy
+    fl_loss = FL(inputs_fl, targets)
+    ce_loss = CE(inputs_ce, targets)
+    print('ce = {}, fl ={}'.format(ce_loss.item(), fl_loss.item()))
     fl_loss.backward()
     ce_loss.backward()
-    # print(inputs_fl.grad.data)
+    print(inputs_fl.grad.data)
     print(inputs_ce.grad.data)
 
+    # per body part alpha
+    parts = ['XR_HAND', 'XR_WRIST']
+    FL = FocalLoss(class_num=2, alpha=torch.rand(2, 2), parts=parts)
+    print(FL(torch.randn(N, 2).half(), torch.LongTensor(N).random_(2), ['XR_HAND', 'XR_WRIST', 'XR_WRIST', 'XR_HAND']))
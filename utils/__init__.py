@@ -2,3 +2,9 @@
 
 from .visualize import Visualizer
 from .FocalLoss import FocalLoss
+from .profiler import Profiler
+from .prediction_cache import PredictionCache, file_hash, softmax
+from .schedule import LRSchedule, EarlyStopping, CheckpointKeeper
+from . import ensemble_search
+from . import pruning
+from .tta import TestTimeAugmentation
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import time
+import itertools
+import numpy as np
+
+
+def weight_grid(num_models, step=0.1):
+    """
+    单纯形上间隔为 step 的所有权重，和为 1；权重为 0 即不使用该模型，所以同时枚举了所有的模型子集
+    返回 shape 为 (K, num_models)
+    """
+    n = int(round(1. / step))
+    weights = []
+    # stars and bars: 在 n + num_models - 1 个位置中选 num_models - 1 个隔板
+    for bars in itertools.combinations(range(n + num_models - 1), num_models - 1):
+        edges = (-1,) + bars + (n + num_models - 1,)
+        weights.append([edges[i + 1] - edges[i] - 1 for i in range(num_models)])
+    return np.array(weights, dtype=np.float64) / n
+
+
+def study_index(imgs, root, parts):
+    """
+    图片 -> study 的映射，以及每个 study 的 label 和部位
+    返回 (每张图片的 study 序号, study 文件夹路径, study label, study 部位序号)
+    """
+    studies, index = [], {}
+    img_study = np.empty(len(imgs), dtype=np.int64)
+    for i, path in enumerate(imgs):
+        folder_path = path[:path.rfind('/')]
+        if folder_path not in index:
+            index[folder_path] = len(studies)
+            studies.append(folder_path)
+        img_study[i] = index[folder_path]
+
+    labels = np.array([1 if k.split('_')[-1] == 'positive' else 0 for k in studies])
+    study_part = np.array([parts.index(k[len(root):].split('/')[2]) for k in studies])
+    return img_study, studies, labels, study_part
+
+
+def study_means(probs, img_study, num_studies):
+    """
+    probs: (M, 图片数) -> (M, study 数)，与 main.study_probabilities 相同取平均
+    """
+    counts = np.bincount(img_study, minlength=num_studies)
+    sums = np.stack([np.bincount(img_study, weights=p, minlength=num_studies) for p in probs], 0)
+    return sums / counts
+
+
+def kappa_table(study_probs, labels, study_part, num_parts, thresholds):
+    """
+    study_probs: (K, S)，返回 (K, 阈值数, 部位数) 的 cohen kappa
+
+    与 main.study_kappa 一致：概率（第 0 类，negative）小于阈值时预测为 positive
+    """
+    onehot = np.zeros((study_probs.shape[1], num_parts))
+    onehot[np.arange(len(study_part)), study_part] = 1
+    n = onehot.sum(0)                                   # (P,)
+    n_true = (onehot * labels[:, None]).sum(0)          # (P,)
+
+    pred = (study_probs[:, None, :] < thresholds[None, :, None]).astype(np.float64)    # (K, L, S)
+    n_pred = pred @ onehot                                                              # (K, L, P)
+    tp = pred @ (onehot * labels[:, None])                                              # (K, L, P)
+    tn = n - n_pred - n_true + tp
+
+    n = np.maximum(n, 1)
+    po = (tp + tn) / n
+    pe = (n_pred * n_true + (n - n_pred) * (n - n_true)) / (n * n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        kappa = np.where(pe < 1, (po - pe) / (1 - pe), 0.)
+    return kappa
+
+
+def search(probs, imgs, root, parts, weights, thresholds, chunk_elements=2 ** 24):
+    """
+    在所有 (权重, 每个部位的阈值) 组合中寻找 study 级别平均 kappa 最大的组合
+
+    probs: (M, 图片数)，每个模型的第 0 类概率；weights: (K, M)；thresholds: (L,)
+    返回 dict: weights, thresholds (每个部位), kappa (每个部位), mean_kappa, 以及速度
+    """
+    start = time.perf_counter()
+    img_study, studies, labels, study_part = study_index(imgs, root, parts)
+    present = sorted(set(study_part.tolist()))
+    model_study_probs = study_means(np.asarray(probs, dtype=np.float64), img_study, len(studies))   # (M, S)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+
+    # 取平均是线性的，所以 ensemble 的 study 概率 = 权重 x 每个模型的 study 概率
+    chunk = max(1, chunk_elements // (len(thresholds) * len(studies)))
+    best = None
+    for i in range(0, len(weights), chunk):
+        w = weights[i:i + chunk]
+        kappa = kappa_table(w @ model_study_probs, labels, study_part, len(parts), thresholds)   # (k, L, P)
+        best_t = kappa.argmax(1)                                                                  # (k, P)
+        best_kappa = kappa.max(1)[:, present]                                                     # (k, P')
+        score = best_kappa.mean(1)
+        j = int(score.argmax())
+        if best is None or score[j] > best['mean_kappa']:
+            best = {
+                'weights': w[j].tolist(),
+                'thresholds': {parts[p]: float(thresholds[best_t[j, p]]) for p in present},
+                'kappa': {parts[p]: float(kappa[j, best_t[j, p], p]) for p in present},
+                'mean_kappa': float(score[j]),
+            }
+
+    elapsed = time.perf_counter() - start
+    best['combinations'] = int(len(weights) * len(thresholds) ** len(present))
+    best['weight_vectors'] = len(weights)
+    best['seconds'] = elapsed
+    best['weight_vectors_per_s'] = len(weights) / elapsed
+    return best
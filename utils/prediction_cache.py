@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import numpy as np
+
+
+def file_hash(path, cache_dir=None):
+    """
+    checkpoint 文件内容的 sha1，按 (路径, 大小, 修改时间) 记录在 cache_dir/hashes.json 中，文件不变时不重新计算
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    signature = [stat.st_size, stat.st_mtime]
+
+    hashes, hashes_file = {}, None
+    if cache_dir is not None:
+        hashes_file = os.path.join(cache_dir, 'hashes.json')
+        if os.path.exists(hashes_file):
+            with open(hashes_file) as F:
+                hashes = json.load(F)
+        if path in hashes and hashes[path][:2] == signature:
+            return hashes[path][2]
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as F:
+        for chunk in iter(lambda: F.read(1 << 20), b''):
+            sha1.update(chunk)
+    digest = sha1.hexdigest()
+
+    if hashes_file is not None:
+        hashes[path] = signature + [digest]
+        with open(hashes_file, 'w') as F:
+            json.dump(hashes, F, indent=1)
+    return digest
+
+
+def softmax(logits):
+    logits = np.asarray(logits, dtype=np.float64)
+    e = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+class PredictionCache(object):
+    """
+    每张图片的 logits，按 (模型, checkpoint 内容的 hash, transform) 保存在一个 npz 文件中：
+
+        cache_dir/{model_type}_{sha1[:16]}_{transform_key}.npz    imgs: 图片路径, logits: (N, num_classes)
+
+    换阈值、换聚合方式、换 ensemble 的组合时不需要重新跑模型，只需要读 cache。
+    """
+
+    def __init__(self, cache_dir, model_type, model_path, transform_key):
+        # 没有 checkpoint 时 classifier 是随机初始化的，每次结果都不同，不能 cache
+        if model_path is None:
+            raise ValueError(f'prediction cache of {model_type} needs a checkpoint, set --load_model_path')
+        if cache_dir is None or transform_key is None:
+            raise ValueError('prediction cache needs prediction_cache_dir and a dataset with a known transform_key')
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.key = f'{model_type}_{file_hash(model_path, cache_dir)[:16]}_{transform_key}'
+        self.path = os.path.join(cache_dir, self.key + '.npz')
+
+        self.logits = {}
+        if os.path.exists(self.path):
+            d = np.load(self.path)
+            self.logits = dict(zip(d['imgs'].tolist(), d['logits']))
+        self._dirty = False
+
+    @staticmethod
+    def open(cache_dir, model_type, model_path, transform_key):
+        """
+        不能 cache 时返回 None：没有 checkpoint（classifier 是随机初始化的）或者 transform 不确定
+        """
+        if cache_dir is None or model_path is None or transform_key is None:
+            return None
+        return PredictionCache(cache_dir, model_type, model_path, transform_key)
+
+    def missing(self, imgs):
+        return [img for img in imgs if img not in self.logits]
+
+    def update(self, logits):
+        """
+        logits: dict 图片路径 -> logits
+        """
+        if logits:
+            self.logits.update(logits)
+            self._dirty = True
+
+    def get(self, imgs):
+        """
+        返回 imgs 的 logits，shape 为 (len(imgs), num_classes)
+        """
+        missing = self.missing(imgs)
+        if missing:
+            raise KeyError(f'{len(missing)} images are not in {self.path}, e.g. {missing[0]}')
+        return np.stack([self.logits[img] for img in imgs], 0)
+
+    def probabilities(self, imgs):
+        """
+        与 test() 相同，返回 softmax 之后第 0 类的概率
+        """
+        return softmax(self.get(imgs))[:, 0]
+
+    def save(self):
+        if not self._dirty:
+            return
+        imgs = list(self.logits.keys())
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as F:
+            np.savez(F, imgs=np.array(imgs), logits=np.stack([self.logits[img] for img in imgs], 0))
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+    def __len__(self):
+        return len(self.logits)
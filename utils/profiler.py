@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch as t
+
+
+class Profiler(object):
+    """
+    按名字统计训练/测试循环中各个阶段的耗时和计数
+
+    prof = Profiler(enabled=True)
+    prof.start('data')
+    for batch in dataloader:
+        prof.stop('data')
+        with prof.stage('forward'):
+            ...
+        prof.step()
+        prof.start('data')
+
+    enabled=False 时所有方法直接返回，开销只有一次属性判断。
+    trace_steps=(start, end) 时在第 start 到 end 个 step 之间用 torch.profiler 记录 trace，保存到 trace_dir。
+    """
+
+    def __init__(self, enabled=False, trace_steps=None, trace_dir='tmp/profile', use_gpu=False, name='train'):
+        self.enabled = enabled
+        self.trace_steps = tuple(trace_steps) if trace_steps else None
+        self.trace_dir = trace_dir
+        self.use_gpu = use_gpu
+        self.name = name
+
+        self.steps = 0
+        self.window_steps = 0
+        self.window_start = time.perf_counter()
+        self.times = OrderedDict()
+        self.counts = OrderedDict()
+        self._started = {}
+        self._trace = None
+
+    def _sync(self):
+        # GPU 是异步执行的，不同步的话时间会算到下一个阶段上
+        if self.use_gpu:
+            t.cuda.synchronize()
+
+    def start(self, name):
+        if not self.enabled:
+            return
+        self._sync()
+        self._started[name] = time.perf_counter()
+
+    def stop(self, name):
+        if not self.enabled or name not in self._started:
+            return
+        self._sync()
+        elapsed = time.perf_counter() - self._started.pop(name)
+        self.times[name] = self.times.get(name, 0.) + elapsed
+
+    @contextmanager
+    def _stage(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def stage(self, name):
+        """
+        with prof.stage('forward'): ...
+        """
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._stage(name)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def step(self):
+        """
+        每个 batch 结束时调用，负责 torch.profiler 的开始和结束
+        """
+        if not self.enabled:
+            return
+        self.steps += 1
+        self.window_steps += 1
+
+        if self.trace_steps is None:
+            return
+        if self.steps == self.trace_steps[0] and self._trace is None:
+            activities = [t.profiler.ProfilerActivity.CPU]
+            if self.use_gpu:
+                activities.append(t.profiler.ProfilerActivity.CUDA)
+            self._trace = t.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self._trace.__enter__()
+        elif self.steps == self.trace_steps[1] and self._trace is not None:
+            self._stop_trace()
+
+    def _stop_trace(self):
+        self._trace.__exit__(None, None, None)
+        if not os.path.exists(self.trace_dir):
+            os.makedirs(self.trace_dir)
+        path = os.path.join(self.trace_dir, f'{self.name}_step{self.trace_steps[0]}-{self.steps}.json')
+        self._trace.export_chrome_trace(path)
+        print('profiler trace saved to', path)
+        self._trace = None
+
+    def summary(self, reset=True):
+        """
+        返回当前窗口内每个阶段的平均耗时（ms/step）和占比，reset=True 时开始新的窗口
+        """
+        if not self.enabled:
+            return ''
+        wall = time.perf_counter() - self.window_start
+        steps = max(self.window_steps, 1)
+        items = [f'{self.name} {self.window_steps} steps, {1000. * wall / steps:.1f} ms/step']
+        for name, seconds in self.times.items():
+            items.append(f'{name} {1000. * seconds / steps:.1f}ms ({100. * seconds / max(wall, 1e-9):.0f}%)')
+        for name, n in self.counts.items():
+            items.append(f'{name}={n}')
+
+        if reset:
+            self.times.clear()
+            self.counts.clear()
+            self.window_steps = 0
+            self.window_start = time.perf_counter()
+        return ' | '.join(items)
+
+    def close(self):
+        if self._trace is not None:
+            self._stop_trace()
+
+
+class _NullContext(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_CONTEXT = _NullContext()
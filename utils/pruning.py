@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import time
+import torch as t
+from torch import nn
+from torchvision.models.densenet import _DenseLayer
+from torchvision.models.resnet import Bottleneck
+
+
+def _keep_indices(bn, ratio, multiple=8):
+    """
+    按 BatchNorm 的 |gamma| 从大到小保留 (1 - ratio) 的 channel，数量取 multiple 的倍数（至少 multiple 个）
+    """
+    n = bn.num_features
+    keep = max(multiple, int(round(n * (1 - ratio) / multiple)) * multiple)
+    if keep >= n:
+        return None
+    return bn.weight.detach().abs().argsort(descending=True)[:keep].sort().values
+
+
+def _prune_conv(conv, out_index=None, in_index=None):
+    weight = conv.weight.detach()
+    if out_index is not None:
+        weight = weight[out_index]
+    if in_index is not None:
+        weight = weight[:, in_index]
+    new = nn.Conv2d(weight.size(1), weight.size(0), conv.kernel_size, conv.stride, conv.padding, conv.dilation,
+                    bias=conv.bias is not None).to(weight.device)
+    new.weight.data.copy_(weight)
+    if conv.bias is not None:
+        new.bias.data.copy_(conv.bias.detach() if out_index is None else conv.bias.detach()[out_index])
+    return new
+
+
+def _prune_bn(bn, index):
+    new = nn.BatchNorm2d(len(index), bn.eps, bn.momentum, bn.affine, bn.track_running_stats).to(bn.weight.device)
+    for name in ['weight', 'bias', 'running_mean', 'running_var']:
+        getattr(new, name).data.copy_(getattr(bn, name).detach()[index])
+    new.num_batches_tracked = bn.num_batches_tracked.clone()
+    return new
+
+
+def _prune_pair(conv_in, bn, conv_out, ratio):
+    """
+    conv_in -> bn -> (relu) -> conv_out 中间的 channel：删除 conv_in 的输出、bn 和 conv_out 的输入中相同的 channel
+    返回新的三个 module，没有可以删除的 channel 时返回 None
+    """
+    if conv_in.groups != 1 or conv_out.groups != 1:
+        return None
+    index = _keep_indices(bn, ratio)
+    if index is None:
+        return None
+    return _prune_conv(conv_in, out_index=index), _prune_bn(bn, index), _prune_conv(conv_out, in_index=index)
+
+
+def prune_model(model, ratio):
+    """
+    结构化地删除每个 block 内部的 channel（in-place 修改 model），返回删除前后的 channel 数
+
+        DenseNet _DenseLayer:       conv1 -> norm2 -> conv2 之间的 bottleneck channel（bn_size * growth_rate）
+        ResNet Bottleneck:          conv1 -> bn1 -> conv2 和 conv2 -> bn2 -> conv3 之间的 channel
+        ResNet34 的 ResidualBlock:  left 中两个 3x3 conv 之间的 channel
+
+    block 的输入输出 channel（concat、residual 相加的部分）不变，所以不需要修改其他层
+    """
+    report = {'before': 0, 'after': 0}
+
+    def count(before, after):
+        report['before'] += before
+        report['after'] += after
+
+    for module in model.modules():
+        if isinstance(module, _DenseLayer):
+            pruned = _prune_pair(module.conv1, module.norm2, module.conv2, ratio)
+            if pruned is not None:
+                count(module.norm2.num_features, pruned[1].num_features)
+                module.conv1, module.norm2, module.conv2 = pruned
+        elif isinstance(module, Bottleneck):
+            for conv_in, bn, conv_out in [('conv1', 'bn1', 'conv2'), ('conv2', 'bn2', 'conv3')]:
+                pruned = _prune_pair(getattr(module, conv_in), getattr(module, bn), getattr(module, conv_out), ratio)
+                if pruned is not None:
+                    count(getattr(module, bn).num_features, pruned[1].num_features)
+                    setattr(module, conv_in, pruned[0])
+                    setattr(module, bn, pruned[1])
+                    setattr(module, conv_out, pruned[2])
+        elif type(module).__name__ == 'ResidualBlock':
+            left = module.left
+            pruned = _prune_pair(left[0], left[1], left[3], ratio)
+            if pruned is not None:
+                count(left[1].num_features, pruned[1].num_features)
+                left[0], left[1], left[3] = pruned
+    return report
+
+
+def count_macs(model, x, body_part=None):
+    """
+    一次 forward 中 Conv2d 和 Linear 的乘加次数（MACs）
+    """
+    total = [0]
+
+    def conv_hook(module, inputs, output):
+        kh, kw = module.kernel_size
+        total[0] += output.numel() * (module.in_channels // module.groups) * kh * kw
+
+    def linear_hook(module, inputs, output):
+        total[0] += output.numel() * module.in_features
+
+    handles = []
+    for module in model.modules():
+        if isinstance(module, nn.Conv2d):
+            handles.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.Linear):
+            handles.append(module.register_forward_hook(linear_hook))
+    try:
+        with t.no_grad():
+            model.eval()
+            model(x) if body_part is None else model(x, body_part)
+    finally:
+        for h in handles:
+            h.remove()
+    return total[0]
+
+
+def latency(model, x, body_part=None, repeat=10):
+    """
+    一个 batch 的平均推理时间（秒）
+    """
+    model.eval()
+    with t.no_grad():
+        run = (lambda: model(x)) if body_part is None else (lambda: model(x, body_part))
+        run()
+        if x.is_cuda:
+            t.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            run()
+        if x.is_cuda:
+            t.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat
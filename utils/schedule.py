@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import math
+
+POLICIES = ('loss', 'plateau', 'cosine', 'onecycle')
+
+
+class LRSchedule(object):
+    """
+    学习率策略，直接修改 optimizer.param_groups 中的 lr：
+
+        loss       原来的方法：一个 epoch 的训练 loss 比上一个 epoch 大时 lr = lr * decay
+        plateau    验证集 study kappa 连续 patience 个 epoch 没有提高时 lr = lr * decay
+        cosine     每个 batch 按 cosine 从 base_lr 降到 min_lr
+        onecycle   前 30% 从 base_lr / 25 按 cosine 升到 base_lr，之后按 cosine 降到 min_lr
+
+    warmup_epochs > 0 时前 warmup_epochs 个 epoch 从 0 线性增加到 base_lr（onecycle 自带 warmup，不使用）。
+    每个 batch 调用 step_batch(epoch, ii, num_batches)，每个 epoch 结束时调用 step_epoch(train_loss, val_kappa)
+    """
+
+    def __init__(self, optimizer, policy='loss', base_lr=1e-4, epochs=20, warmup_epochs=0, decay=0.5, patience=2,
+                 min_lr=0.):
+        if policy not in POLICIES:
+            raise ValueError(f'unknown lr policy {policy}, choose from {POLICIES}')
+        self.optimizer = optimizer
+        self.policy = policy
+        self.base_lr = base_lr
+        self.epochs = epochs
+        self.warmup_epochs = warmup_epochs if policy != 'onecycle' else 0
+        self.decay = decay
+        self.patience = patience
+        self.min_lr = min_lr
+
+        # loss / plateau 的当前 lr 和状态
+        self.epoch_lr = base_lr
+        self.previous_loss = float('inf')
+        self.best_metric = -float('inf')
+        self.bad_epochs = 0
+        self.lr = base_lr
+        self._set(self._lr(0.))
+
+    def _set(self, lr):
+        self.lr = lr
+        for param_group in self.optimizer.param_groups:
+            param_group['lr'] = lr
+
+    def _lr(self, epoch):
+        """
+        epoch: 带小数的训练进度，例如第 3 个 epoch 的一半为 2.5
+        """
+        if epoch < self.warmup_epochs:
+            return self.base_lr * (epoch + 1e-3) / self.warmup_epochs
+
+        if self.policy in ('loss', 'plateau'):
+            return self.epoch_lr
+
+        progress = min(1., (epoch - self.warmup_epochs) / max(1e-9, self.epochs - self.warmup_epochs))
+        if self.policy == 'cosine':
+            return self.min_lr + (self.base_lr - self.min_lr) * (1 + math.cos(math.pi * progress)) / 2
+
+        # onecycle
+        start_lr, peak = self.base_lr / 25, 0.3
+        if progress < peak:
+            return start_lr + (self.base_lr - start_lr) * (1 - math.cos(math.pi * progress / peak)) / 2
+        progress = (progress - peak) / (1 - peak)
+        return self.min_lr + (self.base_lr - self.min_lr) * (1 + math.cos(math.pi * progress)) / 2
+
+    def step_batch(self, epoch, ii, num_batches):
+        self._set(self._lr(epoch + ii / max(1, num_batches)))
+
+    def step_epoch(self, train_loss=None, val_kappa=None):
+        if self.policy == 'loss' and train_loss is not None:
+            if train_loss > self.previous_loss:
+                self.epoch_lr = max(self.min_lr, self.epoch_lr * self.decay)
+            self.previous_loss = train_loss
+        elif self.policy == 'plateau' and val_kappa is not None:
+            if val_kappa > self.best_metric:
+                self.best_metric, self.bad_epochs = val_kappa, 0
+            else:
+                self.bad_epochs += 1
+                if self.bad_epochs >= self.patience:
+                    self.epoch_lr = max(self.min_lr, self.epoch_lr * self.decay)
+                    self.bad_epochs = 0
+        return self.lr
+
+
+class EarlyStopping(object):
+    """
+    指标（验证集 study kappa）连续 patience 个 epoch 没有比最好的结果提高 min_delta 以上时停止训练
+    patience 为 None 时不停止
+    """
+
+    def __init__(self, patience=None, min_delta=0.):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = -float('inf')
+        self.best_epoch = None
+        self.bad_epochs = 0
+
+    def step(self, epoch, metric):
+        """
+        返回 True 时停止训练
+        """
+        if metric > self.best + self.min_delta:
+            self.best, self.best_epoch, self.bad_epochs = metric, epoch, 0
+        else:
+            self.bad_epochs += 1
+        return self.patience is not None and self.bad_epochs >= self.patience
+
+
+class CheckpointKeeper(object):
+    """
+    保存每个 epoch 的 checkpoint，只保留最近 keep_last 个，以及验证集 study kappa 最好的一个（不会被删除）
+    directory/best.json 记录最好的 checkpoint 的路径、epoch 和 kappa。keep_last 为 None 时保留所有 checkpoint
+    """
+
+    def __init__(self, directory, keep_last=None):
+        self.directory = directory
+        self.keep_last = keep_last
+        self.saved = []
+        self.best = None
+
+    def save(self, model, name, epoch, metric):
+        path = model.save(os.path.join(self.directory, name))
+        self.saved.append(path)
+        if self.best is None or metric > self.best['metric']:
+            self.best = {'path': path, 'epoch': epoch, 'metric': metric}
+            with open(os.path.join(self.directory, 'best.json'), 'w') as F:
+                json.dump(self.best, F, indent=1)
+
+        if self.keep_last is not None:
+            recent = self.saved[-self.keep_last:] if self.keep_last > 0 else []
+            for old in self.saved[:]:
+                if old not in recent and old != self.best['path']:
+                    if os.path.exists(old):
+                        os.remove(old)
+                    self.saved.remove(old)
+        return path
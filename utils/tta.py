@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import math
+import torch as t
+from torch.nn import functional as F
+
+# 按优先级排列，view 数为 K 时使用前 K 个。都是对已经 normalize 的 batch 做的 tensor 运算，
+# 输出的 shape 与输入相同（aspect_buckets 的非正方形 canvas 也可以使用，所以没有 90 度旋转）
+VIEWS = ('identity', 'hflip', 'vflip', 'rotate+10', 'rotate-10', 'crop_tl', 'crop_tr', 'crop_bl', 'crop_br', 'hvflip')
+
+
+def _rotate(x, degrees):
+    angle = math.radians(degrees)
+    theta = x.new_tensor([[math.cos(angle), -math.sin(angle), 0.], [math.sin(angle), math.cos(angle), 0.]])
+    grid = F.affine_grid(theta.expand(x.size(0), 2, 3), list(x.shape), align_corners=False)
+    return F.grid_sample(x, grid, align_corners=False)
+
+
+def _crop(x, corner, scale=0.875):
+    """
+    从一个角裁出 scale 大小的区域，再 resize 回原来的大小
+    """
+    h, w = x.shape[-2:]
+    ch, cw = int(h * scale), int(w * scale)
+    top = 0 if corner[0] == 't' else h - ch
+    left = 0 if corner[1] == 'l' else w - cw
+    return F.interpolate(x[..., top:top + ch, left:left + cw], size=(h, w), mode='bilinear', align_corners=False)
+
+
+def view(x, name):
+    if name == 'identity':
+        return x
+    if name == 'hflip':
+        return x.flip(-1)
+    if name == 'vflip':
+        return x.flip(-2)
+    if name == 'hvflip':
+        return x.flip(-2, -1)
+    if name.startswith('rotate'):
+        return _rotate(x, float(name[len('rotate'):]))
+    if name.startswith('crop_'):
+        return _crop(x, name[len('crop_'):])
+    raise ValueError(f'unknown tta view {name}, choose from {VIEWS}')
+
+
+class TestTimeAugmentation(object):
+    """
+    test 时每张图片只 decode 一次，在 device 上生成 K 个 view，拼在 batch 维度上做一次 forward：
+
+        x = tta.expand(input)                       (K * B, C, H, W)，第 k 个 view 为 x[k * B:(k + 1) * B]
+        score = model(x, tta.repeat(body_part))
+        logits = tta.reduce(score)                  (B, 2)，K 个 view 的概率的平均取 log
+
+    reduce 的结果经过 softmax 之后就是平均概率，所以可以和没有 TTA 的 logits 一样使用（PredictionCache、study 级别的平均）
+    views: view 数（使用 VIEWS 的前 views 个），或者 view 名字的 list
+    """
+
+    def __init__(self, views=1):
+        if isinstance(views, int):
+            if not 1 <= views <= len(VIEWS):
+                raise ValueError(f'tta views must be between 1 and {len(VIEWS)}')
+            views = VIEWS[:views]
+        self.views = list(views)
+        for name in self.views:
+            if name not in VIEWS:
+                raise ValueError(f'unknown tta view {name}, choose from {VIEWS}')
+
+    def __len__(self):
+        return len(self.views)
+
+    @property
+    def key(self):
+        """
+        加在 dataset.transform_key 后面，PredictionCache 区分不同的 TTA 设置
+        """
+        return '' if self.views == ['identity'] else 'tta_' + '+'.join(self.views)
+
+    def expand(self, x):
+        if len(self.views) == 1:
+            return view(x, self.views[0])
+        return t.cat([view(x, name) for name in self.views], 0)
+
+    def repeat(self, body_part):
+        return list(body_part) * len(self.views)
+
+    def reduce(self, score):
+        if len(self.views) == 1:
+            return score
+        probability = F.softmax(score.float(), dim=1).view(len(self.views), -1, score.size(1)).mean(0)
+        return probability.clamp(min=1e-12).log()
@@ -1,29 +1,68 @@
 # -*- coding: utf-8 -*-
 
-import visdom
+import os
+import json
 import time
+import queue
+import atexit
+import threading
 import numpy as np
 
+try:
+    import visdom
+except ImportError:
+    visdom = None
+
 
 class Visualizer(object):
     """
     封装了visdom的基本操作，但是你仍然可以通过`self.vis.function`
     调用原生的visdom接口
+
+    所有的 plot/log/img 都只是放进队列，由后台线程每隔 flush_interval 秒批量发送，
+    训练线程不会被 visdom 的 HTTP 请求阻塞。
+    连不上 visdom server（或者中途断开）时，改为追加写入本地的 jsonl 文件 log_file。
     """
 
-    def __init__(self, env='default', **kwargs):
-        self.vis = visdom.Visdom(env=env, **kwargs)
+    def __init__(self, env='default', log_file=None, flush_interval=2., **kwargs):
+        self.env = env
+        self.log_file = log_file or os.path.join('tmp', f'visdom_{env}.jsonl')
+        self.flush_interval = flush_interval
 
         # 画的第几个数，相当于横座标
         # 保存（’loss',23） 即loss的第23个点
         self.index = {}
-        self.log_text = ''
+        self._windows = set()
+
+        self.vis = self._connect(env, **kwargs)
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._sender, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _connect(self, env, **kwargs):
+        if visdom is None:
+            print('visdom is not installed, logging to', self.log_file)
+            return None
+        try:
+            # raise_exceptions=True：发送失败时抛出异常，_send 才能改为写入 log_file（False 时 visdom 只返回 False，数据被丢掉）
+            vis = visdom.Visdom(env=env, raise_exceptions=True, **kwargs)
+            if vis.check_connection():
+                return vis
+        except Exception:
+            pass
+        print('visdom server is not available, logging to', self.log_file)
+        return None
 
     def reinit(self, env='default', **kwargs):
         """
         修改visdom的配置
         """
-        self.vis = visdom.Visdom(env=env, **kwargs)
+        self.flush()
+        self.env = env
+        self._windows = set()
+        self.vis = self._connect(env, **kwargs)
         return self
 
     def plot_many(self, d):
@@ -43,12 +82,7 @@ class Visualizer(object):
         self.plot('loss',1.00)
         """
         x = self.index.get(name, 0)
-        self.vis.line(Y=np.array([y]), X=np.array([x]),
-                      win=name,
-                      opts=dict(title=name),
-                      update=None if x == 0 else 'append',
-                      **kwargs
-                      )
+        self._queue.put(('plot', name, (x, float(y), kwargs)))
         self.index[name] = x + 1
 
     def img(self, name, img_, **kwargs):
@@ -59,21 +93,102 @@ class Visualizer(object):
         self.img('input_imgs',t.Tensor(100,3,64,64),nrows=10)
         ！！！don‘t ~~self.img('input_imgs',t.Tensor(100,64,64),nrows=10)~~！！！
         """
-        self.vis.images(img_.cpu().numpy(),
-                        win=name,
-                        opts=dict(title=name),
-                        **kwargs
-                        )
+        self._queue.put(('img', name, (img_.detach().cpu().numpy(), kwargs)))
 
     def log(self, info, win='log_text'):
         """
         self.log({'loss':1,'lr':0.0001})
         """
+        line = '[{time}] {info} <br>'.format(time=time.strftime('%m%d_%H%M%S'), info=info)
+        self._queue.put(('log', win, line))
+
+    def flush(self):
+        """
+        等待队列中的数据全部发送完，close 之后不再有后台线程，直接返回
+        """
+        if self._thread.is_alive():
+            self._queue.join()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _sender(self):
+        """
+        后台线程：攒够 flush_interval 秒的数据后一起发送
+        """
+        pending = []
+        deadline = time.time() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                item = False
+
+            if item:
+                pending.append(item)
+            if item is None or time.time() >= deadline:
+                self._send(pending)
+                for _ in pending:
+                    self._queue.task_done()
+                pending = []
+                deadline = time.time() + self.flush_interval
+            if item is None:
+                self._queue.task_done()
+                return
+
+    def _send(self, items):
+        if not items:
+            return
+
+        # 同一条曲线的点合并成一次请求，同一个窗口的日志只发送新增的部分
+        points, logs, images = {}, {}, []
+        for kind, name, value in items:
+            if kind == 'plot':
+                points.setdefault(name, []).append(value)
+            elif kind == 'log':
+                logs[name] = logs.get(name, '') + value
+            else:
+                images.append((name, value))
+
+        if self.vis is not None:
+            try:
+                for name, values in points.items():
+                    self.vis.line(Y=np.array([y for _, y, _ in values]), X=np.array([x for x, _, _ in values]),
+                                  win=name,
+                                  opts=dict(title=name),
+                                  update='append' if name in self._windows else None,
+                                  **values[-1][2]
+                                  )
+                    self._windows.add(name)
+                for win, text in logs.items():
+                    self.vis.text(text, win, append=win in self._windows)
+                    self._windows.add(win)
+                for name, (img_, kwargs) in images:
+                    self.vis.images(img_, win=name, opts=dict(title=name), **kwargs)
+                return
+            except Exception as e:
+                print('visdom send failed, logging to', self.log_file, repr(e))
+                self.vis = None
+
+        self._write_local(points, logs)
 
-        self.log_text += ('[{time}] {info} <br>'.format(
-            time=time.strftime('%m%d_%H%M%S'),
-            info=info))
-        self.vis.text(self.log_text, win)
+    def _write_local(self, points, logs):
+        dirname = os.path.dirname(self.log_file)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        now = time.time()
+        with open(self.log_file, 'a') as F:
+            for name, values in points.items():
+                for x, y, _ in values:
+                    F.write(json.dumps({'time': now, 'env': self.env, 'type': 'plot', 'name': name, 'x': x, 'y': y}))
+                    F.write('\n')
+            for win, text in logs.items():
+                F.write(json.dumps({'time': now, 'env': self.env, 'type': 'log', 'name': win, 'text': text}))
+                F.write('\n')
 
     def __getattr__(self, name):
+        if name == 'vis':
+            raise AttributeError(name)
         return getattr(self.vis, name)